@@ -8,6 +8,9 @@ import pickle
 import time
 import sys
 import traceback
+# llm_retry.py is shared with the main implementation in the parent directory.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import llm_retry
 
 class Solution():
     """
@@ -58,16 +61,23 @@ class Solution():
                 f'Example:\n{constants.graph_reply_example}\n\n'
                 f'Data locations:\n{self.data_locations_str}\n')
 
-    def get_LLM_reply(self, prompt, retry_cnt=3, sleep_sec=10, system_role=None):
+    def get_LLM_reply(self, prompt, retry_cnt=3, sleep_sec=2, system_role=None):
         system_role = system_role or self.role
-        for attempt in range(retry_cnt):
-            try:
-                response_text = self.model["query_function"](prompt)
-                return [{"choices": [{"delta": {"content": response_text}}]}]
-            except Exception as e:
-                print(f"[ERROR] DeepSeek query failed ({attempt + 1}/{retry_cnt}): {e}")
-                time.sleep(sleep_sec)
-        raise Exception("Max retries exceeded with DeepSeek model.")
+
+        def request():
+            response_text = self.model["query_function"](prompt)
+            if not response_text:  # the query functions return "" on failure
+                raise llm_retry.EmptyReplyError("Empty response from DeepSeek model.")
+            return response_text
+
+        try:
+            response_text = llm_retry.call_with_retry(request,
+                                                      retry_cnt=retry_cnt,
+                                                      base_delay=sleep_sec,
+                                                      description="DeepSeek query")
+        except Exception as e:
+            raise Exception("Max retries exceeded with DeepSeek model.") from e
+        return [{"choices": [{"delta": {"content": response_text}}]}]
 
     def get_LLM_response_for_graph(self, execute=True):
         response = self.get_LLM_reply(prompt=self.graph_prompt)
@@ -1,4 +1,6 @@
 import re
+import os
+import sys
 import subprocess
 import pandas as pd
 import geopandas as gpd
@@ -8,6 +10,9 @@ import logging
 import time
 from collections import deque
 import LLM_Geo_Constants as constants
+# llm_retry.py is shared with the main implementation in the parent directory.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import llm_retry
 
 
 def ollama_query(prompt: str) -> str:
@@ -50,26 +55,33 @@ def get_LLM_reply(prompt,
                   stream=True,
                   verbose=True,
                   retry_cnt=3,
-                  sleep_sec=10):
+                  sleep_sec=2):
     """
     Query DeepSeek backend via ollama_query.
+    Stops at the first non-empty reply; retries back off exponentially (sleep_sec is the base delay).
     """
     # Append system_role into prompt if provided
     if system_role:
         prompt = f"{system_role}\n\n{prompt}"
 
-    for attempt in range(retry_cnt):
-        try:
-            response_text = model["query_function"](prompt)
-            simulated_response = [{"choices": [{"delta": {"content": response_text}}]}]
-            if verbose:
-                print("[LLM Response]:", response_text)
-            return simulated_response
-        except Exception as e:
-            if verbose:
-                print(f"[ERROR] Attempt {attempt + 1}/{retry_cnt} failed: {e}")
-            time.sleep(sleep_sec)
-    raise RuntimeError("Exceeded max retries, no response from DeepSeek model.")
+    def request():
+        response_text = model["query_function"](prompt)
+        if not response_text:  # ollama_query() returns "" when the query failed
+            raise llm_retry.EmptyReplyError("Empty response from DeepSeek model.")
+        return response_text
+
+    try:
+        response_text = llm_retry.call_with_retry(request,
+                                                  retry_cnt=retry_cnt,
+                                                  base_delay=sleep_sec,
+                                                  description="get_LLM_reply()")
+    except Exception as e:
+        raise RuntimeError("Exceeded max retries, no response from DeepSeek model.") from e
+
+    simulated_response = [{"choices": [{"delta": {"content": response_text}}]}]
+    if verbose:
+        print("[LLM Response]:", response_text)
+    return simulated_response
 
 
 
@@ -6,6 +6,7 @@ import openai
 from LLM_Geo_kernel import Solution
 import LLM_Geo_Constants as constants
 import helper
+import pushdown_reader
 
 # Function to browse for CSV file
 def browse_csv():
@@ -29,6 +30,7 @@ def execute_task():
     # Nullify columns if "None" button is clicked
     if none_clicked:
         task = f"{user_query}\nIgnore values that are 0."
+        known_columns = []
         data_locations = [
             f"CSV: {csv_file}",
             f"Shapefile: {shp_file}"
@@ -40,6 +42,7 @@ def execute_task():
     else:
         csv_column = english_entry.get()
         shp_column = italian_entry.get()
+        known_columns = [csv_column, shp_column]
         csv_language = "English" if not csv_language_var.get() else "Italian"
         shp_language = "English" if not shp_language_var.get() else "Italian"
 
@@ -64,7 +67,9 @@ def execute_task():
 
     # Initialize the Solution object
     selected_model = model_var.get()
-    solution = Solution(task=task, task_name=task_name, save_dir=save_dir, data_locations=data_locations, model=selected_model)
+    aoi = pushdown_reader.find_aoi(user_query)  # e.g., a neighborhood named in the request
+    solution = Solution(task=task, task_name=task_name, save_dir=save_dir, data_locations=data_locations, model=selected_model,
+                        known_columns=known_columns, aoi=aoi)
     print("Prompt to get solution graph:\n")
     print(solution.direct_request_prompt)
     
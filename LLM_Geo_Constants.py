@@ -9,6 +9,14 @@ OpenAI_key = config.get('API_Key', 'OpenAI_key')
 
 # carefully change these prompt parts!   
 
+# Prompts put these static parts (roles, requirements, reply examples) first and the task-specific
+# content last, so repeated requests share a prefix for prompt caching. Bump the version when changing them.
+prompt_template_version = '4'
+
+# the data locations of the canonical CRS copies (see canonical_crs.py) carry their CRS, e.g., "(CRS: EPSG:3004)",
+# so this requirement does not depend on the CRS set in config.ini.
+canonical_crs_requirement = "The data locations marked '(CRS: ...)' are copies of the data already in that one common CRS: DO NOT reproject these layers, and build the points of their CSV files (X/Y columns) in that CRS. Only convert other spatial layers into the same map projection, if they are not in the same projection."
+
 #--------------- constants for graph generation  ---------------
 graph_role = r'''A professional Geo-information scientist and programmer good at Python. You have worked on Geographic information science more than 20 years, and know every detail and pitfall when processing spatial data and coding. You know well how to set up workflows for spatial analysis tasks. You have significant experence on graph theory, application, and implementation. You are also experienced on generating map using Matplotlib and GeoPandas.
 '''
@@ -84,7 +92,7 @@ operation_requirement = [
                         "You need to receive the data from the functions, DO NOT load in the function if other functions have loaded the data and returned it in advance.",
                         # "Note module 'pandas' has no attribute or method of 'StringIO'",
                         "Use the latest Python modules and methods.",
-                        "When doing spatial analysis, convert the involved spatial layers into the same map projection, if they are not in the same projection.",
+                        canonical_crs_requirement,
                         # "DO NOT reproject or set spatial data(e.g., GeoPandas Dataframe) if only one layer involved.",
                         "Map projection conversion is only conducted for spatial data layers such as GeoDataFrame. DataFrame loaded from a CSV file does not have map projection information.",
                         "If join DataFrame and GeoDataFrame, using common columns, DO NOT convert DataFrame to GeoDataFrame.",
@@ -99,6 +107,7 @@ operation_requirement = [
                         "Geopandas.GeoSeries.intersects(other, align=True) returns a Series of dtype('bool') with value True for each aligned geometry that intersects other. other:GeoSeries or geometric object. ",
                         "If using GeoPandas for spatial joining, the arguements are: geopandas.sjoin(left_df, right_df, how='inner', predicate='intersects', lsuffix='left', rsuffix='right', **kwargs), how: the type of join, default ‘inner’, means use intersection of keys from both dfs while retain only left_df geometry column. If 'how' is 'left': use keys from left_df; retain only left_df geometry column, and similarly when 'how' is 'right'. ",
                         "Note geopandas.sjoin() returns all joined pairs, i.e., the return could be one-to-many. E.g., the intersection result of a polygon with two points inside it contains two rows; in each row, the polygon attributes are the same. If you need of extract the polygons intersecting with the points, please remember to remove the duplicated rows in the results.",
+                        "The vector layers in the data locations (e.g., the GeoPackages in 'Dataset/Canonical_CRS') have spatial indexes, built on first use and kept next to the file: 'import spatial_index; index = spatial_index.get_index(path, geometries=gdf.geometry)' where gdf = gpd.read_file(path), all rows, not reprojected. index.query(geometry, predicate='intersects'), index.within_distance(geometry, distance), index.nearest(geometry, k) and index.sjoin(other_gdf, predicate) (other_gdf in the CRS of the layer) return the positions (for gdf.iloc[]) of the matching features, without building an index in the program. Prefer them for repeated buffer, nearest, or intersects queries against those layers.",
 
                         "DO NOT use 'if __name__ == '__main__:' statement because this program needs to be executed by exec().",
                         "Use the Python built-in functions or attribute. If you do not remember, DO NOT make up fake ones, just use alternative methods.",
@@ -107,6 +116,7 @@ operation_requirement = [
                         "When read FIPS or GEOID columns from CSV files, read those columns as str or int, never as float.",
                         "FIPS or GEOID columns may be str type with leading zeros (digits: state: 2, county: 5, tract: 11, block group: 12), or integer type without leading zeros. Thus, when joining they, you can convert the integer colum to str type with leading zeros to ensure the success.",
                         "If you need to make a map and the map size is not given, set the map size to 15*10 inches.",
+                        "To draw city-wide maps of line or polygon layers (e.g., buildings, roads), use 'import geometry_pyramid; geometry_pyramid.plot(gdf, ax=ax, path=layer_path, **kwargs)' instead of gdf.plot(ax=ax, **kwargs), where layer_path is the file gdf was read from (omit it if the rows were reordered or the geometries changed): it draws geometries simplified to the output size and DPI, without visible difference but much faster.",
                         ]
 # other requirements prone to errors, not used for now
 """
@@ -156,7 +166,7 @@ direct_request_requirement = [
                         "Generate descriptions for input and output arguments.",
                         "Note module 'pandas' has no attribute or method of 'StringIO'.",
                         "Use the latest Python modules and methods.",
-                        "When doing spatial analysis, convert the involved spatial layers into the same map projection, if they are not in the sample projection.",
+                        canonical_crs_requirement,
                         # "DO NOT reproject or set spatial data(e.g., GeoPandas Dataframe) if only one layer involved.",
                         "Map projection conversion is only conducted for spatial data layers such as GeoDataFrame. DataFrame loaded from a CSV file does not have map projection information.",
                         "If join DataFrame and GeoDataFrame, using common columns, DO NOT convert DataFrame to GeoDataFrame.",
@@ -171,6 +181,7 @@ direct_request_requirement = [
                         "Geopandas.GeoSeries.intersects(other, align=True) returns a Series of dtype('bool') with value True for each aligned geometry that intersects other. other:GeoSeries or geometric object. ",
                         "If using GeoPandas for spatial joining, the arguements are: geopandas.sjoin(left_df, right_df, how='inner', predicate='intersects', lsuffix='left', rsuffix='right', **kwargs), how: the type of join, default ‘inner’, means use intersection of keys from both dfs while retain only left_df geometry column. If 'how' is 'left': use keys from left_df; retain only left_df geometry column, and similarly when 'how' is 'right'. ",
                         "Note geopandas.sjoin() returns all joined pairs, i.e., the return could be one-to-many. E.g., the intersection result of a polygon with two points inside it contains two rows; in each row, the polygon attribute is the same. If you need of extract the polygons intersecting with the points, please remember to remove the duplicated rows in the results.",
+                        "The vector layers in the data locations (e.g., the GeoPackages in 'Dataset/Canonical_CRS') have spatial indexes, built on first use and kept next to the file: 'import spatial_index; index = spatial_index.get_index(path, geometries=gdf.geometry)' where gdf = gpd.read_file(path), all rows, not reprojected. index.query(geometry, predicate='intersects'), index.within_distance(geometry, distance), index.nearest(geometry, k) and index.sjoin(other_gdf, predicate) (other_gdf in the CRS of the layer) return the positions (for gdf.iloc[]) of the matching features, without building an index in the program. Prefer them for repeated buffer, nearest, or intersects queries against those layers.",
                         # "GEOID in US Census data and FIPS (or 'fips') in Census boundaries are integer with leading zeros. If use pandas.read_csv() to GEOID or FIPS (or 'fips') columns from read CSV files, set the dtype as 'str'.",
                         # "Drop rows with NaN cells, i.e., df.dropna(), before using Pandas or GeoPandas columns for processing (e.g. join or calculation).",
                         "The program is executable, put it in a function named 'direct_solution()' then run it, but DO NOT use 'if __name__ == '__main__:' statement because this program needs to be executed by exec().",
@@ -178,6 +189,7 @@ direct_request_requirement = [
                         "When read FIPS or GEOID columns from CSV files, read those columns as str or int, never as float.",
                         "FIPS or GEOID columns may be str type with leading zeros (digits: state: 2, county: 5, tract: 11, block group: 12), or integer type without leading zeros. Thus, when joining they, you can convert the integer colum to str type with leading zeros to ensure the success.",
                         "If you need to make a map and the map size is not given, set the map size to 15*10 inches.",
+                        "To draw city-wide maps of line or polygon layers (e.g., buildings, roads), use 'import geometry_pyramid; geometry_pyramid.plot(gdf, ax=ax, path=layer_path, **kwargs)' instead of gdf.plot(ax=ax, **kwargs), where layer_path is the file gdf was read from (omit it if the rows were reordered or the geometries changed): it draws geometries simplified to the output size and DPI, without visible difference but much faster.",
                         ]
 
 #--------------- constants for debugging prompt generation  ---------------
@@ -192,7 +204,7 @@ debug_requirement = [
                         'You must return the entire corrected program in only one Python code block(enclosed by ```python and ```); DO NOT return the revised part only.',
                         'If using GeoPandas to load a zipped ESRI shapefile from a URL, the correct method is "gpd.read_file(URL)". DO NOT download and unzip the file.',
                         "Note module 'pandas' has no attribute or method of 'StringIO'",
-                        "When doing spatial analysis, convert the involved spatial layers into the same map projection, if they are not in the same projection.",
+                        canonical_crs_requirement,
                         "DO NOT reproject or set spatial data(e.g., GeoPandas Dataframe) if only one layer involved.",
                         "Map projection conversion is only conducted for spatial data layers such as GeoDataFrame. DataFrame loaded from a CSV file does not have map projection information.",
                         "If join DataFrame and GeoDataFrame, using common columns, DO NOT convert DataFrame to GeoDataFrame.",
@@ -216,6 +228,21 @@ debug_requirement = [
                         "If you need to make a map and the map size is not given, set the map size to 15*10 inches.",
                         ]
 
+# added to the error information when a run exceeds its time or memory limit.
+debug_resource_limit_hint = "The program was stopped because it exceeded the time or memory limit. " \
+                            "Do not only fix the line; use a more efficient approach, e.g., vectorized operations " \
+                            "instead of looping over rows, a spatial index (sjoin) instead of pairwise comparisons, " \
+                            "and filter or select the needed rows and columns before overlay or join."
+
+# the patch debug mode (config.ini [Exec] debug_mode = patch) asks for a unified diff instead of the complete program.
+debug_patch_requirement = [
+                        'Return ONLY the changed lines as a unified diff in one code block (enclosed by ```diff and ```); DO NOT return the entire program.',
+                        'Each hunk starts with a header such as "@@ -12,3 +12,4 @@" (the line numbers in the given code); then the lines: " " (a space) for unchanged context lines, "-" for removed lines, and "+" for added lines.',
+                        'Copy the context and removed lines exactly from the given code, without the line numbers, and keep 2 context lines before and after each change.',
+                        'Keep the program structure, i.e., the function name, its arguments, and returns.',
+                        'Briefly elaborate your reasons for revision after the code block.',
+                        ]
+
 #--------------- constants for operation review prompt generation  ---------------
 operation_review_role =  r'''A professional Geo-information scientist and developer good at Python. You have worked on Geographic information science more than 20 years, and know every detail and pitfall when processing spatial data and coding. Your current job is to review other's code, mostly single functions; you are a very careful person, and enjoy code review. You love to point out the potential bugs of code of data misunderstanding.
 '''
@@ -310,3 +337,22 @@ sampling_data_requirement = [
                         #
                         ]
 
+
+
+#--------------- generation settings for each stage  ---------------
+# Used by helper.get_LLM_reply(stage=...).
+# max_tokens and stop are sent to the API (None: not set); stop_at_code_end stops reading the stream
+# once the first code block is closed, since only that block is used.
+# prompt_token_budget: the approximate token limit of the compiled prompt (see prompt_compiler.py).
+stage_generation_config = {
+                        'graph':            {'max_tokens': 2048, 'stop': None, 'stop_at_code_end': True},
+                        'operation':        {'max_tokens': 2048, 'stop': None, 'stop_at_code_end': True, 'prompt_token_budget': 6000},
+                        'operation_review': {'max_tokens': 2048, 'stop': None, 'stop_at_code_end': True},
+                        'assembly':         {'max_tokens': 4096, 'stop': None, 'stop_at_code_end': True},
+                        'assembly_review':  {'max_tokens': 4096, 'stop': None, 'stop_at_code_end': True},
+                        'direct_request':   {'max_tokens': 4096, 'stop': None, 'stop_at_code_end': True},
+                        'direct_review':    {'max_tokens': 4096, 'stop': None, 'stop_at_code_end': True},
+                        'debug':            {'max_tokens': 4096, 'stop': None, 'stop_at_code_end': True},
+                        'debug_patch':      {'max_tokens': 1024, 'stop': None, 'stop_at_code_end': True},
+                        'sampling_data':    {'max_tokens': 1024, 'stop': None, 'stop_at_code_end': True},
+                        }
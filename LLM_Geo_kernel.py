@@ -10,8 +10,21 @@ from openai import OpenAI
 import configparser
 import pickle
 import time
-import sys
-import traceback
+import asyncio
+from llm_telemetry import LLMTelemetry
+from prompt_compiler import PromptCompiler, PromptSection, get_function_signatures
+import code_checker
+import code_trial
+import data_sampler
+import exec_pool
+import checkpoint_exec
+import code_patch
+import code_fixers
+import fix_memory
+import dataset_catalog
+import pushdown_reader
+import canonical_crs
+from dag_executor import DAGExecutor
 
 #load config
 config = configparser.ConfigParser()
@@ -21,6 +34,41 @@ config.read('config.ini')
 OpenAI_key = config.get('API_Key', 'OpenAI_key')
 client = OpenAI(api_key=OpenAI_key)
 
+# candidate programs generated at once, trial-run against samples of the input data.
+default_candidate_cnt = config.getint('Candidates', 'candidate_cnt', fallback=3)
+trial_sample_rows = config.getint('Candidates', 'sample_rows', fallback=200)
+trial_timeout_sec = config.getfloat('Candidates', 'trial_timeout_sec', fallback=120)
+
+# generated programs run in warm worker processes, see exec_pool.ExecPool.
+exec_pool_size = config.getint('Exec', 'pool_size', fallback=2)
+reader_cache_mb = config.getfloat('Exec', 'reader_cache_mb', fallback=1024)
+mirror_dir = config.get('Exec', 'mirror_dir', fallback='') or None
+exec_timeout_sec = config.getfloat('Exec', 'timeout_sec', fallback=0) or None
+exec_cpu_limit_sec = config.getfloat('Exec', 'cpu_limit_sec', fallback=0) or None
+exec_memory_limit_mb = config.getfloat('Exec', 'memory_limit_mb', fallback=0) or None
+use_checkpoints = config.getboolean('Exec', 'checkpoints', fallback=True)
+checkpoint_min_step_sec = config.getfloat('Exec', 'checkpoint_min_step_sec', fallback=1)
+default_dry_run = config.getboolean('Exec', 'dry_run', fallback=False)
+dry_run_rows = config.getint('Exec', 'dry_run_rows', fallback=500)
+dry_run_method = config.get('Exec', 'dry_run_method', fallback='head')
+debug_mode = config.get('Exec', 'debug_mode', fallback='patch')
+use_local_fixers = config.getboolean('Exec', 'local_fixers', fallback=True)
+fix_memory_path = config.get('Exec', 'fix_memory', fallback='fix_memory.sqlite')
+max_same_error_cnt = config.getint('Exec', 'max_same_error_cnt', fallback=3)
+
+# the schemas of the data files named in the data locations are added to the prompts, see dataset_catalog.py.
+use_catalog = config.getboolean('Catalog', 'enabled', fallback=True)
+catalog_root = config.get('Catalog', 'root', fallback='Dataset')
+catalog_index_file = config.get('Catalog', 'index_file', fallback='.catalog.json')
+
+# the programs are asked to read the data with pushdown_reader.read_data(), given the known columns and AOI.
+use_pushdown = config.getboolean('Pushdown', 'enabled', fallback=True)
+
+# the data locations point to copies of the data files in one CRS, see canonical_crs.py.
+use_canonical_crs = config.getboolean('CanonicalCRS', 'enabled', fallback=True)
+canonical_crs_name = config.get('CanonicalCRS', 'crs', fallback='EPSG:3004')
+canonical_crs_dir = config.get('CanonicalCRS', 'dir', fallback='Dataset/Canonical_CRS')
+
   
 
 class Solution():
@@ -38,8 +86,12 @@ class Solution():
                  data_locations=[],
                  stream=True,
                  verbose=True,
+                 known_columns=None,
+                 aoi=None,
                 ):        
         self.task = task        
+        self.known_columns = [column for column in known_columns or [] if column]  # columns of interest given by the user
+        self.aoi = aoi  # area of interest, see pushdown_reader.find_aoi()
         self.solution_graph = None
         self.graph_response = None
         self.role = role
@@ -64,34 +116,82 @@ class Solution():
         self.code_for_assembly = ""
         self.graph_prompt = ""
          
+        self.original_data_locations = data_locations
+        if use_canonical_crs:
+            copies = canonical_crs.get_default_copies(crs=canonical_crs_name, out_dir=canonical_crs_dir, root=catalog_root)
+            self.data_locations = copies.rewrite_data_locations(data_locations)
+            if use_catalog and (self.data_locations != data_locations):  # index the new copies
+                dataset_catalog.get_default_catalog(root=catalog_root, index_file=catalog_index_file).scan()
         self.data_locations_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(self.data_locations)])     
+        self.data_schema_str = ""  # columns, CRS and bounds of the data files, from the dataset catalog
+        self.data_schema_brief_str = ""
+        if use_catalog:
+            catalog = dataset_catalog.get_default_catalog(root=catalog_root, index_file=catalog_index_file)
+            self.data_schema_str = catalog.get_text(self.data_locations_str)
+            self.data_schema_brief_str = catalog.get_text(self.data_locations_str, brief=True)
+        self.data_reading_str = pushdown_reader.get_reading_hint(self.known_columns, self.aoi) if use_pushdown else ""
         
-        graph_requirement = constants.graph_requirement.copy()
-        graph_requirement.append(f"Save the network into GraphML format, save it at: {self.graph_file}")
-        graph_requirement_str =  '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(graph_requirement)])
-        
-        graph_prompt = f'Your role: {self.role} \n\n' + \
-               f'Your task: {constants.graph_task_prefix} \n {self.task} \n\n' + \
-               f'Your reply needs to meet these requirements: \n {graph_requirement_str} \n\n' + \
-               f'Your reply example: {constants.graph_reply_exmaple} \n\n' + \
-               f'Data locations (each data is a node): {self.data_locations_str} \n'
+        graph_requirement_str =  '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(constants.graph_requirement)])
+
+        # static parts first, so the prompts share a cacheable prefix; see prompt_compiler.PromptCompiler.
+        graph_sections = [
+            PromptSection('role', f'Your role: {self.role} \n\n', static=True),
+            PromptSection('task_prefix', f'Your task: {constants.graph_task_prefix} (the question is given below) \n\n', static=True),
+            PromptSection('requirements', f'Your reply needs to meet these requirements: \n {graph_requirement_str} \n\n', static=True),
+            PromptSection('reply_example', f'Your reply example: {constants.graph_reply_exmaple} \n\n', static=True),
+            PromptSection('task', f'The question: \n {self.task} \n\n'),
+            PromptSection('graph_file', f'Save the network into GraphML format, save it at: {self.graph_file} \n\n'),
+            PromptSection('data_locations', f'Data locations (each data is a node): {self.data_locations_str} \n'),
+        ] + self.get_data_schema_sections()
+        self.prompt_reports = {}  # stage -> report of PromptCompiler.compile()
+        graph_prompt, self.prompt_reports['graph'] = PromptCompiler(version=constants.prompt_template_version).compile(graph_sections)
         self.graph_prompt = graph_prompt
 
         # self.direct_request_prompt = ''
         self.direct_request_LLM_response = ''
         self.direct_request_code = ''
+        self.direct_request_candidates = []
+        self.execution_result = None  # the structured result of the last run of execute_complete_program()
+        self.operation_results = {}  # node_name -> result of execute_operations()
+        self.local_fixes = []  # the fixes of code_fixers applied by execute_complete_program(), with 'saved'
 
         self.chat_history = [{'role': 'system', 'content': role}]
 
+        # records every LLM call of this solution into the JSONL trace.
+        self.telemetry = LLMTelemetry(trace_file=helper.default_telemetry.trace_file, run_id=self.task_name)
+
+    def get_data_schema_sections(self):
+        '''
+        The prompt section of the data schema from the dataset catalog (reduced to the column names when
+        over budget); no section if the data are not in the catalog.
+        '''
+        if not self.data_schema_str:
+            return []
+        return [PromptSection('data_schema',
+                              f"The data files (columns, CRS and bounds, from the dataset catalog): \n{self.data_schema_str} \n\n",
+                              priority=40,
+                              summary=f"The data files (from the dataset catalog): \n{self.data_schema_brief_str} \n\n")]
+
+    def get_data_reading_sections(self):
+        '''
+        The prompt section asking to read only the needed columns and rows, see pushdown_reader.read_data().
+        '''
+        if not self.data_reading_str:
+            return []
+        return [PromptSection('data_reading', f"{self.data_reading_str} \n\n", priority=45)]
+
     def get_LLM_reply(self,
             prompt,
             verbose=True,
             temperature=1,
             stream=True,
             retry_cnt=3,
-            sleep_sec=10,
+            sleep_sec=2,
             system_role=None,
             model=None,
+            cache_mode=None,
+            stage=None,
+            trace_info=None,
             ):
 
 
@@ -101,44 +201,22 @@ class Solution():
         if model is None:
             model = self.model
 
-        # Query ChatGPT with the prompt
-        # if verbose:
-        #     print("Geting LLM reply... \n")
-        count = 0
-        isSucceed = False
         self.chat_history.append({'role': 'user', 'content': prompt})
-        while (not isSucceed) and (count < retry_cnt):
-            try:
-                count += 1
-                response = client.chat.completions.create(model=model,
-                # messages=self.chat_history,  # Too many tokens to run.
-                messages=[
-                            {"role": "system", "content": system_role},
-                            {"role": "user", "content": prompt},
-                          ],
-                temperature=temperature,
-                stream=stream)
-            except Exception as e:
-                # logging.error(f"Error in get_LLM_reply(), will sleep {sleep_sec} seconds, then retry {count}/{retry_cnt}: \n", e)
-                print(f"Error in get_LLM_reply(), will sleep {sleep_sec} seconds, then retry {count}/{retry_cnt}: \n",
-                      e)
-                time.sleep(sleep_sec)
-
-        response_chucks = []
-        if stream:
-            for chunk in response:
-                response_chucks.append(chunk)
-                content = chunk.choices[0].delta.content
-                if content is not None:
-                    if verbose:
-                        print(content, end='')
-        else:
-            content = response.choices[0].message.content
-            # print(content)
-        print('\n\n')
-        # print("Got LLM reply.")
 
-        response = response_chucks  # good for saving
+        # helper.get_LLM_reply() handles the API call and the reply cache.
+        response = helper.get_LLM_reply(prompt=prompt,
+                                        system_role=system_role,
+                                        model=model,
+                                        verbose=verbose,
+                                        temperature=temperature,
+                                        stream=stream,
+                                        retry_cnt=retry_cnt,
+                                        sleep_sec=sleep_sec,
+                                        cache_mode=cache_mode,
+                                        stage=stage,
+                                        telemetry=self.telemetry,
+                                        trace_info=trace_info,
+                                        )
 
         content = helper.extract_content_from_LLM_reply(response)
 
@@ -153,6 +231,8 @@ class Solution():
                                         prompt=self.graph_prompt,
                                         system_role=self.role,
                                         model=self.model,
+                                        stage='graph',
+                                        trace_info={'prefix_id': self.prompt_reports['graph']['prefix_id']},
                                          )
         self.graph_response = response
         try:
@@ -241,7 +321,6 @@ class Solution():
 
         # get ancestors code
         ancestor_operations = self.get_ancestor_operations(node_name)
-        ancestor_operation_codes = '\n'.join([oper['operation_code'] for oper in ancestor_operations])
         descendant_operations = self.get_descendant_operations(node_name)
         descendant_defs = self.get_descendant_operations_definition(descendant_operations)
         descendant_defs_str = str(descendant_defs)
@@ -252,20 +331,48 @@ class Solution():
             f'The function return line is: {operation["return_line"]}'
         ]
 
-        operation_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(
-            pre_requirements + constants.operation_requirement)])
+        operation_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(constants.operation_requirement)])
+        function_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(pre_requirements)])
+
+        # The static parts go first. The prompt is compiled within a token budget: when over budget, the sections
+        # are first summarized in priority order (the graph code to its edges, the descendant definitions to their
+        # names, the distant ancestors to their signatures), then dropped in the same order if still over budget.
+        graph_edges_str = '\n'.join([f"{u} -> {v}" for u, v in self.solution_graph.edges()])
+        descendant_names_str = '\n'.join([f"{oper['node_name']}: {oper['function_definition']}" for oper in descendant_operations])
+
+        sections = [
+            PromptSection('role', f'Your role: {constants.operation_role} \n\n', static=True),
+            PromptSection('reply_example', f'Your reply example: {constants.operation_reply_exmaple} \n\n', static=True),
+            PromptSection('requirements', f'Your reply needs to meet these requirements: \n {operation_requirement_str} \n\n', static=True),
+            PromptSection('operation_task', f'operation_task: {constants.operation_task_prefix} {operation["description"]} \n\n', required=True),
+            PromptSection('function_requirements', f'The function also needs to meet these requirements: \n {function_requirement_str} \n\n', required=True),
+            PromptSection('task', f'This function is one step to solve the question/task: {self.task} \n\n', required=True),
+            PromptSection('graph_code',
+                          f"This function is a operation node in a solution graph for the question/task, the Python code to build the graph is: \n{self.code_for_graph} \n\n",
+                          priority=20,
+                          summary=f"This function is a operation node in a solution graph for the question/task, the edges of the graph are: \n{graph_edges_str} \n\n"),
+            PromptSection('data_locations', f'Data locations: {self.data_locations_str} \n\n', required=True),
+        ] + self.get_data_schema_sections() + self.get_data_reading_sections() + [
+            PromptSection('ancestor_header', "The ancestor function code is (need to follow the generated file names and attribute names): \n ", required=True),
+        ]
+        for oper in ancestor_operations:
+            distance = nx.shortest_path_length(self.solution_graph, oper['node_name'], node_name)
+            sections.append(PromptSection(f"ancestor: {oper['node_name']}",
+                                          f"{oper['operation_code']}\n",
+                                          priority=50 - distance,  # the farther, the earlier to be reduced
+                                          summary=f"{get_function_signatures(oper['operation_code'], oper['description'])}\n"))
+        sections += [
+            PromptSection('descendant_header', " \n\nThe descendant function (if any) definitions for the question are (node_name is function name): \n ", required=True),
+            PromptSection('descendant_definitions', descendant_defs_str, priority=30, summary=descendant_names_str),
+        ]
 
-        operation_prompt = f'Your role: {constants.operation_role} \n\n' + \
-                           f'operation_task: {constants.operation_task_prefix} {operation["description"]} \n\n' + \
-                           f'This function is one step to solve the question/task: {self.task} \n\n' + \
-                           f"This function is a operation node in a solution graph for the question/task, the Python code to build the graph is: \n{self.code_for_graph} \n\n" + \
-                           f'Data locations: {self.data_locations_str} \n\n' + \
-                           f'Your reply example: {constants.operation_reply_exmaple} \n\n' + \
-                           f'Your reply needs to meet these requirements: \n {operation_requirement_str} \n\n' + \
-                           f"The ancestor function code is (need to follow the generated file names and attribute names): \n {ancestor_operation_codes} \n\n" + \
-                           f"The descendant function (if any) definitions for the question are (node_name is function name): \n {descendant_defs_str}"
+        token_budget = constants.stage_generation_config.get('operation', {}).get('prompt_token_budget')
+        operation_prompt, prompt_report = PromptCompiler(token_budget, version=constants.prompt_template_version).compile(sections)
+        if prompt_report['reduced']:
+            print(f"Prompt for {node_name} is over budget. " + PromptCompiler.report_text(prompt_report))
 
         operation['operation_prompt'] = operation_prompt
+        operation['prompt_report'] = prompt_report
         return operation_prompt
         # self.operations.append(operation_dict)
     # def get_prompts_for_operations(self):  ######## Not use ###########
@@ -315,7 +422,7 @@ class Solution():
         for node_name in operation_names:
             function_def_returns = helper.generate_function_def(node_name, self.solution_graph)
             self.operations.append(function_def_returns)
-    def get_LLM_responses_for_operations(self, review=True):
+    def get_LLM_responses_for_operations(self, review=True, local_review=True):
         # def_list, data_node_list = helper.generate_function_def_list(self.solution_graph)
         self.initial_operations()
         for idx, operation in enumerate(self.operations):
@@ -327,6 +434,8 @@ class Solution():
                           prompt=prompt,
                           system_role=constants.operation_role,
                           model=self.model,
+                          stage='operation',
+                          trace_info={'node_name': node_name, 'prefix_id': operation['prompt_report']['prefix_id']},
                           # model=r"gpt-4",
                          )
             # print(response)
@@ -339,11 +448,134 @@ class Solution():
             operation['operation_code'] = operation_code
 
             if review:
-                operation = self.ask_LLM_to_review_operation_code(operation)
+                operation = self.ask_LLM_to_review_operation_code(operation, local_review=local_review)
             
         return self.operations
 
 
+    def get_operation_levels(self):
+        '''
+        Group the operation nodes by topological level (depth in the solution graph).
+        Operations in the same level do not depend on each other, their ancestors are all in earlier levels.
+        Return a list of lists of operation node names.
+        '''
+        assert self.solution_graph, "Do not find solution graph!"
+        G = self.solution_graph
+        node_levels = {}
+        for node_name in nx.topological_sort(G):
+            level = max([node_levels[pred] for pred in G.predecessors(node_name)], default=-1)
+            if G.nodes[node_name]['node_type'] == 'operation':
+                level += 1
+            node_levels[node_name] = level
+
+        levels = {}
+        for node_name in self.operation_node_names:
+            levels.setdefault(node_levels[node_name], []).append(node_name)
+        return [levels[level] for level in sorted(levels)]
+
+    async def get_LLM_response_for_an_operation_async(self, operation, semaphore, review=True, local_review=True):
+        prompt = self.get_prompt_for_an_opearation(operation)
+        self.chat_history.append({'role': 'user', 'content': prompt})
+        response = await helper.get_LLM_reply_async(prompt=prompt,
+                                                    system_role=constants.operation_role,
+                                                    model=self.model,
+                                                    stage='operation',
+                                                    telemetry=self.telemetry,
+                                                    trace_info={'node_name': operation['node_name'],
+                                                                'prefix_id': operation['prompt_report']['prefix_id']},
+                                                    semaphore=semaphore,
+                                                    )
+        operation['response'] = response
+        self.chat_history.append({'role': 'assistant', 'content': helper.extract_content_from_LLM_reply(response)})
+        try:
+            operation_code = helper.extract_code(response=operation['response'], verbose=False)
+        except Exception as e:
+            operation_code = ""
+        operation['operation_code'] = operation_code
+        print(f"LLM generated code for operation node: {operation['node_name']}")
+
+        if review:
+            check_report = self.check_operation_code(operation) if local_review else None
+            if (check_report is not None) and check_report.passed:
+                print(f"Local checks passed for operation node: {operation['node_name']}, skip LLM review.")
+                operation['code'] = operation['operation_code']
+                return operation
+            review_prompt = self.get_review_prompt_for_operation(operation, check_report=check_report)
+            review_response = await helper.get_LLM_reply_async(prompt=review_prompt,
+                                                               system_role=constants.operation_review_role,
+                                                               model=self.model,
+                                                               stage='operation_review',
+                                                               telemetry=self.telemetry,
+                                                               trace_info={'node_name': operation['node_name']},
+                                                               retry_cnt=5,
+                                                               semaphore=semaphore,
+                                                               )
+            operation = self.apply_operation_review(operation, review_response)
+
+        return operation
+
+    async def get_LLM_responses_for_operations_async(self, review=True, max_concurrency=None, local_review=True):
+        '''
+        Generate (and review) the code of operation nodes level by level; the nodes in one level
+        are sent to the LLM at the same time. Only the ancestor code from earlier levels goes into a prompt.
+        Use "await" in a running event loop (e.g., Jupyter), otherwise use get_LLM_responses_for_operations_parallel().
+        '''
+        if max_concurrency is None:
+            max_concurrency = helper.max_concurrency
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.initial_operations()
+        operation_dict = {operation['node_name']: operation for operation in self.operations}
+        levels = self.get_operation_levels()
+        for idx, node_names in enumerate(levels):
+            print(f"Level {idx + 1} / {len(levels)}, LLM is generating code for operation nodes: {node_names}")
+            await asyncio.gather(*[self.get_LLM_response_for_an_operation_async(operation_dict[node_name],
+                                                                                semaphore=semaphore,
+                                                                                review=review,
+                                                                                local_review=local_review)
+                                   for node_name in node_names])
+        return self.operations
+
+    def get_LLM_responses_for_operations_parallel(self, review=True, max_concurrency=None, local_review=True):
+        return asyncio.run(self.get_LLM_responses_for_operations_async(review=review,
+                                                                       max_concurrency=max_concurrency,
+                                                                       local_review=local_review))
+
+
+    def execute_operations(self, force=False, max_workers=None):
+        '''
+        Run the operation code node by node in the order of the solution graph, without assembling
+        a program; see dag_executor.DAGExecutor. The outputs are cached by the code and inputs of each node,
+        so after regenerating or editing an operation, only it and its descendants run again.
+        Return a dict: node_name -> result; also kept in self.operation_results.
+        '''
+        if max_workers is None:
+            max_workers = helper.max_concurrency
+        executor = DAGExecutor(self.solution_graph,
+                               self.operations,
+                               cache_dir=os.path.join(self.save_dir, 'operation_cache'),
+                               pool=exec_pool.get_default_pool(size=exec_pool_size, reader_cache_mb=reader_cache_mb,
+                                                               mirror_dir=mirror_dir),
+                               max_workers=max_workers,
+                               timeout=exec_timeout_sec,
+                               cpu_limit_sec=exec_cpu_limit_sec,
+                               memory_limit_mb=exec_memory_limit_mb,
+                               )
+        results = executor.run(force=force)
+        for node_name in executor.operation_order:
+            result = results[node_name]
+            if result.get('stdout'):
+                print(result['stdout'])
+            if result['ok']:
+                status = "cached" if result['cached'] else f"done in {result['seconds']:.1f} seconds"
+            elif result.get('skipped'):
+                status = "skipped, an upstream operation failed"
+            else:
+                status = f"failed: {result['error_type']}: {result['message']}"
+            print(f"Operation {node_name}: {status}")
+        self.operation_results = results
+        return results
+
     def prompt_for_assembly_program(self):
         all_operation_code_str = '\n'.join([operation['operation_code'] for operation in self.operations])
         # operation_code = solution.operations[-1]['operation_code']
@@ -351,21 +583,29 @@ class Solution():
 
         assembly_requirement = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(constants.assembly_requirement)])
 
-        assembly_prompt = f"Your role: {constants.assembly_role} \n\n" + \
-                          f"Your task is: use the given Python functions, return a complete Python program to solve the question: \n {self.task}" + \
-                          f"Requirement: \n {assembly_requirement} \n\n" + \
-                          f"Data location: \n {self.data_locations_str} \n" + \
-                          f"Code: \n {all_operation_code_str}"
-        
+        assembly_sections = [
+            PromptSection('role', f"Your role: {constants.assembly_role} \n\n", static=True),
+            PromptSection('task_prefix', "Your task is: use the given Python functions, return a complete Python program to solve the question given below. \n\n", static=True),
+            PromptSection('requirements', f"Requirement: \n {assembly_requirement} \n\n", static=True),
+            PromptSection('task', f"The question: \n {self.task} \n\n"),
+            PromptSection('data_locations', f"Data location: \n {self.data_locations_str} \n"),
+        ] + self.get_data_schema_sections() + self.get_data_reading_sections() + [
+            PromptSection('code', f"Code: \n {all_operation_code_str}"),
+        ]
+        assembly_prompt, self.prompt_reports['assembly'] = PromptCompiler(version=constants.prompt_template_version).compile(assembly_sections)
+
         self.assembly_prompt = assembly_prompt
         return self.assembly_prompt
     
     
-    def get_LLM_assembly_response(self, review=True):
+    def get_LLM_assembly_response(self, review=True, local_review=True):
         self.prompt_for_assembly_program()
         assembly_LLM_response = helper.get_LLM_reply(self.assembly_prompt,
                           system_role=constants.assembly_role,
                           model=self.model,
+                          stage='assembly',
+                          telemetry=self.telemetry,
+                          trace_info={'prefix_id': self.prompt_reports['assembly']['prefix_id']},
                           # model=r"gpt-4",
                          )
         self.assembly_LLM_response = assembly_LLM_response
@@ -379,7 +619,7 @@ class Solution():
         self.code_for_assembly = code_for_assembly
 
         if review:
-            self.ask_LLM_to_review_assembly_code()
+            self.ask_LLM_to_review_assembly_code(local_review=local_review)
         
         return self.assembly_LLM_response
     
@@ -398,16 +638,23 @@ class Solution():
         direct_request_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(
             constants.direct_request_requirement)])
 
-        direct_request_prompt = f'Your role: {constants.direct_request_role} \n' + \
-                                f'Your task: {constants.direct_request_task_prefix} to address the question or task: {self.task} \n' + \
-                           f'Location for data you may need: {self.data_locations_str} \n' + \
-                           f'Your reply needs to meet these requirements: \n {direct_request_requirement_str} \n'
+        direct_request_sections = [
+            PromptSection('role', f'Your role: {constants.direct_request_role} \n', static=True),
+            PromptSection('task_prefix', f'Your task: {constants.direct_request_task_prefix} to address the question or task given below. \n', static=True),
+            PromptSection('requirements', f'Your reply needs to meet these requirements: \n {direct_request_requirement_str} \n', static=True),
+            PromptSection('task', f'The question or task: {self.task} \n'),
+            PromptSection('data_locations', f'Location for data you may need: {self.data_locations_str} \n'),
+        ] + self.get_data_schema_sections() + self.get_data_reading_sections()
+        direct_request_prompt, self.prompt_reports['direct_request'] = PromptCompiler(version=constants.prompt_template_version).compile(direct_request_sections)
         return direct_request_prompt
 
-    def get_direct_request_LLM_response(self, review=True):
+    def get_direct_request_LLM_response(self, review=True, local_review=True):
 
         response = helper.get_LLM_reply(prompt=self.direct_request_prompt,
                                         model=self.model,
+                                        stage='direct_request',
+                                        telemetry=self.telemetry,
+                                        trace_info={'prefix_id': self.prompt_reports['direct_request']['prefix_id']},
                                         stream=self.stream,
                                         verbose=self.verbose,
                                         )
@@ -417,88 +664,312 @@ class Solution():
         self.direct_request_code = helper.extract_code(response=response)
 
         if review:
-            self.ask_LLM_to_review_direct_code()
+            self.ask_LLM_to_review_direct_code(local_review=local_review)
 
         return self.direct_request_LLM_response
 
-    def execute_complete_program(self, code: str, try_cnt: int = 10) -> str:
-
+    async def get_direct_request_LLM_candidates_async(self, candidate_cnt=None, max_concurrency=None):
+        '''
+        Request several programs for the direct request at the same time; return the list of their code.
+        Each candidate is cached separately, so a re-run gets the same candidates.
+        '''
+        if candidate_cnt is None:
+            candidate_cnt = default_candidate_cnt
+        if max_concurrency is None:
+            max_concurrency = helper.max_concurrency
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        prompt = self.direct_request_prompt
+        prefix_id = self.prompt_reports['direct_request']['prefix_id']
+        responses = await asyncio.gather(*[helper.get_LLM_reply_async(prompt=prompt,
+                                                                      model=self.model,
+                                                                      stage='direct_request',
+                                                                      telemetry=self.telemetry,
+                                                                      trace_info={'prefix_id': prefix_id,
+                                                                                  'candidate': idx},
+                                                                      semaphore=semaphore,
+                                                                      cache_variant=idx if idx > 0 else None,
+                                                                      )
+                                           for idx in range(candidate_cnt)])
+        return [helper.extract_code(response=response) for response in responses]
+
+    def select_candidate_program(self, codes, sample_rows=None, timeout=None):
+        '''
+        Trial-run the candidate programs at the same time, each in its own process and temporary directory
+        (so their outputs from the samples are discarded) and reading only the first sample_rows rows
+        (features) of its input files. Candidates failing the local checks are not run.
+        Return the index of the first candidate that finished without error, or None.
+        '''
+        if sample_rows is None:
+            sample_rows = trial_sample_rows
+        if timeout is None:
+            timeout = trial_timeout_sec
+
+        sample_dir = os.path.join(self.save_dir, 'samples')
+        trial_indices = []
+        trial_codes = []
+        for idx, code in enumerate(codes):
+            check_report = code_checker.check_program_code(code,
+                                                           allowed_text=self.data_locations_str,
+                                                           entry_function='direct_solution')
+            if check_report.errors:
+                print(f"Candidate {idx + 1} failed the local checks:\n{check_report}\n")
+                continue
+            sampled_code, _ = data_sampler.sample_code_inputs(code, sample_dir, max_rows=sample_rows, absolute=True)
+            trial_indices.append(idx)
+            trial_codes.append(sampled_code)
+
+        print(f"Trial-running {len(trial_codes)} / {len(codes)} candidate programs on data samples...")
+        winner, results = code_trial.run_candidates(trial_codes, timeout=timeout, isolate=True)
+        for idx, result in zip(trial_indices, results):
+            if (result is not None) and (not result['ok']):
+                error_line = (result['stderr'].strip().splitlines() or [''])[-1]
+                print(f"Candidate {idx + 1} failed in {result['seconds']:.1f} seconds: {error_line}")
+        if winner is None:
+            return None
+        print(f"Candidate {trial_indices[winner] + 1} passed the trial run in {results[winner]['seconds']:.1f} seconds.\n")
+        return trial_indices[winner]
+
+    def get_direct_request_LLM_candidates(self, candidate_cnt=None, sample_rows=None, timeout=None):
+        '''
+        Request candidate_cnt programs for the direct request at the same time, and keep the first one
+        that passes a trial run on samples of the data as self.direct_request_code.
+        If none passes, keep the first candidate; execute_complete_program() will debug it.
+        '''
+        codes = asyncio.run(self.get_direct_request_LLM_candidates_async(candidate_cnt=candidate_cnt))
+        self.direct_request_candidates = codes
+        winner = self.select_candidate_program(codes, sample_rows=sample_rows, timeout=timeout)
+        if winner is None:
+            print("No candidate passed the trial run, use the first one.")
+            winner = 0
+        self.direct_request_code = codes[winner]
+        return self.direct_request_code
+
+    def execute_complete_program(self, code: str, try_cnt: int = 10, dry_run=None) -> str:
+        '''
+        Run the program in a warm worker process (exec_pool), and ask the LLM to debug it when it fails.
+        The program cannot change the kernel's variables, and every trial starts from a clean process.
+        The structured result of the last run is kept in self.execution_result.
+        With checkpoints (config.ini [Exec]), a debugged program resumes after the last slow statement
+        of its unchanged beginning, instead of loading and reprojecting all the data again.
+        dry_run: first run and debug the program on samples of its input files (dry_run_rows rows or
+                 features, see data_sampler.py), then once on the full data. None uses config.ini [Exec].
+        '''
+        if dry_run is None:
+            dry_run = default_dry_run
+        pool = exec_pool.get_default_pool(size=exec_pool_size, reader_cache_mb=reader_cache_mb,
+                                          mirror_dir=mirror_dir)
+        checkpoint_dir = os.path.join(self.save_dir, 'checkpoints') if use_checkpoints else None
+        if checkpoint_dir:
+            checkpoint_exec.clear_checkpoints(checkpoint_dir)  # the data may have changed since the last call
+        sample_dir = os.path.join(self.save_dir, 'samples')
+        on_sample = dry_run
+        fixed_errors = set()  # each error (type, message, line) is fixed locally at most once, then goes to the LLM
+        memory = fix_memory.FixMemory(fix_memory_path) if fix_memory_path else None
+        tried_memory_fixes = set()
+        pending_fix = None  # (failed result, code before the fix): stored in the memory if the fix works
+        error_cnts = {}  # fingerprint -> number of runs failed with it
         count = 0
         while count < try_cnt:
-            print(f"\n\n-------------- Running code (trial # {count + 1}/{try_cnt}) --------------\n\n")
-            try:
-                count += 1
-                compiled_code = compile(code, 'Complete program', 'exec')
-                exec(compiled_code, globals())  # #pass only globals() not locals()
-                #!!!!    all variables in code will become global variables! May cause huge issues!     !!!!
-                print("\n\n--------------- Done ---------------\n\n")
+            print(f"\n\n-------------- Running code (trial # {count + 1}/{try_cnt}{', on data samples' if on_sample else ''}) --------------\n\n")
+            count += 1
+            run_code = code
+            if on_sample:
+                run_code, path_map = data_sampler.sample_code_inputs(code, sample_dir, max_rows=dry_run_rows, method=dry_run_method)
+                if run_code == code:  # nothing to sample
+                    on_sample = False
+            result = pool.run(run_code,
+                              timeout=exec_timeout_sec,
+                              cpu_limit_sec=exec_cpu_limit_sec,
+                              memory_limit_mb=exec_memory_limit_mb,
+                              watch_dirs=[self.save_dir],
+                              checkpoint_dir=checkpoint_dir,
+                              checkpoint_min_step_sec=checkpoint_min_step_sec,
+                              )
+            if on_sample:  # show the original paths to the LLM, not the samples
+                for path, sample_path in path_map.items():
+                    for key in ['traceback', 'message', 'stdout']:
+                        if result[key]:
+                            result[key] = result[key].replace(sample_path.replace('\\', '/'), path)
+            self.execution_result = result
+            local_fix_saved = False  # the last local fix got past its error, e.g., to the same KeyError in a later line
+            if self.local_fixes and (self.local_fixes[-1]['saved'] is None):  # the run after a local fix
+                local_fix_saved = result['ok'] or (result['error_type'], result['message'], result['lineno']) != self.local_fixes[-1]['error']
+                self.local_fixes[-1]['saved'] = local_fix_saved
+            if pending_fix is not None:
+                failed_result, code_before = pending_fix
+                if memory and (result['ok'] or fix_memory.get_fingerprint(result) != fix_memory.get_fingerprint(failed_result)):
+                    memory.record(failed_result, code_before, code)
+                pending_fix = None
+            if result.get('resumed_from'):
+                print(f"Resumed from the checkpoint after line {result['resumed_from']}.")
+            print(result['stdout'])
+            if result['ok'] and on_sample:
+                print(f"\n\n--------------- Passed on data samples ({result['seconds']:.1f} seconds), run on the full data ---------------\n\n")
+                on_sample = False
+                count -= 1  # the full run is not a debug trial
+                continue
+            if result['ok']:
+                if checkpoint_dir:
+                    checkpoint_exec.clear_checkpoints(checkpoint_dir)
+                if result['files']:
+                    print("Files created or modified:\n" + '\n'.join(result['files']))
+                print(f"\n\n--------------- Done ({result['seconds']:.1f} seconds) ---------------\n\n")
+                self.print_local_fix_summary()
+                self.print_telemetry_summary()
                 return code
 
-            # except SyntaxError as err:
-            #     error_class = err.__class__.__name__
-            #     detail = err.args[0]
-            #     line_number = err.lineno
-            #
-            except Exception as err:
-
-                # cl, exc, tb = sys.exc_info()
-
-                # print("An error occurred: ", traceback.extract_tb(tb))
-
+            fingerprint = fix_memory.get_fingerprint(result)
+            if not local_fix_saved:  # not stuck on the error if a local fix moved it
+                error_cnts[fingerprint] = error_cnts.get(fingerprint, 0) + 1
+            if count == try_cnt or (max_same_error_cnt and error_cnts.get(fingerprint, 0) >= max_same_error_cnt):
                 if count == try_cnt:
                     print(f"Failed to execute and debug the code within {try_cnt} times.")
-                    return code
-
-                debug_prompt = self.get_debug_prompt(exception=err, code=code)
-                print("Sending error information to LLM for debugging...")
-                # print("Prompt:\n", debug_prompt)
-                response = helper.get_LLM_reply(prompt=debug_prompt,
-                                                system_role=constants.debug_role,
-                                                model=self.model,
-                                                verbose=True,
-                                                stream=True,
-                                                retry_cnt=5,
-                                                )
-                code = helper.extract_code(response)
-
-        return code
+                else:
+                    print(f"The same error occurred {error_cnts[fingerprint]} times, stop debugging.")
+                self.print_local_fix_summary()
+                self.print_telemetry_summary()
+                return code
 
+            pending_fix = (result, code)
+            error = (result['error_type'], result['message'], result['lineno'])  # each line once, e.g., a column misspelled in several lines
+            if use_local_fixers and (error not in fixed_errors):
+                fix = code_fixers.fix_code(code, result, known_columns=self.known_columns)
+                if fix is not None:
+                    fixed_errors.add(error)
+                    self.local_fixes.append({'fixer': fix['fixer'], 'description': fix['description'],
+                                             'error': error, 'saved': None})
+                    print(f"Fixed locally ({fix['fixer']}): {fix['description']}. Run again without asking the LLM.")
+                    code = fix['code']
+                    continue
+
+            hint = ""
+            if memory:
+                known_diffs = [diff for diff in memory.lookup(result) if (fingerprint, diff) not in tried_memory_fixes]
+                for diff in known_diffs:
+                    tried_memory_fixes.add((fingerprint, diff))
+                    try:
+                        code = code_patch.apply_and_validate(code, diff)
+                    except code_patch.PatchError:
+                        continue
+                    print("Applied a known fix of the same error from the fix memory. Run again without asking the LLM.")
+                    break
+                else:
+                    hint = memory.get_hint(result)
+                if code != pending_fix[1]:
+                    continue
+
+            code = self.debug_code(code, result, hint=hint, trace_info={'debug_trial': count,
+                                                                        'error_type': result['error_type'],
+                                                                        'on_sample': on_sample})
 
-    def get_debug_prompt(self, exception, code):
-        etype, exc, tb = sys.exc_info()
-        exttb = traceback.extract_tb(tb)  # Do not quite understand this part.
-        # https://stackoverflow.com/questions/39625465/how-do-i-retain-source-lines-in-tracebacks-when-running-dynamically-compiled-cod/39626362#39626362
+        return code
 
-        ## Fill the missing data:
-        exttb2 = [(fn, lnnr, funcname,
-                   (code.splitlines()[lnnr - 1] if fn == 'Complete program'
-                    else line))
-                  for fn, lnnr, funcname, line in exttb]
 
-        # Print:
-        error_info_str = 'Traceback (most recent call last):\n'
-        for line in traceback.format_list(exttb2[1:]):
-            error_info_str += line
-        for line in traceback.format_exception_only(etype, exc):
-            error_info_str += line
+    def debug_code(self, code, result, trace_info=None, mode=None, hint=""):
+        '''
+        Ask the LLM to correct the failed program; return the corrected code.
+        hint: added to the error information, e.g., the known fixes of the same error (see fix_memory.py).
+        mode: 'patch' asks for a unified diff of the changed lines and applies it (see code_patch.py),
+              falling back to a complete rewrite if the diff does not apply or breaks the syntax;
+              'rewrite' asks for the complete program. None uses config.ini [Exec].
+        '''
+        mode = mode or debug_mode
+        trace_info = trace_info or {}
+        if mode == 'patch':
+            debug_prompt = self.get_debug_prompt(exception=result, code=code, patch=True, hint=hint)
+            print("Sending error information to LLM for debugging (a diff of the changed lines)...")
+            response = helper.get_LLM_reply(prompt=debug_prompt,
+                                            system_role=constants.debug_role,
+                                            model=self.model,
+                                            stage='debug_patch',
+                                            telemetry=self.telemetry,
+                                            trace_info=trace_info,
+                                            verbose=True,
+                                            stream=True,
+                                            retry_cnt=5,
+                                            )
+            diff = code_patch.extract_diff(helper.extract_content_from_LLM_reply(response))
+            try:
+                return code_patch.apply_and_validate(code, diff)
+            except code_patch.PatchError as e:
+                print(f"Cannot apply the diff, ask for the complete program: {e}")
+
+        debug_prompt = self.get_debug_prompt(exception=result, code=code, hint=hint)
+        print("Sending error information to LLM for debugging...")
+        # print("Prompt:\n", debug_prompt)
+        response = helper.get_LLM_reply(prompt=debug_prompt,
+                                        system_role=constants.debug_role,
+                                        model=self.model,
+                                        stage='debug',
+                                        telemetry=self.telemetry,
+                                        trace_info=trace_info,
+                                        verbose=True,
+                                        stream=True,
+                                        retry_cnt=5,
+                                        )
+        return helper.extract_code(response)
+
+    def print_local_fix_summary(self):
+        '''
+        Print the fixes of code_fixers, and the LLM debug round trips they saved: the fixes after which
+        the program passed or failed with another error.
+        '''
+        if not self.local_fixes:
+            return
+        saved_cnt = sum(1 for fix in self.local_fixes if fix['saved'])
+        print(f"Local fixers: {len(self.local_fixes)} fixes, saved {saved_cnt} LLM debug round trips.")
+        for fix in self.local_fixes:
+            print(f"  {fix['fixer']}: {fix['description']} ({'saved' if fix['saved'] else 'not saved'})")
+
+    def print_telemetry_summary(self):
+        '''
+        Print the tokens, latency and retries of the LLM calls of this solution, by stage.
+        '''
+        self.telemetry.print_summary()
+
+    def get_debug_prompt(self, exception, code, patch=False, hint=""):
+        '''
+        exception: the structured result of a failed exec_pool run, or an exception being handled.
+        patch: ask for a unified diff of the changed lines, and show the code with line numbers.
+        hint: added after the error information.
+        '''
+        if isinstance(exception, dict):
+            error_info_str = exec_pool.format_result(exception)
+            if exception.get('limit'):
+                error_info_str += constants.debug_resource_limit_hint + "\n"
+        else:
+            error_info_str = exec_pool.get_error_info(exception, code)['traceback']
 
+        if hint:
+            error_info_str += "\n" + hint
         print(f"Error_info_str: \n{error_info_str}")
 
         # print(f"traceback.format_exc():\n{traceback.format_exc()}")
 
-        debug_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(constants.debug_requirement)])
+        if patch:
+            # the first three requirements ask for the entire program
+            debug_requirements = constants.debug_patch_requirement + constants.debug_requirement[3:]
+            task_str = "correct the code of a program according to the error information, then return the changes as a unified diff."
+            code_str = code_patch.number_lines(code)
+        else:
+            debug_requirements = constants.debug_requirement
+            task_str = "correct the code of a program according to the error information, then return the corrected and completed program."
+            code_str = code
+        debug_requirement_str = '\n'.join([f"{idx + 1}. {line}" for idx, line in enumerate(debug_requirements)])
 
         debug_prompt = f"Your role: {constants.debug_role} \n" + \
-                          f"Your task: correct the code of a program according to the error information, then return the corrected and completed program. \n\n" + \
+                          f"Your task: {task_str} \n\n" + \
                           f"Requirement: \n {debug_requirement_str} \n\n" + \
                           f"The given code is used for this task: {self.task} \n\n" + \
                           f"The data location associated with the given code: \n {self.data_locations_str} \n\n" + \
+                          (f"The data files (from the dataset catalog): \n{self.data_schema_str} \n\n" if self.data_schema_str else "") + \
                           f"The error information for the code is: \n{str(error_info_str)} \n\n" + \
-                          f"The code is: \n{code}"
+                          f"The code is: \n{code_str}"
 
         return debug_prompt
 
-    def ask_LLM_to_review_operation_code(self, operation):
+    def get_review_prompt_for_operation(self, operation, check_report=None):
         code = operation['operation_code']
         operation_prompt = operation['operation_prompt']
         review_requirement_str = '\n'.join(
@@ -507,30 +978,78 @@ class Solution():
                           f"Your task: {constants.operation_review_task_prefix} \n\n" + \
                           f"Requirement: \n{review_requirement_str} \n\n" + \
                           f"The code is: \n----------\n{code}\n----------\n\n" + \
-                          f"The requirements for the code is: \n----------\n{operation_prompt} \n----------\n"
+                          f"The requirements for the code is: \n----------\n{operation_prompt} \n----------\n" + \
+                          self.get_check_report_str(check_report)
 
             # {node_name: "", function_descption: "", function_definition:"", return_line:""
         # operation_prompt:"", operation_code:""}
+        return review_prompt
+
+    def apply_operation_review(self, operation, response):
+        code = operation['operation_code']
+        new_code = helper.extract_code(response)
+        reply_content = helper.extract_content_from_LLM_reply(response)
+        if (reply_content == "PASS") or (new_code == ""):  # if no modification.
+            print("Code review passed, no revision.\n\n")
+            new_code = code
+        operation['code'] = new_code
+
+        return operation
+
+    def check_operation_code(self, operation):
+        '''
+        Local static checks of the operation code; see code_checker.check_operation_code().
+        '''
+        check_report = code_checker.check_operation_code(operation['operation_code'],
+                                                         operation,
+                                                         allowed_text=self.data_locations_str)
+        operation['check_report'] = str(check_report)
+        return check_report
+
+    @staticmethod
+    def get_check_report_str(check_report):
+        if (check_report is None) or check_report.passed:
+            return ""
+        return f"\nThe static checks found these issues, fix them: \n----------\n{check_report} \n----------\n"
+
+    def ask_LLM_to_review_operation_code(self, operation, local_review=True):
+        '''
+        local_review: run the local static checks first, and ask the LLM to review only when they find issues.
+        '''
+        check_report = self.check_operation_code(operation) if local_review else None
+        if (check_report is not None) and check_report.passed:
+            print("Local checks passed, skip LLM review.\n\n")
+            operation['code'] = operation['operation_code']
+            return operation
+        review_prompt = self.get_review_prompt_for_operation(operation, check_report=check_report)
         print("LLM is reviewing the operation code... \n")
         # print(f"review_prompt:\n{review_prompt}")
         response = helper.get_LLM_reply(prompt=review_prompt,
                                         system_role=constants.operation_review_role,
                                         model=self.model,
+                                        stage='operation_review',
+                                        telemetry=self.telemetry,
                                         verbose=True,
                                         stream=True,
                                         retry_cnt=5,
                                         )
-        new_code = helper.extract_code(response)
-        reply_content = helper.extract_content_from_LLM_reply(response)
-        if (reply_content == "PASS") or (new_code == ""):  # if no modification.
-            print("Code review passed, no revision.\n\n")
-            new_code = code
-        operation['code'] = new_code
+        operation = self.apply_operation_review(operation, response)
 
         return operation
 
-    def ask_LLM_to_review_assembly_code(self):
+    def ask_LLM_to_review_assembly_code(self, local_review=True):
+        '''
+        local_review: run the local static checks first, and ask the LLM to review only when they find issues.
+        '''
         code = self.code_for_assembly
+        check_report = None
+        if local_review:
+            check_report = code_checker.check_program_code(code,
+                                                           allowed_text=self.data_locations_str,
+                                                           entry_function='assembely_solution')
+            if check_report.passed:
+                print("Local checks passed, skip LLM review.\n\n")
+                return
         assembly_prompt = self.assembly_prompt
         review_requirement_str = '\n'.join(
             [f"{idx + 1}. {line}" for idx, line in enumerate(constants.assembly_review_requirement)])
@@ -538,13 +1057,16 @@ class Solution():
                           f"Your task: {constants.assembly_review_task_prefix} \n\n" + \
                           f"Requirement: \n{review_requirement_str} \n\n" + \
                           f"The code is: \n----------\n{code} \n----------\n\n" + \
-                          f"The requirements for the code is: \n----------\n{assembly_prompt} \n----------\n\n"
+                          f"The requirements for the code is: \n----------\n{assembly_prompt} \n----------\n\n" + \
+                          self.get_check_report_str(check_report)
 
         print("LLM is reviewing the assembly code... \n")
         # print(f"review_prompt:\n{review_prompt}")
         response = helper.get_LLM_reply(prompt=review_prompt,
                                         system_role=constants.assembly_review_role,
                                         model=self.model,
+                                        stage='assembly_review',
+                                        telemetry=self.telemetry,
                                         verbose=True,
                                         stream=True,
                                         retry_cnt=5,
@@ -556,8 +1078,19 @@ class Solution():
 
         self.code_for_assembly = new_code
 
-    def ask_LLM_to_review_direct_code(self):
+    def ask_LLM_to_review_direct_code(self, local_review=True):
+        '''
+        local_review: run the local static checks first, and ask the LLM to review only when they find issues.
+        '''
         code = self.direct_request_code
+        check_report = None
+        if local_review:
+            check_report = code_checker.check_program_code(code,
+                                                           allowed_text=self.data_locations_str,
+                                                           entry_function='direct_solution')
+            if check_report.passed:
+                print("Local checks passed, skip LLM review.\n\n")
+                return
         direct_prompt = self.direct_request_prompt
         review_requirement_str = '\n'.join(
             [f"{idx + 1}. {line}" for idx, line in enumerate(constants.direct_review_requirement)])
@@ -565,13 +1098,16 @@ class Solution():
                           f"Your task: {constants.direct_review_task_prefix} \n\n" + \
                           f"Requirement: \n{review_requirement_str} \n\n" + \
                           f"The code is: \n----------\n{code} \n----------\n\n" + \
-                          f"The requirements for the code is: \n----------\n{direct_prompt} \n----------\n\n"
+                          f"The requirements for the code is: \n----------\n{direct_prompt} \n----------\n\n" + \
+                          self.get_check_report_str(check_report)
 
         print("LLM is reviewing the direct request code... \n")
         # print(f"review_prompt:\n{review_prompt}")
         response = helper.get_LLM_reply(prompt=review_prompt,
                                         system_role=constants.direct_review_role,
                                         model=self.model,
+                                        stage='direct_review',
+                                        telemetry=self.telemetry,
                                         verbose=True,
                                         stream=True,
                                         retry_cnt=5,
@@ -602,6 +1138,8 @@ class Solution():
         response = helper.get_LLM_reply(prompt=sampling_data_review_prompt,
                                         system_role=constants.sampling_data_role,
                                         model=self.model,
+                                        stage='sampling_data',
+                                        telemetry=self.telemetry,
                                         verbose=True,
                                         stream=True,
                                         retry_cnt=5,
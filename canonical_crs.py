@@ -0,0 +1,266 @@
+import os
+import re
+import sys
+import json
+import shutil
+import functools
+import threading
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import pyproj
+import shapely
+
+import dataset_catalog
+
+
+# the files with a canonical copy: layers become GeoPackages, CSV files with X/Y columns keep their format.
+vector_formats = ['.shp', '.geojson', '.gpkg']
+table_formats = ['.csv']
+
+manifest_name = 'canonical.json'
+
+# the format names in the data locations of the layers copied as GeoPackages.
+format_labels = {'.shp': re.compile(r"\bshape ?files?\b", re.IGNORECASE),
+                 '.geojson': re.compile(r"\bgeojson\b(?!\.)", re.IGNORECASE)}
+
+_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def _get_transformer(source_key, target_key):
+    return pyproj.Transformer.from_crs(source_key, target_key, always_xy=True)
+
+
+def to_crs_key(crs):
+    '''
+    A hashable text of a CRS, "EPSG:3004" when it has an EPSG code.
+    '''
+    crs = pyproj.CRS.from_user_input(crs)
+    epsg = crs.to_epsg()
+    return f"EPSG:{epsg}" if epsg is not None else crs.to_wkt()
+
+
+def get_transformer(source_crs, target_crs):
+    '''
+    The pyproj transformer between two CRSs (x, y order), created once per pair in the process.
+    '''
+    return _get_transformer(to_crs_key(source_crs), to_crs_key(target_crs))
+
+
+def transform_xy(x, y, source_crs, target_crs):
+    return get_transformer(source_crs, target_crs).transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+
+
+def reproject(gdf, crs):
+    '''
+    gdf.to_crs(crs) with a cached transformer; gdf itself if already in the CRS.
+    gdf: GeoDataFrame or GeoSeries with a CRS.
+    '''
+    if gdf.crs is None:
+        raise ValueError("Cannot reproject data without a CRS.")
+    target_key = to_crs_key(crs)
+    if to_crs_key(gdf.crs) == target_key:
+        return gdf
+    transformer = get_transformer(gdf.crs, target_key)
+
+    def transform(coords):
+        return np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    geometries = shapely.transform(np.asarray(gdf.geometry.values), transform)
+    if isinstance(gdf, gpd.GeoSeries):
+        return gpd.GeoSeries(geometries, index=gdf.index, crs=target_key, name=gdf.name)
+    return gdf.set_geometry(gpd.GeoSeries(geometries, index=gdf.index, crs=target_key), crs=target_key)
+
+
+def get_copy_path(path, out_dir, root='Dataset'):
+    '''
+    The canonical copy of a data file, at the same place under out_dir as the file under root.
+    '''
+    abs_path, abs_root = os.path.abspath(path), os.path.abspath(root)
+    if os.path.commonpath([abs_path, abs_root]) == abs_root:
+        relative_path = os.path.relpath(abs_path, abs_root)
+    else:
+        relative_path = os.path.join(os.path.basename(os.path.dirname(abs_path)), os.path.basename(abs_path))
+    stem, ext = os.path.splitext(relative_path)
+    return os.path.join(out_dir, stem + ('.gpkg' if ext.lower() in vector_formats else ext))
+
+
+def get_source_files(path):
+    files = [path]
+    if path.lower().endswith('.shp'):
+        files += [os.path.splitext(path)[0] + ext for ext in dataset_catalog.shapefile_companions]
+    return files
+
+
+def write_metadata(path, copy_path, crs):
+    '''
+    Describe a copy for the dataset catalog: a .qmd with the source's title and abstract and the new CRS,
+    and the attribute_table.txt of the source directory.
+    '''
+    metadata = {}
+    qmd_path = os.path.splitext(path)[0] + '.qmd'
+    if os.path.exists(qmd_path):
+        metadata = dataset_catalog.parse_qmd(qmd_path)
+    root = ET.Element('qgis')
+    for tag in ['title', 'abstract']:
+        ET.SubElement(root, tag).text = metadata.get(tag, "")
+    ET.SubElement(ET.SubElement(ET.SubElement(root, 'crs'), 'spatialrefsys'), 'authid').text = crs
+    ET.ElementTree(root).write(os.path.splitext(copy_path)[0] + '.qmd', encoding='utf-8')
+    attribute_table = os.path.join(os.path.dirname(path), dataset_catalog.attribute_table_name)
+    if os.path.exists(attribute_table):
+        shutil.copyfile(attribute_table, os.path.join(os.path.dirname(copy_path), dataset_catalog.attribute_table_name))
+
+
+def write_copy(path, copy_path, crs):
+    '''
+    Write the canonical copy of a data file; return its description, or None if it has no known CRS.
+    A file already in the CRS is its own copy.
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    tmp_path = f"{os.path.splitext(copy_path)[0]}.{os.getpid()}.tmp{os.path.splitext(copy_path)[1]}"
+    if ext in vector_formats:
+        source_crs = pyogrio.read_info(path)['crs']
+        if source_crs is None:
+            return None
+        source_crs = to_crs_key(source_crs)
+        if source_crs == crs:
+            return {'path': dataset_catalog.to_key(path), 'source_crs': source_crs}
+        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+        pyogrio.write_dataframe(reproject(pyogrio.read_dataframe(path), crs), tmp_path, driver='GPKG',
+                                layer=os.path.splitext(os.path.basename(copy_path))[0])
+    else:
+        entry = dataset_catalog.get_default_catalog().get_entry(path, exact=True) or {}
+        xy_columns, source_crs = entry.get('coordinate_columns'), entry.get('crs')
+        if not (xy_columns and source_crs):
+            return None
+        source_crs = to_crs_key(source_crs)
+        if source_crs == crs:
+            return {'path': dataset_catalog.to_key(path), 'source_crs': source_crs}
+        df = pd.read_csv(path, low_memory=False)
+        x, y = pd.to_numeric(df[xy_columns[0]], errors='coerce'), pd.to_numeric(df[xy_columns[1]], errors='coerce')
+        new_x, new_y = transform_xy(x, y, source_crs, crs)
+        df[xy_columns[0]], df[xy_columns[1]] = np.round(new_x, 3), np.round(new_y, 3)
+        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, copy_path)
+    write_metadata(path, copy_path, crs)
+    return {'path': dataset_catalog.to_key(copy_path), 'source_crs': source_crs}
+
+
+class CanonicalCopies():
+    """
+    Copies of the data files in one canonical CRS, kept in out_dir/<CRS> with the layout of root:
+    vector layers as GeoPackages, CSV files with their X/Y columns reprojected (the CSV CRS is taken
+    from the dataset catalog). A manifest records the source signatures, so a copy is rewritten
+    only when its source changes. Files without a known CRS get no copy.
+    """
+    def __init__(self, crs='EPSG:3004', out_dir='Dataset/Canonical_CRS', root='Dataset'):
+        self.crs = to_crs_key(crs)
+        self.out_dir = os.path.join(out_dir, re.sub(r"\W+", "_", self.crs)[:40])
+        self.root = root
+        self.manifest_path = os.path.join(self.out_dir, manifest_name)
+        self.manifest = {}  # source path -> {'path': ..., 'source_crs': ..., 'signature': ...}, or None
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_copy(self, path):
+        '''
+        The path of the canonical copy of a data file (written if missing or outdated); None if it has none.
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        if (ext not in vector_formats + table_formats) or not os.path.isfile(path):
+            return None
+        if os.path.abspath(path).startswith(os.path.abspath(self.out_dir) + os.sep):  # a copy itself
+            return path
+        key = dataset_catalog.to_key(os.path.abspath(path))
+        signature = [item[1:] for item in dataset_catalog.get_signature(get_source_files(path))]
+        with _lock:
+            record = self.manifest.get(key)
+            if record and (record['signature'] == signature) and ((record['path'] is None) or os.path.exists(record['path'])):
+                return record['path']
+            copy_path = get_copy_path(path, self.out_dir, root=self.root)
+            try:
+                description = write_copy(path, copy_path, self.crs)
+            except Exception as e:
+                print(f"Cannot write the {self.crs} copy of {path}: {e}")
+                return None
+            self.manifest[key] = {'path': description['path'] if description else None,
+                                  'source_crs': description['source_crs'] if description else None,
+                                  'signature': signature}
+            self.save()
+            return self.manifest[key]['path']
+
+    def rewrite_data_locations(self, data_locations):
+        '''
+        Replace the paths of the data files in the data locations by their canonical copies,
+        e.g., "Shapefile: Dataset/Dati_Pesaro/Civici.shp" -> "GeoPackage: Dataset/Canonical_CRS/EPSG_3004/Dati_Pesaro/Civici.gpkg (CRS: EPSG:3004)".
+        The format names of the files turned into GeoPackages (e.g., "Shapefile", "GeoJSON") are replaced as well.
+        '''
+        new_locations = []
+        for location in data_locations:
+            for path in find_data_paths(location):
+                copy_path = self.get_copy(path)
+                if copy_path is not None:
+                    copy_path = os.path.abspath(copy_path) if os.path.isabs(path) else copy_path
+                    location = location.replace(path, copy_path)
+                    ext = os.path.splitext(path)[1].lower()
+                    if (ext in format_labels) and copy_path.lower().endswith('.gpkg'):
+                        location = re.sub(format_labels[ext], "GeoPackage", location)
+                    if f"(CRS: {self.crs})" not in location:
+                        location += f" (CRS: {self.crs})"
+            new_locations.append(location)
+        return new_locations
+
+    def build_all(self):
+        '''
+        Write the copies of every data file under root.
+        '''
+        data_files = dataset_catalog.DatasetCatalog(self.root).find_files()[0]
+        out_dir = os.path.abspath(self.out_dir)
+        for path in data_files:
+            if os.path.abspath(path).startswith(os.path.dirname(out_dir) + os.sep):  # the copies themselves
+                continue
+            copy_path = self.get_copy(path)
+            print(f"{path} -> {copy_path or 'no copy (unknown CRS or no coordinates)'}")
+
+
+def find_data_paths(text):
+    '''
+    The paths of existing data files in a text; a path may contain spaces, e.g., "Dataset/CSV GIS Pesaro/Addresses.csv".
+    '''
+    paths = []
+    for match in re.finditer(r"\.(?:shp|geojson|gpkg|csv)\b", text, re.IGNORECASE):
+        end = match.end()
+        for start in [0] + [m.end() for m in re.finditer(r"[\s'\"(:,]", text[:match.start()])]:
+            candidate = text[start:end].strip()
+            if candidate and os.path.isfile(candidate):
+                paths.append(candidate)
+                break
+    return list(dict.fromkeys(paths))
+
+
+_default_copies = {}
+
+
+def get_default_copies(crs='EPSG:3004', out_dir='Dataset/Canonical_CRS', root='Dataset'):
+    key = (to_crs_key(crs), out_dir, root)
+    if key not in _default_copies:
+        _default_copies[key] = CanonicalCopies(crs=crs, out_dir=out_dir, root=root)
+    return _default_copies[key]
+
+
+if __name__ == '__main__':
+    CanonicalCopies(*sys.argv[1:2]).build_all()
@@ -0,0 +1,171 @@
+import os
+import ast
+import time
+import types
+import pickle
+import hashlib
+
+
+code_filename = 'Complete program'
+
+# statements re-run when resuming from a checkpoint, instead of being saved in it.
+replay_statement_types = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def can_flatten(function_node):
+    '''
+    The body of a function can run at the module level if it does not return, yield,
+    or declare global/nonlocal names (nested functions do not count).
+    '''
+    nodes = list(function_node.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.Return, ast.Yield, ast.YieldFrom, ast.Await, ast.Global, ast.Nonlocal)):
+            return False
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        nodes.extend(ast.iter_child_nodes(node))
+    return True
+
+
+def split_program(code, entry_function='direct_solution'):
+    '''
+    Split a program into top-level statements. A call of the entry function without arguments
+    (e.g., "direct_solution()") is replaced by the function body when possible, so the steps
+    inside the function can be checkpointed. The statements keep their line numbers.
+    '''
+    tree = ast.parse(code, filename=code_filename)
+    function_node = None
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == entry_function and not node.args.args \
+                and not node.decorator_list:
+            function_node = node
+    if (function_node is None) or (not can_flatten(function_node)):
+        return tree.body
+
+    statements = []
+    for node in tree.body:
+        is_entry_call = isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) \
+            and isinstance(node.value.func, ast.Name) and node.value.func.id == entry_function \
+            and not node.value.args and not node.value.keywords
+        if is_entry_call:
+            statements.extend(function_node.body)
+        elif node is not function_node:  # its body is in the steps
+            statements.append(node)
+    return statements
+
+
+def get_step_keys(statements, salt=""):
+    '''
+    The key of step i is the hash of the statements 0..i (and the salt, e.g., the working directory),
+    so a program with a changed statement cannot resume from a checkpoint after it.
+    '''
+    keys = []
+    digest = hashlib.sha1(salt.encode('utf-8'))
+    for statement in statements:
+        digest.update(ast.dump(statement).encode('utf-8'))
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+
+def is_plotting_object(value):
+    return type(value).__module__.startswith('matplotlib')
+
+
+def get_checkpoint_variables(namespace):
+    '''
+    The variables worth saving: data, not modules, functions or classes.
+    Return None when a figure is being drawn; pyplot's state cannot be restored from a checkpoint.
+    '''
+    variables = {}
+    for name, value in namespace.items():
+        if name.startswith('__') or isinstance(value, (types.ModuleType, types.FunctionType, type)):
+            continue
+        if is_plotting_object(value):
+            return None
+        variables[name] = value
+    return variables
+
+
+def save_checkpoint(path, namespace):
+    variables = get_checkpoint_variables(namespace)
+    if variables is None:
+        return False
+    data = {}
+    for name, value in variables.items():
+        try:
+            data[name] = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:  # e.g., open files, database connections; the resumed run will not have them
+            continue
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return True
+
+
+def load_checkpoint(path, namespace):
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    for name, value in data.items():
+        namespace[name] = pickle.loads(value)
+
+
+def run_statement(statement, namespace):
+    module = ast.Module(body=[statement], type_ignores=[])
+    exec(compile(module, code_filename, 'exec'), namespace)
+
+
+def run_with_checkpoints(code, namespace, checkpoint_dir, min_step_sec=1.0, entry_function='direct_solution', salt="",
+                         info=None):
+    '''
+    Run the program statement by statement. After a statement taking at least min_step_sec
+    (loading, reprojecting, joining, ...), the variables are saved into checkpoint_dir.
+    If a checkpoint of an unchanged prefix of the program exists, resume after it: the imports
+    and definitions before it are re-run, the other statements are skipped.
+    Return a dict: steps, resumed_from (line number of the last skipped statement, or None), checkpoints (saved).
+    info: the dict to fill and return, so the caller still has it when the program raises an error.
+    '''
+    statements = split_program(code, entry_function=entry_function)
+    keys = get_step_keys(statements, salt=salt)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    if info is None:
+        info = {}
+    info.update({'steps': len(statements), 'resumed_from': None, 'checkpoints': 0})
+
+    start_idx = 0
+    for idx in range(len(statements) - 1, -1, -1):
+        path = os.path.join(checkpoint_dir, f"{keys[idx]}.pkl")
+        if not os.path.exists(path):
+            continue
+        try:
+            for statement in statements[:idx + 1]:
+                if isinstance(statement, replay_statement_types):
+                    run_statement(statement, namespace)
+            load_checkpoint(path, namespace)
+        except Exception:  # a broken checkpoint, run from the start
+            break
+        start_idx = idx + 1
+        info['resumed_from'] = statements[idx].lineno
+        break
+
+    for idx in range(start_idx, len(statements)):
+        statement = statements[idx]
+        start_time = time.perf_counter()
+        run_statement(statement, namespace)
+        if isinstance(statement, replay_statement_types) or (time.perf_counter() - start_time < min_step_sec):
+            continue
+        if save_checkpoint(os.path.join(checkpoint_dir, f"{keys[idx]}.pkl"), namespace):
+            info['checkpoints'] += 1
+    return info
+
+
+def clear_checkpoints(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.pkl'):
+            try:
+                os.remove(os.path.join(checkpoint_dir, name))
+            except OSError:
+                pass
@@ -0,0 +1,198 @@
+import os
+import ast
+import builtins
+
+
+# functions whose first argument is an input data path
+data_reading_functions = ['read_file', 'read_csv', 'read_parquet', 'read_feather', 'read_excel', 'read_json',
+                          'read_table', 'read_dataframe', 'open',
+                          'read_data', 'read_vector']  # pushdown_reader.py also has a read_table(), listed with pandas'
+
+builtin_names = set(dir(builtins)) | {'__file__', '__name__', '__builtins__'}
+
+
+class CodeCheckReport():
+    """
+    Findings of the local static checks. errors: the code will fail or breaks the interface;
+    warnings: suspicious, worth a review.
+    """
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    @property
+    def passed(self):
+        return (len(self.errors) == 0) and (len(self.warnings) == 0)
+
+    def __str__(self):
+        lines = [f"Error: {error}" for error in self.errors] + [f"Warning: {warning}" for warning in self.warnings]
+        return '\n'.join(lines)
+
+
+def get_bound_names(tree):
+    '''
+    All names bound anywhere in the code (assignments, imports, functions, arguments, loops, ...).
+    Scopes are not distinguished, which is enough to catch names never defined.
+    '''
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.MatchAs) and node.name:
+            names.add(node.name)
+    return names
+
+
+def has_star_import(tree):
+    return any(isinstance(node, ast.ImportFrom) and any(alias.name == '*' for alias in node.names)
+               for node in ast.walk(tree))
+
+
+def check_undefined_names(tree, report, known_names=()):
+    if has_star_import(tree):
+        return
+    bound_names = get_bound_names(tree) | builtin_names | set(known_names)
+    undefined = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and (node.id not in bound_names):
+            undefined.setdefault(node.id, node.lineno)
+    for name, lineno in undefined.items():
+        report.errors.append(f"name '{name}' is used but never defined or imported (line {lineno}).")
+
+
+def get_call_name(call):
+    func = call.func
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    if isinstance(func, ast.Name):
+        return func.id
+    return None
+
+
+def normalize_path(path):
+    return path.replace('\\', '/').strip().lower()
+
+
+def check_data_paths(tree, report, allowed_text):
+    '''
+    Input paths given as string literals need to come from the data locations (allowed_text).
+    '''
+    allowed_text = normalize_path(allowed_text)
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and get_call_name(node) in data_reading_functions and node.args):
+            continue
+        arg = node.args[0]
+        if not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)):
+            continue
+        path = arg.value
+        if get_call_name(node) == 'open':
+            mode = node.args[1].value if (len(node.args) > 1 and isinstance(node.args[1], ast.Constant)) else 'r'
+            if any(flag in str(mode) for flag in 'wax'):
+                continue  # writing an output
+        if normalize_path(path) in allowed_text:
+            continue
+        if path.startswith(('http://', 'https://')) or os.path.exists(path):
+            report.warnings.append(f"reads '{path}' (line {node.lineno}), which is not one of the given data locations.")
+        else:
+            report.errors.append(f"reads '{path}' (line {node.lineno}), which is not one of the given data locations and does not exist.")
+
+
+def parse_code(code, report):
+    if not code.strip():
+        report.errors.append("the code is empty.")
+        return None
+    try:
+        return ast.parse(code)
+    except SyntaxError as e:
+        report.errors.append(f"syntax error: {e.msg} (line {e.lineno}).")
+        return None
+
+
+def get_function_node(tree, function_name):
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == function_name:
+            return node
+    return None
+
+
+def check_operation_code(code, operation, allowed_text=""):
+    '''
+    Check the code of an operation node against its function definition and return line,
+    generated by helper.generate_function_def().
+    '''
+    report = CodeCheckReport()
+    tree = parse_code(code, report)
+    if tree is None:
+        return report
+
+    node_name = operation['node_name']
+    function_node = get_function_node(tree, node_name)
+    if function_node is None:
+        report.errors.append(f"function '{node_name}' is not defined.")
+        return report
+
+    # parameters
+    try:
+        expected_def = ast.parse(f"def {operation['function_definition']}: pass").body[0]
+        expected_params = [arg.arg for arg in expected_def.args.args]
+    except SyntaxError:
+        expected_params = None
+    if expected_params is not None:
+        params = [arg.arg for arg in function_node.args.args]
+        if params != expected_params:
+            report.errors.append(f"the parameters of '{node_name}' are {params}, but the definition is "
+                                 f"'{operation['function_definition']}'.")
+
+    # returned variables
+    expected_returns = [name.strip() for name in operation['return_line'].replace('return', '', 1).split(',') if name.strip()]
+    return_nodes = [node for node in ast.walk(function_node) if isinstance(node, ast.Return)]
+    if expected_returns and not return_nodes:
+        report.errors.append(f"'{node_name}' has no return statement, expected '{operation['return_line']}'.")
+    for return_node in return_nodes:
+        value = return_node.value
+        elements = value.elts if isinstance(value, ast.Tuple) else ([value] if value is not None else [])
+        if len(elements) != len(expected_returns):
+            report.warnings.append(f"'{ast.unparse(return_node)}' (line {return_node.lineno}) does not match "
+                                   f"the return line '{operation['return_line']}'.")
+
+    check_undefined_names(tree, report)
+    check_data_paths(tree, report, allowed_text + operation['function_definition'])
+    return report
+
+
+def check_program_code(code, allowed_text="", entry_function=None):
+    '''
+    Check a complete program (assembly or direct request). entry_function: e.g., 'direct_solution',
+    which must be defined and called at the top level, without the 'if __name__ == "__main__":' block.
+    '''
+    report = CodeCheckReport()
+    tree = parse_code(code, report)
+    if tree is None:
+        return report
+
+    for node in tree.body:
+        if isinstance(node, ast.If) and '__name__' in ast.unparse(node.test):
+            report.errors.append(f"uses 'if __name__ == \"__main__\":' (line {node.lineno}), which does not run in exec().")
+
+    if entry_function is not None:
+        if get_function_node(tree, entry_function) is None:
+            report.errors.append(f"function '{entry_function}()' is not defined.")
+        is_called = any(isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                        and get_call_name(node.value) == entry_function for node in tree.body)
+        if not is_called:
+            report.errors.append(f"function '{entry_function}()' is not called at the top level of the program.")
+
+    check_undefined_names(tree, report)
+    check_data_paths(tree, report, allowed_text)
+    return report
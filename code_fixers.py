@@ -0,0 +1,316 @@
+import os
+import re
+import ast
+import difflib
+
+import pyogrio
+import pandas as pd
+
+import data_sampler
+import dataset_catalog
+
+
+# the same columns in the Italian shapefiles (Dataset/Dati_Pesaro) and the English CSV files (Dataset/CSV GIS Pesaro).
+column_synonyms = [
+                    ('altezza', 'height'),
+                    ('annoctr', 'year_ctr'),
+                    ('annofine', 'year_end', 'end_year'),
+                    ('qbaase', 'q_basic'),
+                    ('qgronda', 'q_gutter'),
+                    ('id_edifici', 'id_build'),
+                    ('scala', 'scale'),
+                    ('descrizion', 'street'),
+                    ('descrizi_1', 'street_num'),
+                    ('lettera', 'letter'),
+                    ('quart2014', 'neigh'),
+                    ('denominazi', 'denomin'),
+                    ('rione', 'district'),
+                    ('codammvia', 'cod_adm'),
+                    ('specieabbr', 'type_abb'),
+                    ('specieeste', 'name'),
+                    ('denomabbre', 'denom_abb'),
+                    ('denomestes', 'denom_ext'),
+                    ('denomperor', 'denom_emp'),
+                    ('nomeab', 'name_abb'),
+                    ('globalid', 'global_id'),
+                    ('sez', 'section'),
+                    ('sez2001', 'sec_2001'),
+                    ('sez2011', 'sec_2011'),
+                    ('cod_istat', 'istat_cod'),
+                    ('cod_tipo', 'cod_type'),
+                    ('cod_stagno', 'cod_ponds'),
+                    ('cod_fiume', 'cod_rivers'),
+                    ('cod_lago', 'cod_lakes'),
+                    ('cod_laguna', 'cod_lagoon', 'cod_lagoons'),
+                    ('loc2001', 'loc_2001'),
+                    ('loc2011', 'loc_2011'),
+                    ('tipo_loc', 'type_loc'),
+                    ('st_length_', 'st_length', 'st_lenght'),
+                    ]
+
+# names often used without their import.
+common_imports = {'pd': 'import pandas as pd',
+                  'gpd': 'import geopandas as gpd',
+                  'np': 'import numpy as np',
+                  'plt': 'import matplotlib.pyplot as plt',
+                  'os': 'import os',
+                  'math': 'import math',
+                  'shapely': 'import shapely',
+                  'Point': 'from shapely.geometry import Point',
+                  'LineString': 'from shapely.geometry import LineString',
+                  'Polygon': 'from shapely.geometry import Polygon',
+                  'box': 'from shapely.geometry import box',
+                  'unary_union': 'from shapely.ops import unary_union',
+                  'make_valid': 'from shapely.validation import make_valid',
+                  }
+
+# calls combining two spatial layers; the first is the receiver of a method call or the first argument.
+two_layer_calls = {'sjoin', 'sjoin_nearest', 'overlay', 'clip', 'distance', 'intersects', 'within', 'contains',
+                   'touches', 'crosses', 'overlaps', 'covers', 'covered_by', 'intersection', 'union',
+                   'difference', 'symmetric_difference'}
+
+# calls failing on invalid geometries (GEOS TopologyException).
+overlay_calls = two_layer_calls | {'unary_union', 'union_all', 'dissolve', 'buffer'}
+
+crs_mismatch_pattern = re.compile(r"CRS mismatch|different CRS|crs.{0,40}(?:do not|don't) match", re.IGNORECASE)
+invalid_geometry_pattern = re.compile(r"TopologyException|Self-intersection|invalid geometr|IllegalArgumentException", re.IGNORECASE)
+
+
+def get_file_columns(path):
+    '''
+    Return the column names of a CSV file or a vector layer (from the dataset catalog if indexed);
+    an empty list if it cannot be read.
+    '''
+    catalog = dataset_catalog.get_default_catalog()
+    entry = catalog.get_entry(path, exact=True)
+    if catalog.is_fresh(entry) and entry['columns']:
+        return [column['name'] for column in entry['columns']]
+    try:
+        if os.path.splitext(path)[1].lower() in ['.csv', '.txt']:
+            return [str(column) for column in pd.read_csv(path, nrows=0).columns]
+        return [str(field) for field in pyogrio.read_info(path)['fields']]
+    except Exception:
+        return []
+
+
+def get_code_columns(code):
+    '''
+    Return the columns of the data files read by the code (paths written as string literals).
+    '''
+    columns = []
+    for path in data_sampler.get_data_path_literals(code):
+        columns += get_file_columns(path)
+    return list(dict.fromkeys(columns))
+
+
+def match_column(name, columns):
+    '''
+    Return the column of the real schema meant by a missing column name, or None:
+    the same name in another case, a synonym in the other language, or a unique close spelling.
+    '''
+    lower_columns = {column.lower(): column for column in columns}
+    if name.lower() in lower_columns:
+        return lower_columns[name.lower()]
+    for group in column_synonyms:
+        if name.lower() in group:
+            matches = [lower_columns[synonym] for synonym in group if synonym in lower_columns]
+            if len(matches) == 1:
+                return matches[0]
+    matches = difflib.get_close_matches(name.lower(), list(lower_columns), n=2, cutoff=0.8)
+    if len(matches) == 1:
+        return lower_columns[matches[0]]
+    return None
+
+
+def get_statement_at(tree, lineno):
+    '''
+    Return the innermost statement containing the line, or None.
+    '''
+    found = None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.stmt) and (node.lineno <= lineno <= node.end_lineno):
+            if (found is None) or (node.end_lineno - node.lineno < found.end_lineno - found.lineno):
+                found = node
+    return found
+
+
+def get_root_name(node):
+    '''
+    The variable of an expression like "gdf", "gdf.geometry" or "gdf['geometry']"; None otherwise.
+    '''
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def get_layer_pairs(statement, call_names, module_names=('gpd', 'geopandas', 'pd', 'np', 'shapely')):
+    '''
+    Return the (first, second) variables of the calls in the statement combining two layers,
+    e.g., gpd.sjoin(a, b) and a.overlay(b) give (a, b); the second is None for single-layer calls
+    and properties, e.g., a.geometry.unary_union gives (a, None).
+    '''
+    pairs = []
+    called = set()
+    for node in ast.walk(statement):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and (node.func.attr in call_names):
+            called.add(id(node.func))
+            receiver = get_root_name(node.func.value)
+            operands = [get_root_name(arg) for arg in node.args]
+            if receiver in module_names:  # gpd.sjoin(a, b)
+                operands = operands[:2]
+            else:  # a.sjoin(b)
+                operands = [receiver] + operands[:1]
+        elif isinstance(node, ast.Attribute) and (node.attr in call_names) and (id(node) not in called):
+            operands = [get_root_name(node.value)]
+        else:
+            continue
+        operands = [name for name in operands if name and (name not in module_names)]
+        if operands:
+            pairs.append((operands[0], operands[1] if len(operands) > 1 else None))
+    return pairs
+
+
+def insert_lines(code, lineno, new_lines):
+    '''
+    Insert the lines before the given line (1-based), with the indentation of that line.
+    '''
+    code_lines = code.splitlines()
+    line = code_lines[lineno - 1]
+    indent = line[: len(line) - len(line.lstrip())]
+    code_lines[lineno - 1: lineno - 1] = [indent + new_line for new_line in new_lines]
+    return '\n'.join(code_lines) + ('\n' if code.endswith('\n') else '')
+
+
+def fix_missing_column(code, result, known_columns=()):
+    '''
+    KeyError of a column: replace the missing name by the column of the real schema it most likely means,
+    e.g., 'altezza' by 'height' when the code reads the English CSV file. Only the failing statement is changed,
+    so the same text elsewhere (e.g., a label or a column of another file) is kept.
+    '''
+    if (result['error_type'] != 'KeyError') or (result['lineno'] is None):
+        return None
+    columns = list(known_columns) + get_code_columns(code)
+    if not columns:
+        return None
+    statement = get_statement_at(ast.parse(code), result['lineno'])
+    if statement is None:
+        return None
+    start, end = statement.lineno, statement.end_lineno
+    body = getattr(statement, 'body', None)
+    if isinstance(body, list) and body:  # e.g., the header of a for loop, not its body
+        end = body[0].lineno - 1
+    code_lines = code.splitlines(keepends=True)
+    statement_text = ''.join(code_lines[start - 1:end])
+    for name in re.findall(r"""['"]([^'"\[\]]+)['"]""", result['message'] or ""):
+        if name in columns:
+            continue
+        column = match_column(name, columns)
+        if column is None:
+            continue
+        fixed_text = re.sub(rf"""(['"]){re.escape(name)}\1""", lambda match: f"{match.group(1)}{column}{match.group(1)}", statement_text)
+        if fixed_text != statement_text:
+            return ''.join(code_lines[:start - 1]) + fixed_text + ''.join(code_lines[end:]), \
+                   f"replaced the missing column '{name}' by '{column}' in line {result['lineno']}"
+    return None
+
+
+def fix_missing_import(code, result, known_columns=()):
+    '''
+    NameError of a module or a function usually imported: add the import after the other imports.
+    '''
+    if result['error_type'] != 'NameError':
+        return None
+    match = re.search(r"name '(\w+)' is not defined", result['message'] or "")
+    if (match is None) or (match.group(1) not in common_imports):
+        return None
+    import_line = common_imports[match.group(1)]
+    tree = ast.parse(code)
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    code_lines = code.splitlines()
+    position = imports[-1].end_lineno if imports else 0
+    code_lines.insert(position, import_line)
+    return '\n'.join(code_lines) + ('\n' if code.endswith('\n') else ''), f"added '{import_line}'"
+
+
+def fix_crs_mismatch(code, result, known_columns=()):
+    '''
+    A CRS mismatch (error or warning) of two layers: reproject the second layer to the CRS of the first
+    before the line combining them.
+    '''
+    locations = [result['lineno']] if crs_mismatch_pattern.search(result['message'] or "") else []
+    locations += [warning['lineno'] for warning in result.get('warnings') or []
+                  if crs_mismatch_pattern.search(warning['message'])]
+    tree = ast.parse(code)
+    statements = {}
+    for lineno in locations:
+        statement = get_statement_at(tree, lineno) if lineno else None
+        if statement is not None:
+            statements[statement.lineno] = statement
+    fixed = code
+    for lineno in sorted(statements, reverse=True):  # from the bottom, so the line numbers stay valid
+        pairs = [(first, second) for first, second in get_layer_pairs(statements[lineno], two_layer_calls) if second]
+        new_lines = []
+        for first, second in dict.fromkeys(pairs):
+            new_lines += [f"if hasattr({second}, 'to_crs') and getattr({first}, 'crs', None) is not None and {second}.crs != {first}.crs:",
+                          f"    {second} = {second}.to_crs({first}.crs)"]
+        if new_lines:
+            fixed = insert_lines(fixed, lineno, new_lines)
+    if fixed == code:
+        return None
+    return fixed, f"reprojected the layers to the same CRS before line(s) {', '.join(map(str, sorted(statements)))}"
+
+
+def fix_invalid_geometry(code, result, known_columns=()):
+    '''
+    TopologyException (or other invalid geometry errors) of an overlay: make the geometries of
+    the involved layers valid before the failing line.
+    '''
+    text = f"{result['error_type']}: {result['message']}"
+    if (not invalid_geometry_pattern.search(text)) or (result['lineno'] is None):
+        return None
+    statement = get_statement_at(ast.parse(code), result['lineno'])
+    if statement is None:
+        return None
+    names = []
+    for first, second in get_layer_pairs(statement, overlay_calls):
+        names += [name for name in (first, second) if name]
+    new_lines = []
+    for name in dict.fromkeys(names):
+        new_lines += [f"if hasattr({name}, 'make_valid'):",
+                      f"    {name} = {name}.set_geometry({name}.geometry.make_valid()) if hasattr({name}, 'set_geometry') else {name}.make_valid()"]
+    if not new_lines:
+        return None
+    return insert_lines(code, statement.lineno, new_lines), f"made the geometries of {', '.join(dict.fromkeys(names))} valid"
+
+
+# tried in order; each returns (fixed code, description) or None.
+fixers = [fix_missing_import, fix_missing_column, fix_crs_mismatch, fix_invalid_geometry]
+
+
+def fix_code(code, result, known_columns=()):
+    '''
+    Try the rule-based fixers on a failed run (see exec_pool.ExecPool.run()).
+    Return {'code': ..., 'fixer': ..., 'description': ...}, or None if no fixer applies.
+    The fixed code is valid Python and differs from the code.
+    known_columns: column names of the data, besides those of the files read by the code.
+    '''
+    if result['ok']:
+        return None
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return None
+    for fixer in fixers:
+        try:
+            fixed = fixer(code, result, known_columns=known_columns)
+        except Exception as e:  # a fixer must never break the debug loop
+            print(f"Fixer {fixer.__name__} failed: {e}")
+            continue
+        if fixed is None or fixed[0] == code:
+            continue
+        try:
+            ast.parse(fixed[0])
+        except SyntaxError:
+            continue
+        return {'code': fixed[0], 'fixer': fixer.__name__, 'description': fixed[1]}
+    return None
@@ -0,0 +1,135 @@
+import re
+import ast
+
+
+class PatchError(Exception):
+    pass
+
+
+hunk_header_pattern = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+diff_block_pattern = re.compile(r"```(?:diff|patch|udiff)?[ \t]*\n(.*?)```", re.DOTALL)
+# the prefix of number_lines(), sometimes copied into the diff
+line_number_prefix = re.compile(r"^\s*\d+\| ?")
+
+
+def extract_diff(text):
+    '''
+    Return the unified diff in an LLM reply: the first ```diff block, or the text itself if it looks like a diff.
+    '''
+    for block in diff_block_pattern.findall(text):
+        if re.search(r"^@@ ", block, re.MULTILINE):
+            return block
+    if re.search(r"^@@ ", text, re.MULTILINE):
+        return text
+    return ""
+
+
+def parse_unified_diff(diff):
+    '''
+    Return a list of hunks: (old_start, [(tag, line)]), tag is ' ', '-' or '+'.
+    File headers (---, +++) and "\\ No newline at end of file" are skipped.
+    '''
+    hunks = []
+    lines = None
+    for line in diff.splitlines():
+        match = hunk_header_pattern.match(line)
+        if match:
+            lines = []
+            hunks.append((int(match.group(1)), lines))
+            continue
+        if lines is None or line.startswith(('--- ', '+++ ', '\\')):
+            continue
+        if line == '':  # an empty context line whose leading space was dropped
+            lines.append((' ', ''))
+        elif line[0] in ' -+':
+            lines.append((line[0], line_number_prefix.sub('', line[1:], count=1)))
+        else:  # a context line without the leading space
+            lines.append((' ', line_number_prefix.sub('', line, count=1)))
+    if not hunks:
+        raise PatchError("No hunk (@@ -a,b +c,d @@) found in the diff.")
+    return hunks
+
+
+def find_block(code_lines, block, start, normalize):
+    '''
+    Find the position of block in code_lines, the nearest to start. Return None if not found.
+    '''
+    if not block:
+        return min(max(start, 0), len(code_lines))
+    target = [normalize(line) for line in block]
+    candidates = [idx for idx in range(len(code_lines) - len(block) + 1)
+                  if [normalize(line) for line in code_lines[idx: idx + len(block)]] == target]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda idx: abs(idx - start))
+
+
+def trim_context(hunk_lines, fuzz):
+    '''
+    Drop up to fuzz context lines at the start and the end of a hunk, like the fuzz factor of GNU patch.
+    '''
+    start, end = 0, len(hunk_lines)
+    while (start < fuzz) and (start < end) and (hunk_lines[start][0] == ' '):
+        start += 1
+    while (len(hunk_lines) - end < fuzz) and (end > start) and (hunk_lines[end - 1][0] == ' '):
+        end -= 1
+    return start, hunk_lines[start: end]
+
+
+def apply_unified_diff(code, diff, max_fuzz=2):
+    '''
+    Apply a unified diff to the code and return the new code. The hunks are located by their
+    context and removed lines (exact match first, then ignoring trailing spaces, then ignoring
+    indentation), the nearest to the line numbers in the headers, since LLMs often get those wrong.
+    If a hunk does not match, up to max_fuzz of its outer context lines are ignored.
+    Raise PatchError if a hunk cannot be located.
+    '''
+    code_lines = code.splitlines()
+    offset = 0  # lines added minus lines removed by the previous hunks
+    for hunk_idx, (old_start, hunk_lines) in enumerate(parse_unified_diff(diff)):
+        position = None
+        for fuzz in range(max_fuzz + 1):
+            trimmed_cnt, trimmed_lines = trim_context(hunk_lines, fuzz)
+            old_block = [line for tag, line in trimmed_lines if tag in ' -']
+            new_block = [line for tag, line in trimmed_lines if tag in ' +']
+            start = old_start - 1 + trimmed_cnt + offset
+            for normalize in [lambda line: line, str.rstrip, str.strip]:
+                position = find_block(code_lines, old_block, start, normalize)
+                if position is not None:
+                    break
+            if position is not None:
+                break
+        if position is None:
+            old_block = [line for tag, line in hunk_lines if tag in ' -']
+            raise PatchError(f"Hunk {hunk_idx + 1} does not match the code:\n" + '\n'.join(old_block))
+        code_lines[position: position + len(old_block)] = new_block
+        offset += len(new_block) - len(old_block)
+    new_code = '\n'.join(code_lines)
+    if code.endswith('\n'):
+        new_code += '\n'
+    return new_code
+
+
+def apply_and_validate(code, diff):
+    '''
+    Apply the diff, and make sure the result is valid Python and differs from the code.
+    '''
+    if not diff.strip():
+        raise PatchError("The reply contains no diff.")
+    new_code = apply_unified_diff(code, diff)
+    if new_code == code:
+        raise PatchError("The diff does not change the code.")
+    try:
+        ast.parse(new_code)
+    except SyntaxError as e:
+        raise PatchError(f"The patched code has a syntax error at line {e.lineno}: {e.msg}")
+    return new_code
+
+
+def number_lines(code):
+    '''
+    The code with line numbers, for the LLM to refer to.
+    '''
+    lines = code.splitlines()
+    width = len(str(len(lines)))
+    return '\n'.join(f"{idx + 1:>{width}}| {line}" for idx, line in enumerate(lines))
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import contextlib
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def trial_run_code(code, timeout=120, cwd=None, processes=None):
+    '''
+    Run a program in a separate Python process, so it cannot change the state of the caller.
+    processes: an optional list; the process is appended to it, so another thread can kill it.
+    Return a dict: ok, returncode, stdout, stderr, seconds.
+    '''
+    start_time = time.perf_counter()
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False, encoding='utf-8') as f:
+        f.write(code)
+        script_path = f.name
+
+    env = dict(os.environ, MPLBACKEND='Agg')  # plt.show() must not block
+    # the program may import the modules of this directory (e.g., spatial_index) from any cwd
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+    try:
+        process = subprocess.Popen([sys.executable, script_path],
+                                   cwd=cwd,
+                                   env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   text=True,
+                                   )
+        if processes is not None:
+            processes.append(process)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            stdout, _ = process.communicate()
+            stderr = f"TimeoutError: the program did not finish within {timeout} seconds."
+        result = {'ok': process.returncode == 0,
+                  'returncode': process.returncode,
+                  'stdout': stdout,
+                  'stderr': stderr,
+                  }
+    finally:
+        os.remove(script_path)
+
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+
+def run_candidates(codes, timeout=120, cwd=None, isolate=False):
+    '''
+    Trial-run the candidate programs at the same time, each in its own process.
+    isolate: run each candidate in its own temporary directory, removed afterwards, so the files it
+             writes (e.g., outputs made from data samples) are discarded; its input paths must be absolute.
+    Return (index of the first candidate that succeeded or None, list of results by index).
+    Once a candidate succeeds, the others are killed; their results stay None.
+    '''
+    results = [None] * len(codes)
+    if not codes:
+        return None, results
+
+    processes = []
+    winner = None
+    with contextlib.ExitStack() as stack, ThreadPoolExecutor(max_workers=len(codes)) as executor:
+        if isolate:
+            cwds = [stack.enter_context(tempfile.TemporaryDirectory(prefix='trial_', ignore_cleanup_errors=True)) for _ in codes]
+        else:
+            cwds = [cwd] * len(codes)
+        futures = {executor.submit(trial_run_code, code, timeout, cwds[idx], processes): idx for idx, code in enumerate(codes)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            result = future.result()
+            if winner is not None:
+                continue
+            results[idx] = result
+            if result['ok']:
+                winner = idx
+                for process in processes:
+                    if process.poll() is None:
+                        process.kill()
+    return winner, results
@@ -0,0 +1,220 @@
+import os
+import sys
+import time
+import hashlib
+import threading
+
+import pandas as pd
+import geopandas as gpd
+
+try:
+    import pyarrow  # GeoParquet and Feather need pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# file extension -> kind of the mirror: vector layers are mirrored as GeoParquet, CSV files as Feather.
+mirror_formats = {'.shp': 'vector',
+                  '.geojson': 'vector',
+                  '.gpkg': 'vector',
+                  '.csv': 'table',
+                  }
+
+shapefile_companions = ['.dbf', '.shx', '.prj', '.cpg']
+
+# the only arguments served from a mirror (column projection); calls with others use the original reader.
+mirror_arguments = {'read_file': {'columns'},
+                    'read_csv': {'usecols'},
+                    }
+
+# part of the mirror names; increase when the layout of the mirrors changes.
+mirror_version = 2
+
+# GeoParquet mirrors are written in row groups with their bounding boxes (a "bbox" covering column),
+# so bbox filters skip the row groups outside (see pushdown_reader.py).
+vector_row_group_size = 4096
+
+# the mirror directory of the installed ColumnarReaders, the default of pushdown_reader.read_data().
+default_mirror_dir = None
+
+
+def get_source_files(path):
+    files = [path]
+    if path.lower().endswith('.shp'):
+        files += [os.path.splitext(path)[0] + ext for ext in shapefile_companions]
+    return files
+
+
+def get_mirror_path(path, mirror_dir):
+    '''
+    The mirror of a file is named by its path, and the modification time and size of its files
+    (a shapefile's .dbf, .prj, ... as well), so an edited file gets a new mirror.
+    '''
+    key = f"{os.path.abspath(path)}|v{mirror_version}"
+    for source_file in get_source_files(path):
+        if os.path.exists(source_file):
+            stat = os.stat(source_file)
+            key += f"|{stat.st_mtime_ns}|{stat.st_size}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    ext = '.parquet' if mirror_formats[os.path.splitext(path)[1].lower()] == 'vector' else '.feather'
+    return os.path.join(mirror_dir, f"{os.path.splitext(os.path.basename(path))[0]}_{digest}{ext}")
+
+
+def can_mirror(path):
+    return (pyarrow is not None) and (os.path.splitext(path)[1].lower() in mirror_formats) and os.path.isfile(path)
+
+
+def build_mirror(path, mirror_dir, read_file=None, read_csv=None):
+    '''
+    Write the mirror of a data file (if missing); return its path.
+    read_file, read_csv: the original readers, when the module functions are patched.
+    '''
+    mirror_path = get_mirror_path(path, mirror_dir)
+    if os.path.exists(mirror_path):
+        return mirror_path
+    os.makedirs(mirror_dir, exist_ok=True)
+    tmp_path = f"{mirror_path}.{os.getpid()}.{threading.get_ident()}.tmp"  # workers may build the same mirror
+    if mirror_formats[os.path.splitext(path)[1].lower()] == 'vector':
+        gdf = (read_file or gpd.read_file)(path)
+        gdf.to_parquet(tmp_path, write_covering_bbox=True, row_group_size=vector_row_group_size)
+    else:
+        df = (read_csv or pd.read_csv)(path)
+        df.to_feather(tmp_path)
+    os.replace(tmp_path, mirror_path)
+    return mirror_path
+
+
+def get_mirror_columns(mirror_path):
+    if mirror_path.endswith('.parquet'):
+        return pyarrow.parquet.read_schema(mirror_path).names
+    with pyarrow.ipc.open_file(mirror_path) as reader:
+        return reader.schema.names
+
+
+def read_mirror(mirror_path, columns=None):
+    '''
+    Load a mirror, only the given columns (and the geometry) if columns is not None.
+    The columns keep the order of the source file, as the original readers do.
+    '''
+    if columns is not None:
+        all_columns = get_mirror_columns(mirror_path)
+        columns = [column for column in all_columns if column in set(columns)]
+    if mirror_path.endswith('.parquet'):
+        if columns is not None:
+            geometry_columns = [column for column in all_columns if column == 'geometry']
+            columns = [column for column in columns if column not in geometry_columns] + geometry_columns
+        gdf = gpd.read_parquet(mirror_path, columns=columns)
+        epsg = gdf.crs.to_epsg() if gdf.crs is not None else None
+        if epsg is not None:  # GeoParquet stores PROJJSON; print the CRS as "EPSG:3004" like the source
+            gdf = gdf.set_crs(epsg, allow_override=True)
+        return gdf
+    return pd.read_feather(mirror_path, columns=columns)
+
+
+class ColumnarReaders():
+    """
+    Shims of gpd.read_file() and pd.read_csv() loading GeoParquet/Feather mirrors of the data files,
+    built on the first read (see build_mirror()), instead of parsing the shapefiles and CSV texts.
+    Only calls with a local file path and no other arguments than the column projection
+    (columns= of read_file(), usecols= of read_csv() with column names) use the mirrors;
+    the others go to the original readers unchanged.
+    """
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        self._originals = {}
+        self.mirror_reads = 0
+
+    def get_original(self, func_name):
+        module = gpd if func_name == 'read_file' else pd
+        return self._originals.get(func_name, getattr(module, func_name))
+
+    def read(self, func_name, filename, *args, **kwargs):
+        original = self.get_original(func_name)
+        if args or (not isinstance(filename, (str, os.PathLike))) or (not set(kwargs) <= mirror_arguments[func_name]):
+            return original(filename, *args, **kwargs)
+        path = os.fspath(filename)
+        if not can_mirror(path) or (func_name == 'read_csv') != path.lower().endswith('.csv'):
+            return original(filename, *args, **kwargs)
+        columns = kwargs.get('columns', kwargs.get('usecols'))
+        if (columns is not None) and not (isinstance(columns, (list, tuple)) and all(isinstance(column, str) for column in columns)):
+            return original(filename, *args, **kwargs)
+        try:
+            mirror_path = build_mirror(path, self.mirror_dir,
+                                       read_file=self.get_original('read_file'), read_csv=self.get_original('read_csv'))
+            if (columns is not None) and not set(columns) <= set(get_mirror_columns(mirror_path)):
+                return original(filename, *args, **kwargs)  # let the original reader raise its own error
+            df = read_mirror(mirror_path, columns=columns)
+        except Exception:
+            return original(filename, *args, **kwargs)
+        self.mirror_reads += 1
+        return df
+
+    def install(self):
+        '''
+        Replace gpd.read_file() and pd.read_csv() by the shims.
+        '''
+        global default_mirror_dir
+        if pyarrow is None:
+            return
+        default_mirror_dir = self.mirror_dir
+        for module, func_name in [(gpd, 'read_file'), (pd, 'read_csv')]:
+            if func_name in self._originals:
+                continue
+            original = getattr(module, func_name)
+            self._originals[func_name] = original
+
+            def reader(filename, *args, _func_name=func_name, **kwargs):
+                return self.read(_func_name, filename, *args, **kwargs)
+            reader.__doc__ = original.__doc__
+            reader.__name__ = func_name
+            setattr(module, func_name, reader)
+
+    def uninstall(self):
+        for module, func_name in [(gpd, 'read_file'), (pd, 'read_csv')]:
+            original = self._originals.pop(func_name, None)
+            if original is not None:
+                setattr(module, func_name, original)
+
+
+def find_data_files(root):
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+        paths += [os.path.join(dir_path, name) for name in sorted(file_names) if os.path.splitext(name)[1].lower() in mirror_formats]
+    return paths
+
+
+def benchmark(root='Dataset', mirror_dir=None, repeat=3):
+    '''
+    For each layer, compare loading the source file (cold) with loading its mirror (warm); print a table.
+    The mirrors are built if missing.
+    '''
+    mirror_dir = mirror_dir or os.path.join(root, '.columnar')
+    print(f"{'layer':<48} {'source (s)':>10} {'build (s)':>10} {'mirror (s)':>10} {'speedup':>8}")
+    for path in find_data_files(root):
+        reader = pd.read_csv if path.lower().endswith('.csv') else gpd.read_file
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                reader(path)
+            source_sec = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            mirror_path = build_mirror(path, mirror_dir)
+            build_sec = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(repeat):
+                read_mirror(mirror_path)
+            mirror_sec = (time.perf_counter() - start) / repeat
+        except Exception as e:
+            print(f"{os.path.relpath(path, root):<48} cannot be read: {e}")
+            continue
+        print(f"{os.path.relpath(path, root):<48} {source_sec:>10.3f} {build_sec:>10.3f} {mirror_sec:>10.3f} "
+              f"{source_sec / max(mirror_sec, 1e-9):>7.1f}x")
+
+
+if __name__ == '__main__':
+    if pyarrow is None:
+        sys.exit("pyarrow is required for the GeoParquet/Feather mirrors.")
+    benchmark(*sys.argv[1:2])
@@ -0,0 +1,179 @@
+import os
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import networkx as nx
+
+import exec_pool
+
+
+def get_file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return f"{path}|missing"
+    return f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+
+
+class DAGExecutor():
+    """
+    Run the operations of a solution graph one by one, instead of an assembled program.
+
+    Each operation node runs its operation_code in a worker of exec_pool: the function is called with
+    the outputs of its upstream operations (input files keep their default paths), and its returned
+    data nodes are pickled into cache_dir under the node's key. The key is the hash of the node's code and
+    its inputs' fingerprints: the keys of the upstream operations, and the modification time and size of
+    the input files. So after editing or regenerating one operation, only that node and its descendants
+    run again; the others are loaded from the cache. Operations whose upstream are done run concurrently.
+
+    graph: the solution graph (networkx.DiGraph, node_type: 'data' or 'operation'); each data node
+           is produced by one operation at most, otherwise its value would be ambiguous (ValueError).
+    operations: the list of operation dicts of a Solution (node_name, operation_code, ...).
+    """
+    def __init__(self, graph, operations, cache_dir, pool=None, max_workers=4, timeout=None,
+                 cpu_limit_sec=None, memory_limit_mb=None):
+        self.graph = graph
+        self.operations = {operation['node_name']: operation for operation in operations}
+        self.cache_dir = cache_dir
+        self.pool = pool if pool is not None else exec_pool.get_default_pool()
+        self.max_workers = max_workers
+        self.run_kwargs = {'timeout': timeout, 'cpu_limit_sec': cpu_limit_sec, 'memory_limit_mb': memory_limit_mb}
+        self.operation_order = [node_name for node_name in nx.topological_sort(graph)
+                                if graph.nodes[node_name].get('node_type') == 'operation']
+        for data_name in graph.nodes:
+            producers = self.get_producers(data_name)
+            if (graph.nodes[data_name].get('node_type') != 'operation') and (len(producers) > 1):
+                raise ValueError(f"The data node '{data_name}' is produced by several operations: {producers}")
+
+    def get_producers(self, data_name):
+        return [pred for pred in self.graph.predecessors(data_name)
+                if self.graph.nodes[pred].get('node_type') == 'operation']
+
+    def get_upstream_operations(self, node_name):
+        '''
+        Return a dict: input data node -> the operation producing it (None for input files).
+        '''
+        upstream = {}
+        for data_name in self.graph.predecessors(node_name):
+            producers = self.get_producers(data_name)
+            upstream[data_name] = producers[0] if producers else None  # one at most, see __init__()
+        return upstream
+
+    def get_output_names(self, node_name):
+        return list(self.graph.successors(node_name))  # the same order as helper.generate_function_def()
+
+    def get_node_keys(self):
+        keys = {}
+        for node_name in self.operation_order:
+            digest = hashlib.sha1(node_name.encode('utf-8'))
+            digest.update(self.operations[node_name]['operation_code'].encode('utf-8'))
+            for data_name, producer in sorted(self.get_upstream_operations(node_name).items()):
+                if producer is None:
+                    fingerprint = get_file_fingerprint(self.graph.nodes[data_name].get('data_path', ''))
+                else:
+                    fingerprint = keys[producer]
+                digest.update(f"|{data_name}={fingerprint}".encode('utf-8'))
+            keys[node_name] = digest.hexdigest()
+        return keys
+
+    def get_output_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get_node_program(self, node_name, keys):
+        '''
+        The operation code followed by the lines loading its inputs, calling it, and saving its outputs.
+        The operation code comes first, so the line numbers in errors are the lines of the operation code.
+        '''
+        input_files = {}
+        for data_name, producer in self.get_upstream_operations(node_name).items():
+            if producer is not None:
+                input_files.setdefault(self.get_output_path(keys[producer]), []).append(data_name)
+        output_names = self.get_output_names(node_name)
+        output_path = self.get_output_path(keys[node_name])
+        driver = f"""
+
+import os as _os
+import pickle as _pickle
+_inputs = {{}}
+for _path, _names in {input_files!r}.items():
+    with open(_path, 'rb') as _f:
+        _outputs = _pickle.load(_f)
+    for _name in _names:
+        _inputs[_name] = _pickle.loads(_outputs[_name])
+_returns = {node_name}(**_inputs)
+_output_names = {output_names!r}
+if len(_output_names) <= 1:
+    _returns = (_returns,)
+_outputs = {{}}
+for _name, _value in zip(_output_names, _returns):
+    try:
+        _outputs[_name] = _pickle.dumps(_value)
+    except Exception:  # e.g., a figure; the downstream operations cannot use it
+        _outputs[_name] = _pickle.dumps(None)
+with open({output_path + '.tmp'!r}, 'wb') as _f:
+    _pickle.dump(_outputs, _f)
+_os.replace({output_path + '.tmp'!r}, {output_path!r})
+"""
+        return self.operations[node_name]['operation_code'] + driver
+
+    def run(self, force=False, cwd=None):
+        '''
+        Run the operations; return a dict: node_name -> result (see exec_pool.ExecPool.run()),
+        with 'cached' (loaded from the cache) and 'key'. Operations downstream of a failure are skipped.
+        force: run every operation even if its output is cached.
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        keys = self.get_node_keys()
+        results = {}
+        lock = threading.Lock()
+        pending = list(self.operation_order)
+
+        def upstream_of(node_name):
+            return [producer for producer in self.get_upstream_operations(node_name).values() if producer is not None]
+
+        def run_node(node_name):
+            if (not force) and os.path.exists(self.get_output_path(keys[node_name])):
+                result = {'ok': True, 'cached': True, 'seconds': 0.0}
+            else:
+                # the function definitions use the input names as default values, e.g., "def f(df=df)".
+                variables = {data_name: None for data_name in self.get_upstream_operations(node_name)}
+                result = self.pool.run(self.get_node_program(node_name, keys), cwd=cwd, variables=variables,
+                                       **self.run_kwargs)
+                result['cached'] = False
+            result['key'] = keys[node_name]
+            with lock:
+                results[node_name] = result
+            return node_name
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = set()
+            while pending or running:
+                for node_name in list(pending):
+                    upstream = upstream_of(node_name)
+                    if any((producer in results) and not results[producer]['ok'] for producer in upstream) or \
+                            any(results.get(producer, {}).get('skipped') for producer in upstream):
+                        results[node_name] = {'ok': False, 'skipped': True, 'cached': False, 'key': keys[node_name],
+                                              'message': "An upstream operation failed."}
+                        pending.remove(node_name)
+                    elif all(producer in results for producer in upstream):
+                        running.add(executor.submit(run_node, node_name))
+                        pending.remove(node_name)
+                if not running:
+                    if pending:  # cannot happen in a DAG; avoid spinning forever
+                        raise RuntimeError(f"Cannot schedule the operations: {pending}")
+                    continue
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        return results
+
+    def load_outputs(self, node_name, keys=None):
+        '''
+        Return the cached outputs of an operation: a dict of data node -> value.
+        '''
+        keys = keys or self.get_node_keys()
+        with open(self.get_output_path(keys[node_name]), 'rb') as f:
+            outputs = pickle.load(f)
+        return {name: pickle.loads(value) for name, value in outputs.items()}
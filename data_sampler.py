@@ -0,0 +1,197 @@
+import os
+import ast
+import hashlib
+
+import pyogrio
+import shapely
+import pandas as pd
+import geopandas as gpd
+
+
+# file extension -> (kind, OGR driver); other files are used as they are.
+sampleable_formats = {'.csv': ('table', None),
+                      '.txt': ('table', None),
+                      '.shp': ('vector', 'ESRI Shapefile'),
+                      '.geojson': ('vector', 'GeoJSON'),
+                      '.json': ('vector', 'GeoJSON'),
+                      '.gpkg': ('vector', 'GPKG'),
+                      }
+
+# head:   the first rows (features);
+# window: vector features in a window at the center of the layer's extent (tables fall back to head);
+# stride: every k-th row (feature), spread over the whole file.
+sample_methods = ['head', 'window', 'stride']
+
+
+def get_sample_path(path, sample_dir, max_rows, method='head'):
+    '''
+    The sample of a file is named by its path, modification time and size, so an edited file gets a new sample.
+    '''
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime}|{stat.st_size}|{max_rows}|{method}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    base_name = os.path.basename(path)
+    return os.path.join(sample_dir, f"{digest}_{base_name}")
+
+
+def sample_table(path, sample_path, max_rows, method='head'):
+    '''
+    Keep the header and max_rows lines as they are (separator, encoding, quoting).
+    Return False if the table is not longer than max_rows.
+    '''
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if method == 'stride':
+            line_cnt = sum(1 for _ in f)
+            if line_cnt <= max_rows:
+                return False
+            f.seek(0)
+            f.readline()
+            step = -(-line_cnt // max_rows)  # ceil
+            lines = [line for idx, line in enumerate(f) if idx % step == 0]
+        else:
+            lines = [line for _, line in zip(range(max_rows + 1), f)]
+            if len(lines) <= max_rows:
+                return False
+    with open(sample_path, 'wb') as f:
+        f.write(header)
+        f.writelines(lines[:max_rows])
+    return True
+
+
+def sample_vector(path, sample_path, driver, max_rows, method='head'):
+    '''
+    Return False if the layer has no more than max_rows features.
+    '''
+    info = pyogrio.read_info(path)
+    feature_cnt = info['features']
+    if 0 <= feature_cnt <= max_rows:
+        return False
+    if method == 'window':
+        xmin, ymin, xmax, ymax = info['total_bounds']
+        fraction = min(1.0, (max_rows / max(feature_cnt, 1)) ** 0.5)  # about max_rows features if evenly spread
+        cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+        half_width, half_height = (xmax - xmin) * fraction / 2, (ymax - ymin) * fraction / 2
+        gdf = gpd.read_file(path, bbox=(cx - half_width, cy - half_height, cx + half_width, cy + half_height))
+        gdf = gdf.head(max_rows)
+        if len(gdf) == 0:  # an empty center, e.g., a ring of features
+            gdf = gpd.read_file(path, rows=max_rows)
+    elif method == 'stride':
+        step = max(1, -(-feature_cnt // max_rows))
+        gdf = gpd.read_file(path).iloc[::step]
+    else:
+        gdf = gpd.read_file(path, rows=max_rows)
+    gdf.to_file(sample_path, driver=driver)
+    return True
+
+
+def sample_file(path, sample_dir, max_rows=200, method='head'):
+    '''
+    Write max_rows rows (or features) of a data file into sample_dir, in the same format; see sample_methods.
+    Return the path of the sample; the original path if the format is not supported, the file
+    is not larger than the sample, or it cannot be read.
+    '''
+    assert method in sample_methods, f"Unknown sample method: {method}, should be one of {sample_methods}"
+    ext = os.path.splitext(path)[1].lower()
+    if (ext not in sampleable_formats) or (not os.path.isfile(path)):
+        return path
+
+    sample_path = get_sample_path(path, sample_dir, max_rows, method=method)
+    if os.path.exists(sample_path):
+        return sample_path
+
+    kind, driver = sampleable_formats[ext]
+    os.makedirs(sample_dir, exist_ok=True)
+    try:
+        if kind == 'table':
+            is_sampled = sample_table(path, sample_path, max_rows, method=method)
+        else:
+            is_sampled = sample_vector(path, sample_path, driver, max_rows, method=method)
+    except Exception as e:
+        print(f"Cannot sample {path}, use the full data: {e}")
+        return path
+    return sample_path if is_sampled else path
+
+
+def get_data_path_literals(code):
+    '''
+    Return the string literals in the code that are paths of existing files in a sampleable format.
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+    paths = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and (len(node.value) < 1024):
+            if (os.path.splitext(node.value)[1].lower() in sampleable_formats) and os.path.isfile(node.value):
+                paths.append(node.value)
+    return list(dict.fromkeys(paths))
+
+
+def sample_inputs(paths, sample_dir, max_rows=200, method='head'):
+    '''
+    Sample the data files; return a dict: original path -> sample path.
+    '''
+    return {path: sample_file(path, sample_dir, max_rows=max_rows, method=method) for path in paths}
+
+
+def sample_code_inputs(code, sample_dir, max_rows=200, method='head', absolute=False):
+    '''
+    Return a copy of the code reading samples of its input files instead of the full data,
+    and the dict of original path -> sample path.
+    Only paths written as plain string literals in the code are replaced.
+    absolute: write the absolute paths of the inputs (sampled or not), so the code can run in another directory.
+    '''
+    path_map = sample_inputs(get_data_path_literals(code), sample_dir, max_rows=max_rows, method=method)
+    sampled_code = code
+    for path, sample_path in path_map.items():
+        if absolute:
+            sample_path = os.path.abspath(sample_path)
+        if sample_path == path:
+            continue
+        sample_path = sample_path.replace('\\', '/')
+        for quote in ["'", '"']:
+            sampled_code = sampled_code.replace(f"{quote}{path}{quote}", f"{quote}{sample_path}{quote}")
+    return sampled_code, path_map
+
+
+def format_geometry(geometry):
+    '''
+    A short text of a geometry: its type, vertex count and bounding box, instead of the full WKT.
+    '''
+    if (geometry is None) or geometry.is_empty:
+        return "EMPTY"
+    if geometry.geom_type == 'Point':
+        return f"Point({geometry.x:.10g} {geometry.y:.10g})"
+    bounds = ', '.join(f"{value:.10g}" for value in geometry.bounds)
+    return f"{geometry.geom_type}({shapely.get_num_coordinates(geometry)} vertices, bbox=[{bounds}])"
+
+
+def read_head(path, row_cnt=3, compact_geometry=True):
+    '''
+    Read only the first rows (features) of a data file, whatever its size.
+    Vector layers: the geometries are replaced by format_geometry() texts if compact_geometry.
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if sampleable_formats.get(ext, ('vector', None))[0] == 'table':
+        return pd.read_csv(path, nrows=row_cnt)
+    gdf = pyogrio.read_dataframe(path, max_features=row_cnt)
+    if (not compact_geometry) or (not isinstance(gdf, gpd.GeoDataFrame)):
+        return gdf
+    geometry_name = gdf.geometry.name
+    df = pd.DataFrame(gdf.drop(columns=geometry_name))
+    df[geometry_name] = [format_geometry(geometry) for geometry in gdf.geometry]
+    return df
+
+
+def get_sample_text(path, file_type="csv", row_cnt=3, encoding="utf-8"):
+    '''
+    The first rows of a data file as text, with all the columns.
+    file_type: "csv", "shp" (any vector format), or "txt" (the first lines as they are).
+    '''
+    if file_type == "txt":
+        with open(path, 'r', encoding=encoding) as f:
+            return ''.join(line for _, line in zip(range(row_cnt), f))
+    df = read_head(path, row_cnt=row_cnt)
+    return df.to_string(max_colwidth=100)
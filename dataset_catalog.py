@@ -0,0 +1,453 @@
+import os
+import re
+import json
+import threading
+import xml.etree.ElementTree as ET
+
+import pyogrio
+import numpy as np
+import pandas as pd
+
+import data_sampler
+
+
+# file extension -> kind; the catalog describes these files.
+catalog_formats = {'.csv': 'table',
+                   '.shp': 'vector',
+                   '.geojson': 'vector',
+                   '.gpkg': 'vector',
+                   }
+
+# files read by a shapefile reader besides the .shp
+shapefile_companions = ['.dbf', '.shx', '.prj', '.cpg']
+
+attribute_table_name = 'attribute_table.txt'
+
+# column names of coordinates in tables: the bounds of a table are computed from them.
+coordinate_columns = [('x', 'y'), ('lon', 'lat'), ('longitude', 'latitude')]
+
+sample_row_cnt = 3
+
+# entries of an index written with another version are recomputed.
+index_version = 2
+
+
+def to_key(path):
+    return os.path.normpath(path).replace('\\', '/')
+
+
+def get_signature(paths):
+    '''
+    Modification time and size of the files; the entry of a layer is recomputed when it changes.
+    '''
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append([to_key(path), stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            signature.append([to_key(path), None, None])
+    return signature
+
+
+def to_json_value(value):
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating,)):
+        return None if np.isnan(value) else round(float(value), 6)
+    if isinstance(value, (np.bool_,)):
+        return bool(value)
+    if isinstance(value, (pd.Timestamp,)):
+        return value.isoformat()
+    return value
+
+
+def get_column_stats(series):
+    '''
+    dtype, null rate, and value range (numbers) or distinct count and the most common values (others).
+    '''
+    stats = {'name': str(series.name),
+             'dtype': str(series.dtype),
+             'null_rate': round(float(series.isna().mean()), 4) if len(series) else 0.0,
+             }
+    values = series.dropna()
+    if len(values) == 0:
+        return stats
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        stats['min'] = to_json_value(values.min())
+        stats['max'] = to_json_value(values.max())
+        stats['zero_rate'] = round(float((values == 0).mean()), 4)
+    else:
+        values = values.astype(str)
+        stats['distinct'] = int(values.nunique())
+        stats['examples'] = [str(value)[:40] for value in values.value_counts().index[:3]]
+    return stats
+
+
+def parse_qmd(path):
+    '''
+    The useful parts of a QGIS metadata file: title, abstract, CRS and extent (if valid).
+    '''
+    metadata = {'metadata_file': to_key(path)}
+    try:
+        root = ET.parse(path).getroot()
+    except (ET.ParseError, OSError):
+        return metadata
+    for tag in ['title', 'abstract']:
+        text = (root.findtext(tag) or "").strip()
+        if text and not text.startswith('REQUIRED:'):  # the placeholders of an empty template
+            metadata[tag] = text
+    authid = (root.findtext('crs/spatialrefsys/authid') or "").strip()
+    if authid:
+        metadata['crs'] = authid
+    spatial = root.find('extent/spatial')
+    if spatial is not None:
+        try:
+            bounds = [float(spatial.get(key)) for key in ['minx', 'miny', 'maxx', 'maxy']]
+            if (bounds[0] <= bounds[2]) and (bounds[1] <= bounds[3]):  # an empty layer has min > max
+                metadata['bounds'] = bounds
+        except (TypeError, ValueError):
+            pass
+    return metadata
+
+
+def parse_attribute_table(path):
+    '''
+    Parse a text file of column descriptions: a layer name line, then "column = description" lines.
+    Return a dict: layer name -> {column: description}.
+    '''
+    tables = {}
+    current = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if '=' in line and current is not None:
+                column, description = line.split('=', 1)
+                tables[current][column.strip()] = description.strip()
+            elif '=' not in line:
+                current = line
+                tables[current] = {}
+    return tables
+
+
+def normalize_name(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def match_layer_name(file_name, names):
+    '''
+    Return the layer name (of an attribute table) that matches the file name, e.g., "AddressesPesaro"
+    for Addresses.csv and "Sections ISTAT2011" for SectionsISTAT.csv; None if none or several match.
+    '''
+    stem = normalize_name(os.path.splitext(file_name)[0])
+    matches = [name for name in names
+               if normalize_name(name) and ((stem in normalize_name(name)) or (normalize_name(name) in stem))]
+    return matches[0] if len(matches) == 1 else None
+
+
+def describe_vector(path):
+    info = pyogrio.read_info(path)
+    entry = {'kind': 'vector',
+             'crs': info.get('crs'),
+             'geometry_type': info.get('geometry_type'),
+             'feature_count': int(info.get('features', -1)),
+             'bounds': [to_json_value(value) for value in info['total_bounds']] if info.get('total_bounds') is not None else None,
+             'columns': [{'name': str(name), 'dtype': str(dtype)} for name, dtype in zip(info['fields'], info['dtypes'])],
+             }
+    if len(info['fields']):  # the attributes only (the .dbf of a shapefile)
+        df = pyogrio.read_dataframe(path, read_geometry=False)
+        entry['columns'] = [get_column_stats(df[column]) for column in df.columns]
+    entry['sample'] = data_sampler.get_sample_text(path, file_type='shp', row_cnt=sample_row_cnt)
+    return entry
+
+
+def describe_table(path):
+    df = pd.read_csv(path, low_memory=False)
+    entry = {'kind': 'table',
+             'crs': None,
+             'row_count': len(df),
+             'columns': [get_column_stats(df[column]) for column in df.columns],
+             'sample': df.head(sample_row_cnt).to_string(max_colwidth=100),
+             'bounds': None,
+             }
+    lower_columns = {str(column).lower(): column for column in df.columns}
+    for x_name, y_name in coordinate_columns:
+        if (x_name in lower_columns) and (y_name in lower_columns):
+            x, y = pd.to_numeric(df[lower_columns[x_name]], errors='coerce'), pd.to_numeric(df[lower_columns[y_name]], errors='coerce')
+            if x.notna().any() and y.notna().any():
+                entry['bounds'] = [to_json_value(x.min()), to_json_value(y.min()), to_json_value(x.max()), to_json_value(y.max())]
+                entry['coordinate_columns'] = [str(lower_columns[x_name]), str(lower_columns[y_name])]
+            break
+    return entry
+
+
+class DatasetCatalog():
+    """
+    An index of the data files under a directory: for each layer (shapefile, GeoJSON, GeoPackage, CSV),
+    the columns with their dtypes, null rates and value ranges, the CRS, bounds, feature (row) count,
+    and the descriptions found in the QGIS metadata (.qmd, same name) and attribute_table.txt files.
+
+    The index is kept in a JSON sidecar file (index_file, in the directory). scan() only recomputes
+    the layers whose files (or metadata files) changed since, by modification time and size,
+    so the prompts get accurate schemas without opening the data each time.
+    """
+    def __init__(self, root='Dataset', index_file='.catalog.json'):
+        self.root = root
+        self.index_path = os.path.join(root, index_file)
+        self.entries = {}  # path (with "/") -> entry
+        self._lock = threading.Lock()
+        self._scanned = False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == index_version:
+                self.entries = index.get('entries', {})
+        except (OSError, ValueError):
+            pass
+
+    def find_files(self):
+        '''
+        Return the data files and the metadata files under the root.
+        '''
+        data_files, qmd_files, attribute_tables = [], [], []
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            dir_names[:] = [name for name in dir_names if not name.startswith('.')]  # e.g., .ipynb_checkpoints
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                ext = os.path.splitext(file_name)[1].lower()
+                if ext in catalog_formats:
+                    data_files.append(path)
+                elif ext == '.qmd':
+                    qmd_files.append(path)
+                elif file_name == attribute_table_name:
+                    attribute_tables.append(path)
+        return data_files, qmd_files, attribute_tables
+
+    def get_metadata_files(self, path, qmd_files, attribute_tables):
+        stem = os.path.splitext(path)[0]
+        files = [qmd for qmd in qmd_files if os.path.splitext(qmd)[0] == stem]
+        files += [table for table in attribute_tables if os.path.dirname(table) == os.path.dirname(path)]
+        return files
+
+    def describe(self, path, metadata_files):
+        '''
+        Compute the entry of a data file.
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        try:
+            entry = describe_table(path) if catalog_formats[ext] == 'table' else describe_vector(path)
+        except Exception as e:
+            entry = {'kind': catalog_formats[ext], 'columns': [], 'error': f"{type(e).__name__}: {e}"}
+        descriptions = {}
+        for metadata_file in metadata_files:
+            if metadata_file.endswith('.qmd'):
+                metadata = parse_qmd(metadata_file)
+                for key in ['title', 'abstract', 'metadata_file']:
+                    if key in metadata:
+                        entry[key] = metadata[key]
+                if (not entry.get('crs')) and metadata.get('crs'):
+                    entry['crs'] = metadata['crs']
+                    entry['crs_source'] = to_key(metadata_file)
+            else:
+                tables = parse_attribute_table(metadata_file)
+                layer_name = match_layer_name(os.path.basename(path), list(tables))
+                if layer_name:
+                    entry['layer_name'] = layer_name
+                    descriptions = tables[layer_name]
+        for column in entry['columns']:
+            if column['name'] in descriptions:
+                column['description'] = descriptions[column['name']]
+        return entry
+
+    def scan(self, force=False):
+        '''
+        Update the index: recompute the changed layers, drop the removed ones, and save it if anything changed.
+        '''
+        with self._lock:
+            data_files, qmd_files, attribute_tables = self.find_files()
+            entries = {}
+            changed = False
+            for path in data_files:
+                key = to_key(path)
+                related_files = [path]
+                if path.lower().endswith('.shp'):
+                    related_files += [os.path.splitext(path)[0] + ext for ext in shapefile_companions]
+                metadata_files = self.get_metadata_files(path, qmd_files, attribute_tables)
+                signature = get_signature(related_files + metadata_files)
+                old_entry = self.entries.get(key)
+                if (not force) and old_entry and (old_entry.get('signature') == signature):
+                    entries[key] = old_entry
+                    continue
+                entry = self.describe(path, metadata_files)
+                entry['path'] = key
+                entry['signature'] = signature
+                entries[key] = entry
+                changed = True
+            changed = changed or (set(entries) != set(self.entries))
+            self.entries = entries
+            self._scanned = True
+            if changed:
+                self.save()
+        return self.entries
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': index_version, 'root': to_key(self.root), 'entries': self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Cannot save the dataset catalog at {self.index_path}: {e}")
+
+    def ensure_scanned(self):
+        if not self._scanned:
+            self.scan()
+
+    def get_entry(self, path, exact=False):
+        '''
+        Return the entry of a data file, or None. The path may have another prefix than the catalog's
+        (e.g., 'FB_world/Dati_Pesaro/edifici2005.shp'); then the entry sharing the longest tail is used,
+        unless exact is True.
+        '''
+        self.ensure_scanned()
+        key = to_key(path)
+        if key in self.entries:
+            return self.refresh(self.entries[key])
+        abs_path = os.path.abspath(path)
+        for entry_key, entry in self.entries.items():
+            if os.path.abspath(entry_key) == abs_path:
+                return self.refresh(entry)
+        if exact:
+            return None
+        parts = key.lower().split('/')
+        best_entries, best_score = [], 0
+        for entry_key, entry in self.entries.items():
+            entry_parts = entry_key.lower().split('/')
+            score = 0
+            while (score < min(len(parts), len(entry_parts))) and (parts[-1 - score] == entry_parts[-1 - score]):
+                score += 1
+            if score > best_score:
+                best_entries, best_score = [entry], score
+            elif score == best_score and score > 0:
+                best_entries.append(entry)
+        return self.refresh(best_entries[0]) if len(best_entries) == 1 else None
+
+    def is_fresh(self, entry):
+        return bool(entry) and all(item[1:] == get_signature([item[0]])[0][1:] for item in entry.get('signature', []))
+
+    def refresh(self, entry):
+        '''
+        Return the entry, recomputed (and saved) if its files changed since the scan; None if the data file is gone.
+        The catalog is scanned once per process, so this keeps a long session from serving old schemas.
+        '''
+        if (entry is None) or self.is_fresh(entry):
+            return entry
+        path = entry['path']
+        with self._lock:
+            if not os.path.isfile(path):
+                self.entries.pop(path, None)
+                self.save()
+                return None
+            related_files = [path]
+            if path.lower().endswith('.shp'):
+                related_files += [os.path.splitext(path)[0] + ext for ext in shapefile_companions]
+            candidates = [os.path.splitext(path)[0] + '.qmd', os.path.join(os.path.dirname(path), attribute_table_name)]
+            metadata_files = [file for file in candidates if os.path.isfile(file)]
+            new_entry = self.describe(path, metadata_files)
+            new_entry['path'] = path
+            new_entry['signature'] = get_signature(related_files + metadata_files)
+            self.entries[path] = new_entry
+            self.save()
+        return new_entry
+
+    def find_entries_in_text(self, text):
+        '''
+        Return the entries of the data files named in a text, e.g., the data locations of a task.
+        Files of the same name are told apart by the longest part of their path found in the text.
+        '''
+        self.ensure_scanned()
+        text = text.replace('\\', '/').lower()
+        found = {}  # file name -> (matched tail length, [entries])
+        for key, entry in list(self.entries.items()):
+            parts = key.lower().split('/')
+            if parts[-1] not in text:
+                continue
+            tail_len = max(idx for idx in range(1, len(parts) + 1) if '/'.join(parts[-idx:]) in text)
+            best_len, entries = found.get(parts[-1], (0, []))
+            if tail_len > best_len:
+                found[parts[-1]] = (tail_len, [entry])
+            elif tail_len == best_len:
+                entries.append(entry)
+        entries = [self.refresh(entry) for _, entries in found.values() for entry in entries]
+        return [entry for entry in entries if entry is not None]
+
+    @staticmethod
+    def get_entry_text(entry, max_columns=40, brief=False):
+        '''
+        A compact description of a layer for prompts; brief: the column names only.
+        '''
+        kind = entry['kind']
+        lines = [f"{entry['path']}: {kind}"]
+        if entry.get('error'):
+            lines[0] += f" (cannot be read: {entry['error']})"
+        details = []
+        if kind == 'vector':
+            if entry.get('geometry_type'):
+                details.append(f"geometry: {entry['geometry_type']}")
+            if entry.get('feature_count', -1) >= 0:
+                details.append(f"{entry['feature_count']} features")
+        elif 'row_count' in entry:
+            details.append(f"{entry['row_count']} rows")
+        if entry.get('crs'):
+            source = f" (from {os.path.basename(entry['crs_source'])})" if entry.get('crs_source') else ""
+            details.append(f"CRS: {entry['crs']}{source}")
+        if entry.get('bounds'):
+            bounds = ', '.join(f"{value:.6g}" if isinstance(value, float) else str(value) for value in entry['bounds'])
+            columns = f" of {'/'.join(entry['coordinate_columns'])}" if entry.get('coordinate_columns') else ""
+            details.append(f"bounds{columns}: [{bounds}]")
+        if details:
+            lines[0] += "; " + "; ".join(details)
+        if brief:
+            if entry['columns']:
+                lines.append("  Columns: " + ', '.join(column['name'] for column in entry['columns']))
+            return '\n'.join(lines)
+        if entry.get('title'):
+            lines.append(f"  Title: {entry['title']}")
+        if entry['columns']:
+            lines.append("  Columns:")
+        for column in entry['columns'][:max_columns]:
+            column_str = f"  - {column['name']} ({column['dtype']}"
+            if column.get('null_rate'):
+                column_str += f", {column['null_rate']:.0%} null"
+            if 'min' in column:
+                column_str += f", {column['min']} to {column['max']}"
+            if column.get('zero_rate'):
+                column_str += f", {column['zero_rate']:.0%} zero"
+            if 'distinct' in column:
+                examples = ', '.join(repr(example) for example in column['examples'])
+                column_str += f", {column['distinct']} distinct, e.g., {examples}"
+            column_str += ")"
+            if column.get('description'):
+                column_str += f": {column['description']}"
+            lines.append(column_str)
+        if len(entry['columns']) > max_columns:
+            lines.append(f"  ... and {len(entry['columns']) - max_columns} more columns")
+        return '\n'.join(lines)
+
+    def get_text(self, data_locations_text, brief=False):
+        '''
+        The descriptions of the data files named in the data locations; "" if none is in the catalog.
+        '''
+        return '\n'.join(self.get_entry_text(entry, brief=brief) for entry in self.find_entries_in_text(data_locations_text))
+
+
+_default_catalog = None
+
+
+def get_default_catalog(root='Dataset', index_file='.catalog.json'):
+    global _default_catalog
+    if (_default_catalog is None) or (_default_catalog.root != root):
+        _default_catalog = DatasetCatalog(root=root, index_file=index_file)
+    return _default_catalog
@@ -0,0 +1,515 @@
+import os
+import io
+import sys
+import time
+import pickle
+import signal
+import builtins
+import threading
+import traceback
+import warnings
+import importlib
+import subprocess
+import contextlib
+from collections import deque
+
+import checkpoint_exec
+import geo_readers
+import columnar_cache
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+
+# imported by every worker before it takes a job; matplotlib is switched to the Agg backend first.
+default_preload_modules = ['numpy', 'pandas', 'geopandas', 'shapely', 'matplotlib.pyplot']
+
+code_filename = 'Complete program'
+
+
+def get_error_info(exc, code, filename=code_filename):
+    '''
+    Structured information of an exception raised by the code: error_type, message, lineno (of the code), traceback.
+    The source lines of the code are filled into the traceback text.
+    '''
+    code_lines = code.splitlines()
+    frames = traceback.extract_tb(exc.__traceback__)
+    frames = [frame for frame in frames if frame.filename != __file__]  # drop the worker's own frames
+    lineno = None
+    filled_frames = []
+    for frame in frames:
+        line = frame.line
+        if frame.filename == filename and frame.lineno and (frame.lineno <= len(code_lines)):
+            line = code_lines[frame.lineno - 1].strip()
+            lineno = frame.lineno
+        filled_frames.append((frame.filename, frame.lineno, frame.name, line))
+    if isinstance(exc, SyntaxError) and (exc.filename == filename):
+        lineno = exc.lineno
+
+    traceback_str = 'Traceback (most recent call last):\n'
+    traceback_str += ''.join(traceback.format_list(filled_frames))
+    traceback_str += ''.join(traceback.format_exception_only(type(exc), exc))
+    return {'error_type': type(exc).__name__,
+            'message': str(exc),
+            'lineno': lineno,
+            'traceback': traceback_str,
+            }
+
+
+def snapshot_files(dirs):
+    files = {}
+    for directory in dirs:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    files[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+    return files
+
+
+class WarningRecorder():
+    """
+    Record the warnings shown while the program runs (e.g., a CRS mismatch), with the line of the
+    program causing them: the innermost frame of the program, not the line in the library.
+    The warnings are still printed to stderr.
+    """
+    max_warnings = 20
+
+    def __init__(self, filename=code_filename):
+        self.filename = filename
+        self.warnings = []  # [{'category': ..., 'message': ..., 'lineno': ...}]
+        self._original = None
+
+    def showwarning(self, message, category, filename, lineno, file=None, line=None):
+        frame = sys._getframe(1)
+        while (frame is not None) and (frame.f_code.co_filename != self.filename):
+            frame = frame.f_back
+        if len(self.warnings) < self.max_warnings:
+            self.warnings.append({'category': category.__name__,
+                                  'message': str(message),
+                                  'lineno': frame.f_lineno if frame is not None else None})
+        self._original(message, category, filename, lineno, file, line)
+
+    def __enter__(self):
+        self._original = warnings.showwarning
+        warnings.showwarning = self.showwarning
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        warnings.showwarning = self._original
+        return False
+
+
+class ResourceLimits():
+    """
+    Limits of a run inside the worker, raising an exception in the program's own frame,
+    so the error carries the line that was running:
+    wall-clock time (SIGALRM -> TimeoutError), CPU time (RLIMIT_CPU, SIGXCPU -> TimeoutError),
+    and resident memory (a watchdog thread checking the peak RSS, SIGUSR1 -> MemoryError).
+    Unavailable on Windows; the pool still kills a worker running past the timeout.
+    """
+    check_interval_sec = 0.2
+
+    def __init__(self, timeout=None, cpu_limit_sec=None, memory_limit_mb=None):
+        self.timeout = timeout
+        self.cpu_limit_sec = cpu_limit_sec
+        self.memory_limit_mb = memory_limit_mb
+        self.exceeded = None  # 'wall_time', 'cpu_time' or 'memory'
+        self.peak_rss_mb = None
+        self._stop = threading.Event()
+        self._old_cpu_limit = None
+
+    @staticmethod
+    def get_peak_rss_mb():
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024  # bytes on macOS, KB on Linux
+
+    def _raise(self, kind, exception):
+        self.exceeded = kind
+        raise exception
+
+    def _on_alarm(self, signum, frame):
+        self._raise('wall_time', TimeoutError(f"The program timed out after {self.timeout} seconds"))
+
+    def _on_cpu_limit(self, signum, frame):
+        self._raise('cpu_time', TimeoutError(f"The program used more than {self.cpu_limit_sec} seconds of CPU time"))
+
+    def _on_memory_limit(self, signum, frame):
+        self._raise('memory', MemoryError(f"The program exceeded {self.memory_limit_mb / 1024:.1f} GB of memory "
+                                          f"(peak resident memory: {self.peak_rss_mb / 1024:.1f} GB)"))
+
+    def _watch_memory(self):
+        while not self._stop.wait(self.check_interval_sec):
+            self.peak_rss_mb = self.get_peak_rss_mb()
+            if self.peak_rss_mb > self.memory_limit_mb:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                self._stop.wait(1)  # let the program handle it; raise again if it keeps running
+
+    def __enter__(self):
+        if resource is None:
+            return self
+        if self.timeout:
+            signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        if self.cpu_limit_sec:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self._old_cpu_limit = resource.getrlimit(resource.RLIMIT_CPU)
+            soft_limit = int(usage.ru_utime + usage.ru_stime + self.cpu_limit_sec) + 1  # the preloading counts too
+            hard_limit = self._old_cpu_limit[1]
+            if hard_limit != resource.RLIM_INFINITY:
+                soft_limit = min(soft_limit, hard_limit)
+            signal.signal(signal.SIGXCPU, self._on_cpu_limit)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, hard_limit))
+        if self.memory_limit_mb:
+            signal.signal(signal.SIGUSR1, self._on_memory_limit)
+            threading.Thread(target=self._watch_memory, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if resource is None:
+            return False
+        if self.timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if self._old_cpu_limit is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, self._old_cpu_limit)
+        if self.memory_limit_mb:
+            self.peak_rss_mb = self.get_peak_rss_mb()
+        return False
+
+
+def run_job(job):
+    '''
+    Run the code of a job in a fresh namespace; return the structured result.
+    '''
+    code = job['code']
+    watch_dirs = [d for d in job.get('watch_dirs', []) if os.path.isdir(d)]
+    files_before = snapshot_files(watch_dirs)
+    stdout = io.StringIO()
+    result = {'ok': True, 'error_type': None, 'message': None, 'lineno': None, 'traceback': None}
+    start_time = time.perf_counter()
+    namespace = {'__name__': '__main__', '__builtins__': builtins}
+    namespace.update(job.get('variables') or {})
+    checkpoint_info = {}
+    limits = ResourceLimits(timeout=job.get('timeout'),
+                            cpu_limit_sec=job.get('cpu_limit_sec'),
+                            memory_limit_mb=job.get('memory_limit_mb'))
+    warning_recorder = WarningRecorder()
+    try:
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+        with contextlib.redirect_stdout(stdout), limits, warning_recorder:
+            if job.get('checkpoint_dir'):
+                checkpoint_exec.run_with_checkpoints(code,
+                                                     namespace,
+                                                     job['checkpoint_dir'],
+                                                     min_step_sec=job.get('checkpoint_min_step_sec', 1.0),
+                                                     salt=os.getcwd(),
+                                                     info=checkpoint_info)
+            else:
+                exec(compile(code, code_filename, 'exec'), namespace)
+    except BaseException as exc:  # SystemExit and KeyboardInterrupt are failures of the program as well
+        result['ok'] = isinstance(exc, SystemExit) and (exc.code in (0, None))
+        if not result['ok']:
+            result.update(get_error_info(exc, code))
+    if limits.exceeded and result['ok']:  # the program caught the exception and went on
+        result.update({'ok': False,
+                       'error_type': 'MemoryError' if limits.exceeded == 'memory' else 'TimeoutError',
+                       'message': f"The program exceeded its {limits.exceeded.replace('_', ' ')} limit "
+                                  f"and caught the exception.",
+                       'traceback': None,
+                       })
+    if limits.exceeded:
+        result['limit'] = limits.exceeded
+        if result['lineno'] is not None:  # e.g., "timed out after 120 seconds in line 42: ..."
+            line = code.splitlines()[result['lineno'] - 1].strip()
+            result['message'] = f"{result['message']} in line {result['lineno']}: {line}"
+    result['peak_rss_mb'] = limits.peak_rss_mb
+    result['warnings'] = warning_recorder.warnings
+    result.update(checkpoint_info)
+    result['seconds'] = time.perf_counter() - start_time
+    result['stdout'] = stdout.getvalue()
+    files_after = snapshot_files(watch_dirs)
+    checkpoint_dir = job.get('checkpoint_dir') or None
+    result['files'] = sorted(path for path, mtime in files_after.items()
+                             if (files_before.get(path) != mtime) and not (checkpoint_dir and path.startswith(checkpoint_dir)))
+    return result
+
+
+def worker_main():
+    '''
+    The worker process: preload the modules, then run one job read from stdin and write the result.
+    While waiting for the job, it reads the data files used by the previous jobs ("prefetch" messages)
+    into the memoized readers, so the program gets them without parsing; see geo_readers.
+    The results go through a copy of the original stdout; the program's own output to file
+    descriptor 1 (e.g., from GDAL) is sent to stderr so it cannot break the protocol.
+    '''
+    result_file = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    job_file = sys.stdin.buffer
+
+    setup = pickle.load(job_file)
+    os.environ['MPLBACKEND'] = 'Agg'  # plt.show() must not block
+    for module_name in setup['modules']:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+    if setup.get('mirror_dir'):  # under the memoized readers: a cache miss loads the mirror
+        columnar_cache.ColumnarReaders(setup['mirror_dir']).install()
+    readers = None
+    if setup.get('reader_cache_mb'):
+        readers = geo_readers.MemoizedReaders(max_memory_mb=setup['reader_cache_mb'])
+        readers.install()
+        readers.prefetch(setup.get('prefetch', []))
+
+    while True:
+        try:
+            job = pickle.load(job_file)
+        except EOFError:
+            break
+        if job.get('type') == 'prefetch':
+            if readers is not None:
+                readers.prefetch(job['reads'])
+            continue
+        try:
+            read_cnt = len(readers.reads) if readers is not None else 0
+            result = run_job(job)
+            if readers is not None:
+                result['reads'] = readers.reads[read_cnt:]
+                result['reader_cache_hits'] = readers.hits
+        except BaseException as exc:
+            result = {'ok': False, 'stdout': '', 'files': [], 'seconds': 0.0, **get_error_info(exc, job.get('code', ''))}
+        try:
+            pickle.dumps(result)
+        except Exception:  # e.g., an exception message that cannot be pickled
+            result = {key: (str(value) if key == 'message' else value) for key, value in result.items()}
+        pickle.dump(result, result_file)
+        result_file.flush()
+        if job.get('recycle', True):
+            break
+
+
+class ExecPool():
+    """
+    A pool of warm worker processes for running generated programs.
+
+    Each worker is a separate Python process that has already imported pandas, geopandas, shapely
+    and matplotlib (Agg backend), so a run does not pay the import time. A worker runs one job and
+    exits, so no state leaks into the next run; a replacement is started in the background right away.
+    run() returns a dict: ok, stdout, traceback, error_type, message, lineno (in the code), files (created
+    or modified in the watched directories), seconds.
+
+    size: number of warm workers kept idle.
+    reader_cache_mb: memory cap of the memoized gpd.read_file()/pd.read_csv() in each worker (0: no memoizing).
+                     The idle workers prefetch the files read by the recent jobs, so a debug trial
+                     (or the next task on the same data) does not parse them again.
+    mirror_dir: gpd.read_file()/pd.read_csv() load GeoParquet/Feather mirrors of the data files kept
+                in this directory (see columnar_cache.py); None reads the files themselves.
+    """
+    # number of recent data reads the new workers prefetch
+    max_prefetch_reads = 20
+
+    def __init__(self, size=2, preload_modules=None, reader_cache_mb=1024, mirror_dir=None):
+        self.size = size
+        self.preload_modules = default_preload_modules if preload_modules is None else preload_modules
+        self.reader_cache_mb = reader_cache_mb
+        self.mirror_dir = os.path.abspath(mirror_dir) if mirror_dir else None  # the jobs change the directory
+        self._recent_reads = []
+        self._idle_workers = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(self.size):
+            self._idle_workers.append(self._start_worker())
+
+    def _start_worker(self):
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   )
+        pickle.dump({'modules': self.preload_modules,
+                     'reader_cache_mb': self.reader_cache_mb,
+                     'mirror_dir': self.mirror_dir,
+                     'prefetch': list(self._recent_reads),
+                     }, process.stdin)
+        process.stdin.flush()
+        return process
+
+    def _add_recent_reads(self, reads):
+        '''
+        Remember the data read by a job, and let the idle workers prefetch it.
+        '''
+        new_reads = [read for read in reads if read not in self._recent_reads]
+        if not new_reads:
+            return
+        with self._lock:
+            self._recent_reads = (self._recent_reads + new_reads)[-self.max_prefetch_reads:]
+            for process in self._idle_workers:
+                try:
+                    pickle.dump({'type': 'prefetch', 'reads': new_reads}, process.stdin)
+                    process.stdin.flush()
+                except OSError:
+                    pass
+
+    def _take_worker(self):
+        with self._lock:
+            while self._idle_workers:
+                process = self._idle_workers.popleft()
+                if process.poll() is None:
+                    break
+            else:
+                process = self._start_worker()  # cold start, all workers are busy
+        return process
+
+    def _refill(self):
+        with self._lock:
+            while (not self._closed) and (len(self._idle_workers) < self.size):
+                self._idle_workers.append(self._start_worker())
+
+    # seconds the pool waits past the timeout for the worker to report it, before killing the worker.
+    kill_grace_sec = 10
+
+    def run(self, code, cwd=None, timeout=None, watch_dirs=(), checkpoint_dir=None, checkpoint_min_step_sec=1.0,
+            cpu_limit_sec=None, memory_limit_mb=None, variables=None):
+        '''
+        Run the code in a warm worker and return the structured result.
+        cwd: the working directory of the run; None uses the current directory.
+        variables: a dict of (picklable) global variables defined before the code runs.
+        timeout, cpu_limit_sec, memory_limit_mb: limits of wall-clock time, CPU time and resident memory
+                 (None: no limit). A violation is a TimeoutError or MemoryError at the running line,
+                 and result['limit'] is 'wall_time', 'cpu_time' or 'memory'; see ResourceLimits.
+        watch_dirs: directories whose new or modified files are reported in result['files'].
+        checkpoint_dir: run statement by statement, saving the variables after the slow statements,
+                        and resume from the checkpoint of an unchanged prefix; see checkpoint_exec.
+                        The result then has 'steps', 'resumed_from' and 'checkpoints'.
+        '''
+        if self._closed:
+            raise RuntimeError("The ExecPool is closed.")
+        process = self._take_worker()
+        threading.Thread(target=self._refill, daemon=True).start()
+
+        job = {'code': code,
+               'cwd': os.path.abspath(cwd or os.getcwd()),
+               'watch_dirs': [os.path.abspath(d) for d in watch_dirs],
+               'checkpoint_dir': os.path.abspath(checkpoint_dir) if checkpoint_dir else None,
+               'checkpoint_min_step_sec': checkpoint_min_step_sec,
+               'timeout': timeout,
+               'cpu_limit_sec': cpu_limit_sec,
+               'memory_limit_mb': memory_limit_mb,
+               'variables': variables,
+               }
+        start_time = time.perf_counter()
+        reply = {}
+
+        def read_result():
+            try:
+                pickle.dump(job, process.stdin)
+                process.stdin.flush()
+                reply['result'] = pickle.load(process.stdout)
+            except (EOFError, OSError, pickle.UnpicklingError) as e:
+                reply['error'] = e
+
+        reader = threading.Thread(target=read_result, daemon=True)
+        reader.start()
+        reader.join(timeout + self.kill_grace_sec if timeout else None)
+        if reader.is_alive():  # timed out, and the worker could not report it (e.g., stuck in a C extension)
+            process.kill()
+            reader.join()
+            result = {'ok': False,
+                      'error_type': 'TimeoutError',
+                      'message': f"The program did not finish within {timeout} seconds.",
+                      'lineno': None,
+                      'traceback': f"TimeoutError: the program did not finish within {timeout} seconds.\n",
+                      'stdout': '',
+                      'files': [],
+                      'limit': 'wall_time',
+                      }
+        elif 'result' in reply:
+            result = reply['result']
+        else:  # the worker died, e.g., a segmentation fault in a C extension
+            process.wait()
+            killed = (process.returncode == -getattr(signal, 'SIGKILL', 9))
+            result = {'ok': False,
+                      'error_type': 'WorkerCrashed',
+                      'message': f"The worker process exited with code {process.returncode}"
+                                 f"{' (killed, probably out of memory)' if killed else ''}.",
+                      'lineno': None,
+                      'traceback': f"WorkerCrashed: the worker process exited with code {process.returncode}.\n",
+                      'stdout': '',
+                      'files': [],
+                      }
+        self._close_worker(process)
+        self._add_recent_reads(result.get('reads', []))
+        result['seconds'] = time.perf_counter() - start_time
+        return result
+
+    @staticmethod
+    def _close_worker(process):
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._idle_workers)
+            self._idle_workers.clear()
+        for process in workers:
+            self._close_worker(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool(size=2, reader_cache_mb=1024, mirror_dir=None):
+    '''
+    The shared pool, started on first use.
+    '''
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ExecPool(size=size, reader_cache_mb=reader_cache_mb, mirror_dir=mirror_dir)
+    return _default_pool
+
+
+def format_result(result):
+    '''
+    The error information of a failed run, as given to the LLM for debugging.
+    '''
+    if result['ok']:
+        return ""
+    text = result['traceback'] or f"{result['error_type']}: {result['message']}\n"
+    if result.get('limit'):
+        text += f"{result['message']}\n"
+    elif result['lineno'] is not None:
+        text += f"(The error occurred at line {result['lineno']} of the program.)\n"
+    if result.get('warnings'):
+        text += "Warnings before the error:\n"
+        for warning in result['warnings']:
+            location = f"line {warning['lineno']}: " if warning['lineno'] else ""
+            text += f"{location}{warning['category']}: {warning['message']}\n"
+    return text
+
+
+if __name__ == '__main__':
+    if '--worker' in sys.argv:
+        worker_main()
@@ -0,0 +1,105 @@
+import re
+import time
+import sqlite3
+import difflib
+import hashlib
+import threading
+import contextlib
+
+
+def normalize_message(message):
+    '''
+    Drop the parts of an error message that change from run to run: paths (keep the file name),
+    numbers, memory addresses, and extra spaces.
+    '''
+    message = message or ""
+    message = re.sub(r"0x[0-9a-fA-F]+", "<addr>", message)
+    message = re.sub(r"(?:[A-Za-z]:)?(?:[^\\/\s'\"()\[\]<>,]*[\\/])+([^\\/\s'\"()\[\]<>,]+)", r"\1", message)  # a/b/c.shp -> c.shp
+    message = re.sub(r"\b\d+(?:\.\d+)?\b", "<n>", message)
+    message = re.sub(r"\s+", " ", message).strip()
+    return message[:500]
+
+
+def get_fingerprint(result):
+    '''
+    The fingerprint of a failed run (see exec_pool.ExecPool.run()): the error type and the normalized
+    message. The line numbers and code are not part of it, so the same error is recognized in
+    other programs as well; a stored fix only applies where its context lines match.
+    '''
+    text = f"{result['error_type']}|{normalize_message(result['message'])}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def make_diff(code_before, code_after):
+    return '\n'.join(difflib.unified_diff(code_before.splitlines(), code_after.splitlines(),
+                                          fromfile='before', tofile='after', n=2, lineterm=''))
+
+
+class FixMemory():
+    """
+    SQLite store of the fixes of errors: the fingerprint of an error (see get_fingerprint())
+    and the unified diff of the code change after which the error was gone.
+    The same fix found again increases its success count; lookup() returns the most successful first.
+    """
+    def __init__(self, db_path='fix_memory.sqlite'):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS fixes (
+                                fingerprint TEXT NOT NULL,
+                                error_type TEXT,
+                                message TEXT,
+                                diff TEXT NOT NULL,
+                                success_cnt INTEGER NOT NULL DEFAULT 1,
+                                created REAL,
+                                last_used REAL,
+                                PRIMARY KEY (fingerprint, diff))""")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''
+        A connection committing on success, closed at the end.
+        '''
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, result, code_before, code_after):
+        '''
+        Store the change from code_before to code_after as a fix of the error of the failed run result.
+        '''
+        diff = make_diff(code_before, code_after)
+        if not diff:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("""INSERT INTO fixes (fingerprint, error_type, message, diff, success_cnt, created, last_used)
+                            VALUES (?, ?, ?, ?, 1, ?, ?)
+                            ON CONFLICT (fingerprint, diff) DO UPDATE SET success_cnt = success_cnt + 1, last_used = ?""",
+                         (get_fingerprint(result), result['error_type'], normalize_message(result['message']),
+                          diff, now, now, now))
+
+    def lookup(self, result, limit=3):
+        '''
+        Return the diffs that fixed the same error before, the most successful first.
+        '''
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("""SELECT diff FROM fixes WHERE fingerprint = ?
+                                   ORDER BY success_cnt DESC, last_used DESC LIMIT ?""",
+                                (get_fingerprint(result), limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_hint(self, result):
+        '''
+        The known fixes as a text for the debug prompt; "" if none.
+        '''
+        diffs = self.lookup(result)
+        if not diffs:
+            return ""
+        hint = "The same error was fixed before in a similar program by the change(s) below; adapt them if they fit:\n"
+        for diff in diffs:
+            hint += f"```diff\n{diff}\n```\n"
+        return hint
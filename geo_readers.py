@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import geopandas as gpd
+
+import columnar_cache
+
+
+# (module, function name) patched by MemoizedReaders.install().
+memoized_functions = [(gpd, 'read_file'), (pd, 'read_csv')]
+
+# pandas >= 3.0 always uses Copy-on-Write (and deprecates the option).
+copy_on_write = (int(pd.__version__.split('.')[0]) >= 3) or (pd.options.mode.copy_on_write is True)
+
+
+def get_nbytes(df):
+    try:
+        return int(df.memory_usage(deep=True).sum())
+    except Exception:
+        return 0
+
+
+class MemoizedReaders():
+    """
+    Memoized gpd.read_file() and pd.read_csv(): a call with the same path (same modification time
+    and size) and the same arguments returns a copy of the cached DataFrame instead of parsing the file again.
+    With pandas Copy-on-Write (always on in pandas >= 3.0) the copies are shallow and cost nothing
+    until they are modified; otherwise they are deep copies.
+    The least recently used entries are evicted when the cache grows over max_memory_mb.
+
+    Only calls with a path of an existing local file are cached; file objects, URLs and
+    unhashable arguments go straight to the original reader.
+    Every cached call is recorded in self.reads, so a new process can prefetch the same data.
+    """
+    def __init__(self, max_memory_mb=1024):
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self._cache = OrderedDict()  # key -> (DataFrame, nbytes)
+        self._lock = threading.Lock()
+        self._originals = {}
+        self.reads = []  # [{'func': ..., 'path': ..., 'args': ..., 'kwargs': ...}]
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def memory_bytes(self):
+        return sum(nbytes for _, nbytes in self._cache.values())
+
+    @staticmethod
+    def make_key(func_name, path, args, kwargs):
+        '''
+        The files of a shapefile (.dbf, .prj, .cpg, ...) are part of the signature; lists
+        (e.g., columns, usecols) become tuples.
+        '''
+        signature = tuple((stat.st_mtime_ns, stat.st_size) for stat in
+                          [os.stat(file) for file in columnar_cache.get_source_files(path) if os.path.exists(file)])
+
+        def to_hashable(value):
+            return tuple(value) if isinstance(value, list) else value
+        args = tuple(to_hashable(value) for value in args)
+        kwargs = tuple(sorted((name, to_hashable(value)) for name, value in kwargs.items()))
+        key = (func_name, os.path.abspath(path), signature, args, kwargs)
+        hash(key)  # raises TypeError for other unhashable arguments, e.g., a dict of dtypes
+        return key
+
+    @staticmethod
+    def get_copy(df):
+        return df.copy(deep=not copy_on_write)
+
+    def read(self, func_name, original, filename, *args, **kwargs):
+        if not (isinstance(filename, (str, os.PathLike)) and os.path.isfile(filename)):
+            return original(filename, *args, **kwargs)
+        try:
+            key = self.make_key(func_name, os.fspath(filename), args, kwargs)
+        except TypeError:
+            return original(filename, *args, **kwargs)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self.get_copy(cached[0])
+
+        df = original(filename, *args, **kwargs)
+        self.misses += 1
+        nbytes = get_nbytes(df)
+        if nbytes <= self.max_memory_bytes:
+            with self._lock:
+                self._cache[key] = (df, nbytes)
+                self.reads.append({'func': func_name, 'path': os.path.abspath(filename), 'args': args, 'kwargs': kwargs})
+                self.evict()
+        return self.get_copy(df)
+
+    def evict(self):
+        total = self.memory_bytes
+        while (total > self.max_memory_bytes) and self._cache:
+            _, (_, nbytes) = self._cache.popitem(last=False)
+            total -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def install(self):
+        '''
+        Replace gpd.read_file() and pd.read_csv() by the memoized versions.
+        '''
+        for module, func_name in memoized_functions:
+            if (module.__name__, func_name) in self._originals:
+                continue
+            original = getattr(module, func_name)
+            self._originals[(module.__name__, func_name)] = original
+
+            def reader(filename, *args, _func_name=func_name, _original=original, **kwargs):
+                return self.read(_func_name, _original, filename, *args, **kwargs)
+            reader.__doc__ = original.__doc__
+            reader.__name__ = func_name
+            setattr(module, func_name, reader)
+
+    def uninstall(self):
+        for module, func_name in memoized_functions:
+            original = self._originals.pop((module.__name__, func_name), None)
+            if original is not None:
+                setattr(module, func_name, original)
+
+    def prefetch(self, reads):
+        '''
+        Read the files of the given records (see self.reads) into the cache, skipping the failures.
+        '''
+        originals = {func_name: self._originals.get((module.__name__, func_name), getattr(module, func_name))
+                     for module, func_name in memoized_functions}
+        for read in reads:
+            try:
+                self.read(read['func'], originals[read['func']], read['path'], *read['args'], **read['kwargs'])
+            except Exception:
+                continue
@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+import geopandas as gpd
+import pyogrio
+import shapely
+
+import spatial_index
+
+try:
+    import pyarrow  # the pyramids are saved as Parquet files
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# the sidecar of a layer: <layer file>.pyramid.parquet, next to the data.
+sidecar_suffix = '.pyramid.parquet'
+
+# the simplification tolerances of the levels, as fractions of the layer's larger side, from the finest
+# to the coarsest: for the Pesaro layers (about 20 km) from 0.3 m to 40 m.
+level_fractions = [2.0 ** -k for k in range(16, 8, -1)]
+
+# the simplification error allowed, in pixels of the output; less than a pixel is not visible.
+max_error_px = 0.5
+
+# the part of the figure taken by the map axes when the axes are not given.
+default_axes_fraction = 0.8
+
+pyramid_version = 1
+
+
+def simplify_level(geometries, tolerance, coverage=False):
+    '''
+    Topology-preserving simplification: the shared edges of a polygon coverage (e.g., neighborhoods)
+    are simplified once, so no gaps or overlaps appear; other geometries stay valid each.
+    '''
+    if coverage:
+        return shapely.coverage_simplify(geometries, tolerance)
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def is_coverage(geometries):
+    types = shapely.get_type_id(geometries[~shapely.is_missing(geometries)])
+    if not len(types) or not np.isin(types, [3, 6]).all():  # Polygon, MultiPolygon
+        return False
+    try:
+        return bool(shapely.coverage_is_valid(geometries))
+    except Exception:  # GEOS < 3.12
+        return False
+
+
+class GeometryPyramid():
+    """
+    Simplified copies of the geometries of a layer at several tolerances (levels), saved next to the
+    layer and rebuilt when it changes. A map draws the coarsest level whose error stays under
+    half a pixel of the output (see choose_level()), so a city-wide map of thousands of buildings
+    or roads draws a fraction of the vertices, without visible difference.
+    Point layers have no levels.
+    """
+    def __init__(self, path, tolerances, levels, crs=None, bounds=None, vertex_counts=None):
+        self.path = path
+        self.tolerances = tolerances  # the largest distance of each level to the original geometries
+        self.levels = levels  # level -> array of geometries, or None if not loaded yet
+        self.crs = crs
+        self.bounds = bounds
+        self.vertex_counts = vertex_counts or []
+
+    @classmethod
+    def build(cls, path):
+        gdf = pyogrio.read_dataframe(path, columns=[])
+        geometries = np.asarray(gdf.geometry.values)
+        bounds = [float(value) for value in gdf.total_bounds]
+        types = shapely.get_type_id(geometries[~shapely.is_missing(geometries)])
+        tolerances, levels = [], {}
+        if len(types) and not np.isin(types, [0, 4]).all():  # Point, MultiPoint
+            span = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+            coverage = is_coverage(geometries)
+            previous, error = geometries, 0.0
+            for level, fraction in enumerate(level_fractions):
+                # each level is simplified from the previous one (much faster); the errors add up
+                previous = simplify_level(previous, span * fraction, coverage=coverage)
+                error += span * fraction
+                tolerances.append(error)
+                levels[level] = previous
+        vertex_counts = [int(shapely.get_num_coordinates(geometries).sum())]
+        vertex_counts += [int(shapely.get_num_coordinates(levels[level]).sum()) for level in range(len(tolerances))]
+        return cls(path, tolerances, levels, crs=gdf.crs.to_string() if gdf.crs is not None else None,
+                   bounds=bounds, vertex_counts=vertex_counts)
+
+    def save(self, sidecar_path, signature=""):
+        metadata = {'version': pyramid_version, 'signature': signature, 'tolerances': self.tolerances,
+                    'crs': self.crs, 'bounds': self.bounds, 'vertex_counts': self.vertex_counts}
+        columns = {f"level_{level}": shapely.to_wkb(self.levels[level]) for level in range(len(self.tolerances))}
+        if not columns:
+            columns = {'level_none': np.array([], dtype=object)}
+        table = pyarrow.table({name: pyarrow.array(values, type=pyarrow.binary()) for name, values in columns.items()})
+        table = table.replace_schema_metadata({'geometry_pyramid': json.dumps(metadata)})
+        tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+        pyarrow.parquet.write_table(table, tmp_path)
+        os.replace(tmp_path, sidecar_path)
+
+    @classmethod
+    def load(cls, path, sidecar_path, signature=None):
+        '''
+        Return the saved pyramid (the levels are read when used), or None if missing or outdated.
+        '''
+        try:
+            schema = pyarrow.parquet.read_schema(sidecar_path)
+            metadata = json.loads(schema.metadata[b'geometry_pyramid'])
+        except (OSError, KeyError, ValueError, TypeError, pyarrow.ArrowException):
+            return None
+        if (metadata.get('version') != pyramid_version) or ((signature is not None) and (metadata.get('signature') != signature)):
+            return None
+        pyramid = cls(path, metadata['tolerances'], {}, crs=metadata['crs'], bounds=metadata['bounds'],
+                      vertex_counts=metadata['vertex_counts'])
+        pyramid.sidecar_path = sidecar_path
+        return pyramid
+
+    def get_level(self, level):
+        '''
+        The geometries of a level (None: the original ones), in the order of the layer's features.
+        '''
+        if level is None:
+            return np.asarray(pyogrio.read_dataframe(self.path, columns=[]).geometry.values)
+        if level not in self.levels:
+            column = pyarrow.parquet.read_table(self.sidecar_path, columns=[f"level_{level}"]).column(0)
+            self.levels[level] = shapely.from_wkb(np.asarray(column.to_pylist(), dtype=object))
+        return self.levels[level]
+
+    def choose_level(self, bounds=None, size_px=(1200, 800)):
+        '''
+        The coarsest level (None: none) whose tolerance is under max_error_px pixels, for a map of
+        the given extent (the layer's if None) drawn into size_px (width, height) pixels.
+        '''
+        bounds = bounds if bounds is not None else self.bounds
+        return choose_level(self.tolerances, get_pixel_size(bounds, size_px))
+
+
+def get_pixel_size(bounds, size_px):
+    '''
+    The ground size of a pixel of a map of the extent drawn with equal axes into size_px pixels.
+    '''
+    width, height = max(bounds[2] - bounds[0], 1e-12), max(bounds[3] - bounds[1], 1e-12)
+    return max(width / max(size_px[0], 1), height / max(size_px[1], 1))
+
+
+def choose_level(tolerances, pixel_size):
+    level = None
+    for index, tolerance in enumerate(tolerances):
+        if tolerance <= max_error_px * pixel_size:
+            level = index
+    return level
+
+
+def get_output_size(figsize=(15, 10), dpi=None, ax=None):
+    '''
+    The size in pixels of the map axes in the saved figure: of ax if given, otherwise
+    default_axes_fraction of a figsize (inches) figure; dpi defaults to the savefig DPI.
+    '''
+    import matplotlib
+    save_dpi = matplotlib.rcParams['savefig.dpi']
+    if ax is not None:
+        figure_dpi = ax.figure.dpi
+        dpi = dpi or (figure_dpi if save_dpi == 'figure' else save_dpi)
+        extent = ax.get_window_extent()
+        return extent.width * dpi / figure_dpi, extent.height * dpi / figure_dpi
+    dpi = dpi or (matplotlib.rcParams['figure.dpi'] if save_dpi == 'figure' else save_dpi)
+    return figsize[0] * dpi * default_axes_fraction, figsize[1] * dpi * default_axes_fraction
+
+
+_pyramids = {}
+_pyramids_lock = threading.Lock()
+
+
+def get_pyramid(path):
+    '''
+    The GeometryPyramid of a layer file, loaded from its sidecar (built and saved if missing or outdated).
+    '''
+    signature = spatial_index.get_layer_signature(path)
+    key = (os.path.abspath(path), signature)
+    with _pyramids_lock:
+        pyramid = _pyramids.get(key)
+        if pyramid is None:
+            sidecar_path = path + sidecar_suffix
+            pyramid = GeometryPyramid.load(path, sidecar_path, signature=signature) if pyarrow is not None else None
+            if pyramid is None:
+                pyramid = GeometryPyramid.build(path)
+                if pyarrow is not None:
+                    try:
+                        pyramid.save(sidecar_path, signature=signature)
+                        pyramid.sidecar_path = sidecar_path
+                    except OSError as e:  # e.g., a read-only data directory; the pyramid is kept in memory only
+                        print(f"Cannot save the geometry pyramid of {path}: {e}")
+            _pyramids[key] = pyramid
+    return pyramid
+
+
+def read_layer(path, figsize=(15, 10), dpi=None, ax=None, columns=None, bbox=None):
+    '''
+    Read a layer for a map: the attributes (columns, None for all) with the geometries of the pyramid level
+    fitting the output (see get_output_size()) and the map extent (bbox, the layer's if None).
+    The rows are the layer's features in order, so the result joins like gpd.read_file(path).
+    '''
+    pyramid = get_pyramid(path)
+    level = pyramid.choose_level(bounds=bbox, size_px=get_output_size(figsize=figsize, dpi=dpi, ax=ax))
+    if columns is not None and len(columns) == 0:
+        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(pyramid.get_level(level), crs=pyramid.crs))
+    else:
+        gdf = pyogrio.read_dataframe(path, columns=columns, read_geometry=False)
+        gdf = gpd.GeoDataFrame(gdf, geometry=gpd.GeoSeries(pyramid.get_level(level), crs=pyramid.crs))
+    if bbox is not None:
+        gdf = gdf[shapely.intersects(np.asarray(gdf.geometry.values), shapely.box(*bbox))]
+    return gdf
+
+
+def plot(gdf, ax=None, figsize=(15, 10), dpi=None, path=None, **kwargs):
+    '''
+    gdf.plot(ax=ax, **kwargs), drawing simplified geometries when the full detail cannot be seen at the
+    output size. With the path of the layer gdf was read from (rows not reordered; filtered is fine, the
+    index gives the feature positions), the precomputed pyramid levels are used; otherwise the geometries
+    are simplified here. Return the axes.
+    '''
+    import matplotlib.pyplot as plt
+    if ax is None:
+        _, ax = plt.subplots(figsize=figsize)
+    bounds = list(gdf.total_bounds)
+    if ax.has_data():  # the map shows the other layers as well
+        (x_min, x_max), (y_min, y_max) = ax.get_xlim(), ax.get_ylim()
+        bounds = [min(bounds[0], x_min), min(bounds[1], y_min), max(bounds[2], x_max), max(bounds[3], y_max)]
+    pixel_size = get_pixel_size(bounds, get_output_size(dpi=dpi, ax=ax))
+    geometries = np.asarray(gdf.geometry.values)
+    simplified = None
+    if path is not None:
+        pyramid = get_pyramid(path)
+        level = choose_level(pyramid.tolerances, pixel_size)
+        positions = np.asarray(gdf.index)
+        if level is None:
+            simplified = geometries
+        elif np.issubdtype(positions.dtype, np.integer) and len(positions) and (positions.min() >= 0):
+            level_geometries = pyramid.get_level(level)
+            if positions.max() < len(level_geometries):
+                candidate = level_geometries[positions]
+                # the rows must be the layer's features: same boxes within the tolerance
+                difference = np.abs(shapely.bounds(candidate) - shapely.bounds(geometries))
+                if np.nan_to_num(difference, nan=0).max() <= 2 * pyramid.tolerances[level] + 1e-9:
+                    simplified = candidate
+    if simplified is None:
+        simplified = simplify_level(geometries, max_error_px * pixel_size) if pixel_size > 0 else geometries
+    plot_gdf = gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+    plot_gdf.plot(ax=ax, **kwargs)
+    return ax
+
+
+def benchmark(root='Dataset/Dati_Pesaro', figsize=(15, 10), dpi=100):
+    '''
+    For each layer, compare drawing the full geometries with drawing the chosen pyramid level; print a table.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    print(f"{'layer':<28} {'level':>5} {'vertices':>9} {'drawn':>9} {'full (s)':>9} {'pyramid (s)':>11}")
+    for file_name in sorted(os.listdir(root)):
+        if os.path.splitext(file_name)[1].lower() not in spatial_index.indexable_formats:
+            continue
+        path = os.path.join(root, file_name)
+        try:
+            gdf = gpd.read_file(path)
+            pyramid = get_pyramid(path)
+        except Exception as e:
+            print(f"{file_name:<28} cannot be read: {e}")
+            continue
+        timings = []
+        for use_pyramid in [False, True]:
+            fig, ax = plt.subplots(figsize=figsize)
+            start = time.perf_counter()
+            if use_pyramid:
+                plot(gdf, ax=ax, dpi=dpi, path=path)
+            else:
+                gdf.plot(ax=ax)
+            fig.savefig(os.devnull, format='png', dpi=dpi)
+            timings.append(time.perf_counter() - start)
+            plt.close(fig)
+        level = pyramid.choose_level(size_px=get_output_size(figsize=figsize, dpi=dpi))
+        drawn = pyramid.vertex_counts[0 if level is None else level + 1]
+        print(f"{file_name:<28} {str(level):>5} {pyramid.vertex_counts[0]:>9} {drawn:>9} {timings[0]:>9.3f} {timings[1]:>11.3f}")
+
+
+if __name__ == '__main__':
+    benchmark(*sys.argv[1:2])
@@ -1,23 +1,26 @@
 import re
 # import openai
 from collections import deque
-from openai import OpenAI
+from contextlib import nullcontext
+from openai import OpenAI, AsyncOpenAI
 
 import configparser
 
 # import networkx as nx
 import logging
-import time
 
 import os
 import requests
 import networkx as nx
-import pandas as pd
-import geopandas as gpd
 from pyvis.network import Network
  
 
 import LLM_Geo_Constants as constants
+from llm_cache import LLMReplyCache
+import llm_retry
+from llm_telemetry import LLMTelemetry, LLMCallTimer
+import dataset_catalog
+import data_sampler
 
 #load config
 config = configparser.ConfigParser()
@@ -26,9 +29,36 @@ config.read('config.ini')
 # use your KEY.
 OpenAI_key = config.get('API_Key', 'OpenAI_key')
 client = OpenAI(api_key=OpenAI_key)
+async_client = AsyncOpenAI(api_key=OpenAI_key)
+
+# max number of concurrent requests for the asyncio-based generation.
+max_concurrency = config.getint('LLM', 'max_concurrency', fallback=4)
+
+# retry with exponential backoff, and client-side limits of requests and tokens per minute (<= 0: unlimited).
+backoff_max_sec = config.getfloat('LLM', 'backoff_max_sec', fallback=60)
+rate_limiter = llm_retry.RateLimiter(requests_per_minute=config.getfloat('LLM', 'requests_per_minute', fallback=0),
+                                     tokens_per_minute=config.getfloat('LLM', 'tokens_per_minute', fallback=0),
+                                     )
+
+# on-disk cache of LLM replies, keyed by prompt, system role, model, temperature and generation settings.
+reply_cache = LLMReplyCache(cache_dir=config.get('LLM_Cache', 'cache_dir', fallback='.llm_cache'),
+                            max_size_mb=config.getfloat('LLM_Cache', 'max_size_mb', fallback=200),
+                            mode=config.get('LLM_Cache', 'mode', fallback='read_write'),
+                            )
+
+# JSONL trace of every LLM call; a Solution keeps its own LLMTelemetry writing to the same file.
+default_telemetry = LLMTelemetry(trace_file=config.get('Telemetry', 'trace_file', fallback='llm_trace.jsonl'))
+
+# index of the schemas, CRS, bounds and statistics of the data files, see dataset_catalog.py.
+use_catalog = config.getboolean('Catalog', 'enabled', fallback=True)
+catalog_root = config.get('Catalog', 'root', fallback='Dataset')
+catalog_index_file = config.get('Catalog', 'index_file', fallback='.catalog.json')
 
 
 def extract_content_from_LLM_reply(response):
+    if isinstance(response, str):  # reply loaded from the cache
+        return response
+
     stream = False
     if isinstance(response, list):
         stream = True
@@ -36,6 +66,8 @@ def extract_content_from_LLM_reply(response):
     content = ""
     if stream:       
         for chunk in response:
+            if not chunk.choices:  # the last chunk carrying the usage only
+                continue
             chunk_content = chunk.choices[0].delta.content         
 
             if chunk_content is not None:
@@ -50,6 +82,20 @@ def extract_content_from_LLM_reply(response):
     return content
 
 
+def get_finish_reason(response):
+    '''
+    The finish_reason of a reply ("stop", "length", ...); None if unknown, e.g., a stream closed early.
+    '''
+    if isinstance(response, str):
+        return None
+    if isinstance(response, list):
+        for chunk in reversed(response):
+            if chunk.choices and chunk.choices[0].finish_reason:
+                return chunk.choices[0].finish_reason
+        return None
+    return response.choices[0].finish_reason
+
+
 def extract_code(response, verbose=False):
     '''
     Extract python code from reply
@@ -69,6 +115,8 @@ def extract_code(response, verbose=False):
     python_code = ""
     reply_content = extract_content_from_LLM_reply(response)
     python_code_match = re.search(r"```(?:python)?(.*?)```", reply_content, re.DOTALL)
+    if python_code_match is None:  # the closing fence may be cut by a stop sequence
+        python_code_match = re.search(r"```(?:python)?(.*)$", reply_content, re.DOTALL)
     if python_code_match:
         python_code = python_code_match.group(1).strip()
 
@@ -78,6 +126,93 @@ def extract_code(response, verbose=False):
     return python_code
 
 
+class StreamingCodeExtractor():
+    """
+    Consume a reply piece by piece and tell when the first code block is closed,
+    so the rest of the stream (explanations, other code blocks) can be dropped.
+    The extracted code is the same as extract_code() on the complete reply.
+    """
+    code_pattern = re.compile(r"```(?:python)?(.*?)```", re.DOTALL)
+
+    def __init__(self):
+        self.content = ""
+        self.code = None
+
+    @property
+    def done(self):
+        return self.code is not None
+
+    def feed(self, text):
+        '''
+        Add a piece of the reply; return True once the first code block is closed.
+        '''
+        if self.done or not text:
+            return self.done
+        self.content += text
+        if '`' in text:  # a fence can only be closed by a new backtick
+            python_code_match = self.code_pattern.search(self.content)
+            if python_code_match:
+                self.code = python_code_match.group(1).strip()
+        return self.done
+
+
+def get_generation_kwargs(stage=None, max_tokens=None, stop=None, stop_at_code_end=None):
+    '''
+    Merge the explicit arguments with the stage defaults in constants.stage_generation_config.
+    Return the keyword arguments for the API (max_tokens, stop) and stop_at_code_end.
+    '''
+    stage_config = constants.stage_generation_config.get(stage, {})
+    if max_tokens is None:
+        max_tokens = stage_config.get('max_tokens')
+    if stop is None:
+        stop = stage_config.get('stop')
+    if stop_at_code_end is None:
+        stop_at_code_end = stage_config.get('stop_at_code_end', False)
+
+    generation_kwargs = {}
+    if max_tokens is not None:
+        generation_kwargs['max_tokens'] = max_tokens
+    if stop is not None:
+        generation_kwargs['stop'] = stop
+    return generation_kwargs, stop_at_code_end
+
+
+def record_LLM_call(telemetry, timer, model, stage, system_role, prompt, content,
+                    usage=None, retry_cnt=0, cache_hit=False, trace_info=None):
+    '''
+    Write one LLM call into the telemetry. Token counts come from the API usage if available,
+    otherwise (e.g., the stream was closed early) they are estimated from the text.
+    '''
+    if cache_hit:  # no tokens spent
+        prompt_tokens, completion_tokens, cached_tokens = 0, 0, 0
+        usage_source = "cache"
+    elif usage is not None:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = usage.completion_tokens
+        prompt_tokens_details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(prompt_tokens_details, 'cached_tokens', None) or 0
+        usage_source = "api"
+    else:
+        prompt_tokens = llm_retry.estimate_tokens(system_role, prompt)
+        completion_tokens = llm_retry.estimate_tokens(content)
+        cached_tokens = 0
+        usage_source = "estimate"
+
+    return telemetry.record(model=model,
+                            stage=stage,
+                            prompt_tokens=prompt_tokens,
+                            completion_tokens=completion_tokens,
+                            cached_tokens=cached_tokens,
+                            time_to_first_token=timer.time_to_first_token,
+                            latency=timer.latency,
+                            generation_time=timer.generation_time,
+                            retry_cnt=retry_cnt,
+                            cache_hit=cache_hit,
+                            usage_source=usage_source,
+                            **(trace_info or {}),
+                            )
+
+
 def get_LLM_reply(prompt="Provide Python code to read a CSV file from this URL and store the content in a variable. ",
                   system_role=r'You are a professional Geo-information scientist and developer.',
                   model=r"gpt-3.5-turbo",
@@ -85,8 +220,30 @@ def get_LLM_reply(prompt="Provide Python code to read a CSV file from this URL a
                   temperature=1,
                   stream=True,
                   retry_cnt=3,
-                  sleep_sec=10,
+                  sleep_sec=2,
+                  cache_mode=None,
+                  stage=None,
+                  max_tokens=None,
+                  stop=None,
+                  stop_at_code_end=None,
+                  telemetry=None,
+                  trace_info=None,
                   ):
+    '''
+    Return the LLM reply: a list of stream chunks, the completion object, or
+    the reply text when it is found in the cache.
+    retry_cnt: max tries; stops at the first success.
+    sleep_sec: base delay of the exponential backoff between tries.
+    cache_mode: None (use reply_cache.mode), "read_write", "read_only" or "bypass".
+    stage: a key of constants.stage_generation_config, providing the defaults of
+           max_tokens, stop and stop_at_code_end (stop the stream once the first code block is closed).
+    telemetry: the LLMTelemetry recording this call; None uses helper.default_telemetry.
+    trace_info: a dict of extra fields for the trace record, e.g., {"node_name": ...}.
+    '''
+    generation_kwargs, stop_at_code_end = get_generation_kwargs(stage, max_tokens, stop, stop_at_code_end)
+    if telemetry is None:
+        telemetry = default_telemetry
+    timer = LLMCallTimer()
 
     # Generate prompt for ChatGPT
     # url = "https://github.com/gladcolor/LLM-Geo/raw/master/overlay_analysis/NC_tract_population.csv"
@@ -95,40 +252,183 @@ def get_LLM_reply(prompt="Provide Python code to read a CSV file from this URL a
     # Query ChatGPT with the prompt
     # if verbose:
     #     print("Geting LLM reply... \n")
-    count = 0
-    isSucceed = False
-    while (not isSucceed) and (count < retry_cnt):
-        try:
-            count += 1
-            response = client.chat.completions.create(model=model,
-            messages=[
-            {"role": "system", "content": system_role},
-            {"role": "user", "content": prompt},
-            ],
-            temperature=temperature,
-            stream=stream)
-        except Exception as e:
-            # logging.error(f"Error in get_LLM_reply(), will sleep {sleep_sec} seconds, then retry {count}/{retry_cnt}: \n", e)
-            print(f"Error in get_LLM_reply(), will sleep {sleep_sec} seconds, then retry {count}/{retry_cnt}: \n", e)
-            time.sleep(sleep_sec)
-
-
-    response_chucks = []
-    if stream:
+    cache_key = reply_cache.make_key(prompt, system_role, model, temperature,
+                                     generation_kwargs=dict(generation_kwargs, stop_at_code_end=stop_at_code_end))
+    cached_content = reply_cache.get(cache_key, mode=cache_mode)
+    if cached_content is not None:
+        if verbose:
+            print(cached_content, end='')
+        print('\n\n')
+        timer.stop()
+        record_LLM_call(telemetry, timer, model, stage, system_role, prompt, cached_content,
+                        cache_hit=True, trace_info=trace_info)
+        return cached_content
+
+    usage = None
+
+    def request():
+        nonlocal usage
+        usage = None
+        timer.start_request()
+        response = client.chat.completions.create(model=model,
+        messages=[
+        {"role": "system", "content": system_role},
+        {"role": "user", "content": prompt},
+        ],
+        temperature=temperature,
+        stream=stream,
+        **generation_kwargs,
+        **({"stream_options": {"include_usage": True}} if stream else {}))
+
+        if not stream:
+            timer.got_token()
+            usage = response.usage
+            return response
+
+        # consume the stream inside the retry, so a broken stream is retried as well.
+        response_chucks = []
+        code_extractor = StreamingCodeExtractor() if stop_at_code_end else None
         for chunk in response:
             response_chucks.append(chunk)
+            if not chunk.choices:  # the last chunk carrying the usage only
+                usage = chunk.usage
+                continue
             content = chunk.choices[0].delta.content
             if content is not None:
+                timer.got_token()
                 if verbose:
                     print(content, end='')
-    else:
-        content = response.choices[0].message.content
-        # print(content)
+            if (code_extractor is not None) and code_extractor.feed(content):
+                response.close()  # got the code, drop the rest of the reply
+                break
+        return response_chucks
+
+    retry_stats = {}
+    response = llm_retry.call_with_retry(request,
+                                         retry_cnt=retry_cnt,
+                                         base_delay=sleep_sec,
+                                         max_delay=backoff_max_sec,
+                                         rate_limiter=rate_limiter,
+                                         estimated_tokens=llm_retry.estimate_tokens(system_role, prompt),
+                                         description="get_LLM_reply()",
+                                         stats=retry_stats,
+                                         )
+    timer.stop()
     print('\n\n')
     # print("Got LLM reply.")
-        
-    response = response_chucks # good for saving
-    
+
+    content = extract_content_from_LLM_reply(response)
+    record_LLM_call(telemetry, timer, model, stage, system_role, prompt, content,
+                    usage=usage, retry_cnt=retry_stats.get('retry_cnt', 0), trace_info=trace_info)
+
+    if get_finish_reason(response) != 'length':  # a reply cut by max_tokens is not kept
+        reply_cache.put(cache_key, content, mode=cache_mode, model=model)
+
+    return response
+
+
+async def get_LLM_reply_async(prompt,
+                              system_role=r'You are a professional Geo-information scientist and developer.',
+                              model=r"gpt-3.5-turbo",
+                              verbose=False,
+                              temperature=1,
+                              stream=True,
+                              retry_cnt=3,
+                              sleep_sec=2,
+                              cache_mode=None,
+                              semaphore=None,
+                              stage=None,
+                              max_tokens=None,
+                              stop=None,
+                              stop_at_code_end=None,
+                              telemetry=None,
+                              trace_info=None,
+                              cache_variant=None,
+                              ):
+    '''
+    The asyncio version of get_LLM_reply(), using AsyncOpenAI.
+    semaphore: an asyncio.Semaphore shared by the concurrent calls to limit the concurrency.
+    cache_variant: cache several replies to the same prompt separately, e.g., candidate programs.
+    The stream is not printed by default since concurrent replies would be interleaved.
+    '''
+    generation_kwargs, stop_at_code_end = get_generation_kwargs(stage, max_tokens, stop, stop_at_code_end)
+    if telemetry is None:
+        telemetry = default_telemetry
+    timer = LLMCallTimer()
+
+    cache_key = reply_cache.make_key(prompt, system_role, model, temperature, variant=cache_variant,
+                                     generation_kwargs=dict(generation_kwargs, stop_at_code_end=stop_at_code_end))
+    cached_content = reply_cache.get(cache_key, mode=cache_mode)
+    if cached_content is not None:
+        if verbose:
+            print(cached_content, end='\n\n')
+        timer.stop()
+        record_LLM_call(telemetry, timer, model, stage, system_role, prompt, cached_content,
+                        cache_hit=True, trace_info=trace_info)
+        return cached_content
+
+    if semaphore is None:
+        semaphore = nullcontext()
+
+    usage = None
+
+    async def request():
+        nonlocal usage
+        usage = None
+        async with semaphore:
+            timer.start_request()
+            response = await async_client.chat.completions.create(model=model,
+            messages=[
+            {"role": "system", "content": system_role},
+            {"role": "user", "content": prompt},
+            ],
+            temperature=temperature,
+            stream=stream,
+            **generation_kwargs,
+            **({"stream_options": {"include_usage": True}} if stream else {}))
+            if not stream:
+                timer.got_token()
+                usage = response.usage
+                return response
+
+            stream_response = response
+            response = []
+            code_extractor = StreamingCodeExtractor() if stop_at_code_end else None
+            async for chunk in stream_response:
+                response.append(chunk)
+                if not chunk.choices:  # the last chunk carrying the usage only
+                    usage = chunk.usage
+                    continue
+                content = chunk.choices[0].delta.content
+                if content is not None:
+                    timer.got_token()
+                if (code_extractor is not None) and code_extractor.feed(content):
+                    await stream_response.close()  # got the code, drop the rest of the reply
+                    break
+        return response
+
+    retry_stats = {}
+    response = await llm_retry.call_with_retry_async(request,
+                                                     retry_cnt=retry_cnt,
+                                                     base_delay=sleep_sec,
+                                                     max_delay=backoff_max_sec,
+                                                     rate_limiter=rate_limiter,
+                                                     estimated_tokens=llm_retry.estimate_tokens(system_role, prompt),
+                                                     description="get_LLM_reply_async()",
+                                                     stats=retry_stats,
+                                                     )
+    timer.stop()
+
+    content = extract_content_from_LLM_reply(response)
+    if verbose:
+        print(content, end='\n\n')
+
+    record_LLM_call(telemetry, timer, model, stage, system_role, prompt, content,
+                    usage=usage, retry_cnt=retry_stats.get('retry_cnt', 0), trace_info=trace_info)
+
+    if get_finish_reason(response) != 'length':  # a reply cut by max_tokens is not kept
+        reply_cache.put(cache_key, content, mode=cache_mode, model=model)
+
     return response
 
  
@@ -266,19 +566,23 @@ def get_data_sample_text(file_path, file_type="csv", encoding="utf-8"):
     """
     file_type: ["csv", "shp", "txt"]
     return: a text string
+    The sample of a file indexed by the dataset catalog (and unchanged since) is taken from the index.
     """
+    if use_catalog and file_type in ["csv", "shp"]:
+        catalog = dataset_catalog.get_default_catalog(root=catalog_root, index_file=catalog_index_file)
+        entry = catalog.get_entry(file_path, exact=True)
+        if catalog.is_fresh(entry) and entry.get('sample'):
+            return entry['sample']
+
+    # only the first rows are read; geometries are shown as their type, vertex count and bounding box.
     if file_type == "csv":
-        df = pd.read_csv(file_path)
-        text = str(df.head(3))
-        
+        text = data_sampler.get_sample_text(file_path, file_type="csv", row_cnt=3)
+
     if file_type == "shp":
-        gdf = gpd.read_file(file_path)
-        text = str(gdf.head(2))  # .drop('geomtry')
-        
+        text = data_sampler.get_sample_text(file_path, file_type="shp", row_cnt=2)
+
     if file_type == "txt":
-        with open(file_path, 'r', encoding=encoding) as f:
-            lines = f.readlines()
-            text = ''.join(lines[:3])
+        text = data_sampler.get_sample_text(file_path, file_type="txt", row_cnt=3, encoding=encoding)
     return text
 
 
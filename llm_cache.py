@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+CACHE_MODES = ["read_write", "read_only", "bypass"]
+
+
+class LLMReplyCache():
+    """
+    Content-addressed, on-disk cache for LLM replies.
+
+    Each reply is stored as a small JSON file named by the SHA-256 of the
+    request (prompt, system role, model, temperature, generation settings). Only the extracted reply
+    text is stored, not the raw stream chunks. When the cache grows over
+    max_size_mb, the least recently used entries are removed (a hit refreshes
+    the file's modification time).
+
+    mode:
+        "read_write": return cached replies and store new ones.
+        "read_only":  return cached replies, never write.
+        "bypass":     neither read nor write; always ask the LLM.
+    """
+    def __init__(self,
+                 cache_dir=".llm_cache",
+                 max_size_mb=200,
+                 mode="read_write",
+                ):
+        assert mode in CACHE_MODES, f"Unknown cache mode: {mode}, should be one of {CACHE_MODES}"
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.mode = mode
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt, system_role, model, temperature, variant=None, generation_kwargs=None):
+        """
+        variant: tells apart several replies to the same request, e.g., the index of a candidate program.
+        generation_kwargs: the other settings changing the reply, e.g., max_tokens and stop.
+        """
+        request = {"prompt": prompt,
+                   "system_role": system_role,
+                   "model": model,
+                   "temperature": temperature,
+                   }
+        if variant is not None:  # keep the keys of the existing entries unchanged
+            request["variant"] = variant
+        generation_kwargs = {name: value for name, value in (generation_kwargs or {}).items() if value not in [None, False]}
+        if generation_kwargs:  # the default settings keep the existing keys as well
+            request["generation_kwargs"] = generation_kwargs
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _resolve_mode(self, mode):
+        mode = self.mode if mode is None else mode
+        assert mode in CACHE_MODES, f"Unknown cache mode: {mode}, should be one of {CACHE_MODES}"
+        return mode
+
+    def get(self, key, mode=None):
+        '''
+        Return the cached reply text, or None if missing (or bypassed).
+        '''
+        if self._resolve_mode(mode) == "bypass":
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+            os.utime(path, None)  # refresh for LRU eviction
+        except (OSError, ValueError):
+            return None
+
+        return record.get("content")
+
+    def put(self, key, content, mode=None, **meta):
+        '''
+        Store the reply text; only in "read_write" mode. Empty replies are not stored.
+        '''
+        if self._resolve_mode(mode) != "read_write":
+            return
+        if not content:
+            return
+
+        path = self._path(key)
+        record = {"content": content, "created": time.time()}
+        record.update(meta)
+
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)  # atomic, so readers never see half a file
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits max_size_mb.
+        '''
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size_bytes:
+            return 0
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
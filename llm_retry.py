@@ -0,0 +1,197 @@
+import time
+import random
+import asyncio
+import threading
+import email.utils
+
+try:
+    import openai
+except ImportError:  # e.g., the DeepSeek implementation queries ollama only
+    openai = None
+
+
+# HTTP status codes that are worth retrying; other 4xx errors (bad request, authentication, ...) are not.
+RETRYABLE_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+
+class EmptyReplyError(RuntimeError):
+    """
+    The model returned no reply, e.g., ollama failed; worth retrying.
+    """
+
+
+# errors without a status code that are worth retrying; others (TypeError, KeyError, ...) are bugs, raised at once.
+RETRYABLE_EXCEPTIONS = (OSError, EmptyReplyError)  # OSError: ConnectionError, TimeoutError, ...
+if openai is not None:
+    RETRYABLE_EXCEPTIONS += (openai.APIConnectionError,)  # includes openai.APITimeoutError
+
+
+class TokenBucket():
+    """
+    A token bucket refilled continuously at `rate_per_minute`, holding at most `rate_per_minute` tokens.
+
+    reserve() takes the tokens immediately (the level may go negative) and returns how long
+    the caller must wait before using them, so the same bucket serves threads and asyncio tasks.
+    """
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_sec = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate_per_sec)
+            self.updated = now
+            self.level -= min(float(amount), self.capacity)  # a huge request would otherwise wait forever
+            if self.level >= 0:
+                return 0.0
+            return -self.level / self.rate_per_sec
+
+
+class RateLimiter():
+    """
+    Client-side limits of requests per minute and tokens per minute. A limit <= 0 means unlimited.
+    """
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+
+    def reserve(self, tokens=0):
+        wait_sec = 0.0
+        if self.request_bucket is not None:
+            wait_sec = max(wait_sec, self.request_bucket.reserve(1))
+        if (self.token_bucket is not None) and (tokens > 0):
+            wait_sec = max(wait_sec, self.token_bucket.reserve(tokens))
+        return wait_sec
+
+    def acquire(self, tokens=0):
+        wait_sec = self.reserve(tokens)
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+        return wait_sec
+
+    async def acquire_async(self, tokens=0):
+        wait_sec = self.reserve(tokens)
+        if wait_sec > 0:
+            await asyncio.sleep(wait_sec)
+        return wait_sec
+
+
+def estimate_tokens(*texts):
+    '''
+    A rough token count (about 4 characters per token) for the rate limiter.
+    '''
+    return sum(len(text or '') for text in texts) // 4 + 1
+
+
+def get_retry_after(exception):
+    '''
+    Return the delay in seconds requested by the server (Retry-After headers), or None.
+    '''
+    response = getattr(exception, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:  # HTTP date
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_date.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def is_retryable(exception):
+    status_code = getattr(exception, 'status_code', None)
+    if status_code is None:
+        return isinstance(exception, RETRYABLE_EXCEPTIONS)
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+def get_backoff_delay(attempt, base_delay=2, max_delay=60, exception=None):
+    '''
+    Exponential backoff with full jitter; a server's Retry-After takes precedence.
+    attempt: 1 for the first retry.
+    '''
+    retry_after = get_retry_after(exception) if exception is not None else None
+    if retry_after is not None:
+        return min(retry_after, max_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def call_with_retry(func,
+                    retry_cnt=3,
+                    base_delay=2,
+                    max_delay=60,
+                    rate_limiter=None,
+                    estimated_tokens=0,
+                    description="LLM call",
+                    stats=None,
+                    ):
+    '''
+    Call func() until the first success, at most retry_cnt times, and return its result.
+    Raise the last exception if all tries fail or the error is not retryable.
+    stats: an optional dict; stats['retry_cnt'] is set to the number of retries.
+    '''
+    count = 0
+    while True:
+        count += 1
+        if stats is not None:
+            stats['retry_cnt'] = count - 1
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimated_tokens)
+        try:
+            return func()
+        except Exception as e:
+            if (count >= retry_cnt) or (not is_retryable(e)):
+                print(f"Error in {description}, giving up after {count}/{retry_cnt} tries: \n", e)
+                raise
+            delay = get_backoff_delay(count, base_delay=base_delay, max_delay=max_delay, exception=e)
+            print(f"Error in {description}, will sleep {delay:.1f} seconds, then retry {count}/{retry_cnt}: \n", e)
+            time.sleep(delay)
+
+
+async def call_with_retry_async(func,
+                                retry_cnt=3,
+                                base_delay=2,
+                                max_delay=60,
+                                rate_limiter=None,
+                                estimated_tokens=0,
+                                description="LLM call",
+                                stats=None,
+                                ):
+    '''
+    The asyncio version of call_with_retry(); func() returns an awaitable.
+    '''
+    count = 0
+    while True:
+        count += 1
+        if stats is not None:
+            stats['retry_cnt'] = count - 1
+        if rate_limiter is not None:
+            await rate_limiter.acquire_async(estimated_tokens)
+        try:
+            return await func()
+        except Exception as e:
+            if (count >= retry_cnt) or (not is_retryable(e)):
+                print(f"Error in {description}, giving up after {count}/{retry_cnt} tries: \n", e)
+                raise
+            delay = get_backoff_delay(count, base_delay=base_delay, max_delay=max_delay, exception=e)
+            print(f"Error in {description}, will sleep {delay:.1f} seconds, then retry {count}/{retry_cnt}: \n", e)
+            await asyncio.sleep(delay)
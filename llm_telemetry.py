@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import threading
+
+
+class LLMCallTimer():
+    """
+    Timing of one LLM call: total latency from the start of the call (retries and
+    rate-limit waits included), and time-to-first-token of the successful request.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.request_time = None
+        self.first_token_time = None
+        self.end_time = None
+
+    def start_request(self):
+        self.request_time = time.perf_counter()
+        self.first_token_time = None
+
+    def got_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+
+    @property
+    def latency(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def time_to_first_token(self):
+        if (self.request_time is None) or (self.first_token_time is None):
+            return None
+        return self.first_token_time - self.request_time
+
+    @property
+    def generation_time(self):
+        if (self.first_token_time is None) or (self.end_time is None):
+            return None
+        return self.end_time - self.first_token_time
+
+
+class LLMTelemetry():
+    """
+    Record each LLM call (model, stage, tokens, time-to-first-token, latency, retries)
+    as one line of a JSONL trace, and summarize the calls by stage.
+
+    trace_file: the JSONL file to append to; None keeps the records in memory only.
+    run_id: written into every record, e.g., the task name of a Solution.
+    """
+    def __init__(self, trace_file=None, run_id=None):
+        self.trace_file = trace_file
+        self.run_id = run_id
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):  # a Solution with its telemetry can be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self,
+               model,
+               stage=None,
+               prompt_tokens=0,
+               completion_tokens=0,
+               cached_tokens=0,
+               time_to_first_token=None,
+               latency=0.0,
+               generation_time=None,
+               retry_cnt=0,
+               cache_hit=False,
+               usage_source="api",
+               **extra,
+               ):
+        record = {"time": time.time(),
+                  "run_id": self.run_id,
+                  "model": model,
+                  "stage": stage,
+                  "prompt_tokens": prompt_tokens,
+                  "completion_tokens": completion_tokens,
+                  "cached_tokens": cached_tokens,
+                  "time_to_first_token": time_to_first_token,
+                  "latency": latency,
+                  "generation_time": generation_time,
+                  "retry_cnt": retry_cnt,
+                  "cache_hit": cache_hit,
+                  "usage_source": usage_source,  # "api", "estimate" (e.g., the stream was closed early), or "cache"
+                  }
+        record.update(extra)
+
+        with self._lock:
+            self.records.append(record)
+            if self.trace_file:
+                trace_dir = os.path.dirname(self.trace_file)
+                if trace_dir:
+                    os.makedirs(trace_dir, exist_ok=True)
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return record
+
+    def summary(self):
+        '''
+        Return a dict: stage -> aggregated statistics, plus a "TOTAL" entry.
+        '''
+        with self._lock:
+            records = list(self.records)
+
+        stats = {}
+        for record in records:
+            for key in [record["stage"] or "unknown", "TOTAL"]:
+                stage_stats = stats.setdefault(key, {"calls": 0,
+                                                     "cache_hits": 0,
+                                                     "retries": 0,
+                                                     "prompt_tokens": 0,
+                                                     "completion_tokens": 0,
+                                                     "cached_tokens": 0,
+                                                     "api_prompt_tokens": 0,
+                                                     "latency": 0.0,
+                                                     "generation_time": 0.0,
+                                                     "ttft_list": [],
+                                                     })
+                stage_stats["calls"] += 1
+                stage_stats["cache_hits"] += int(bool(record["cache_hit"]))
+                stage_stats["retries"] += record["retry_cnt"]
+                stage_stats["prompt_tokens"] += record["prompt_tokens"]
+                stage_stats["completion_tokens"] += record["completion_tokens"]
+                stage_stats["cached_tokens"] += record.get("cached_tokens", 0)
+                if record["usage_source"] == "api":  # cached tokens are only known from the API usage
+                    stage_stats["api_prompt_tokens"] += record["prompt_tokens"]
+                stage_stats["latency"] += record["latency"]
+                stage_stats["generation_time"] += record["generation_time"] or 0.0
+                if record["time_to_first_token"] is not None:
+                    stage_stats["ttft_list"].append(record["time_to_first_token"])
+
+        for stage_stats in stats.values():
+            ttft_list = stage_stats.pop("ttft_list")
+            stage_stats["mean_ttft"] = sum(ttft_list) / len(ttft_list) if ttft_list else None
+            generation_time = stage_stats["generation_time"]
+            stage_stats["tokens_per_sec"] = stage_stats["completion_tokens"] / generation_time if generation_time > 0 else None
+            # share of the prompt tokens served from the provider's prompt cache
+            api_prompt_tokens = stage_stats.pop("api_prompt_tokens")
+            stage_stats["prompt_cache_hit_rate"] = stage_stats["cached_tokens"] / api_prompt_tokens if api_prompt_tokens > 0 else None
+        return stats
+
+    def summary_text(self):
+        stats = self.summary()
+        if not stats:
+            return "No LLM calls recorded."
+
+        total_latency = stats["TOTAL"]["latency"] or 1e-9
+        header = f"{'stage':<18}{'calls':>6}{'cached':>7}{'retries':>8}{'prompt_tok':>11}{'pc_hit':>7}{'compl_tok':>10}" + \
+                 f"{'latency_s':>10}{'share':>7}{'ttft_s':>8}{'tok/s':>7}"
+        lines = [header, '-' * len(header)]
+        stages = sorted([stage for stage in stats if stage != "TOTAL"], key=lambda stage: -stats[stage]["latency"])
+        for stage in stages + ["TOTAL"]:
+            s = stats[stage]
+            mean_ttft = f"{s['mean_ttft']:.2f}" if s["mean_ttft"] is not None else "-"
+            tokens_per_sec = f"{s['tokens_per_sec']:.0f}" if s["tokens_per_sec"] is not None else "-"
+            hit_rate = f"{s['prompt_cache_hit_rate']:.0%}" if s["prompt_cache_hit_rate"] is not None else "-"
+            lines.append(f"{stage:<18}{s['calls']:>6}{s['cache_hits']:>7}{s['retries']:>8}{s['prompt_tokens']:>11}{hit_rate:>7}"
+                         f"{s['completion_tokens']:>10}{s['latency']:>10.1f}{s['latency'] / total_latency:>7.0%}"
+                         f"{mean_ttft:>8}{tokens_per_sec:>7}")
+        return '\n'.join(lines)
+
+    def prefix_cache_hit_rates(self):
+        '''
+        Return a dict: prefix_id (see prompt_compiler.PromptCompiler) -> share of prompt tokens served from the prompt cache.
+        '''
+        with self._lock:
+            records = list(self.records)
+        totals = {}
+        for record in records:
+            if ("prefix_id" not in record) or (record["usage_source"] != "api"):
+                continue
+            prompt_tokens, cached_tokens = totals.get(record["prefix_id"], (0, 0))
+            totals[record["prefix_id"]] = (prompt_tokens + record["prompt_tokens"], cached_tokens + record["cached_tokens"])
+        return {prefix_id: cached / prompt if prompt > 0 else 0.0 for prefix_id, (prompt, cached) in totals.items()}
+
+    def print_summary(self):
+        print(f"\n--------------- LLM call summary{'' if self.run_id is None else f' ({self.run_id})'} ---------------")
+        print(self.summary_text())
+        print("(cached: replies from the local cache; pc_hit: prompt tokens served from the provider's prompt cache)")
+        print()
@@ -0,0 +1,152 @@
+import re
+import ast
+import math
+import hashlib
+
+
+# words, numbers, and single punctuation marks; long words count as several BPE tokens.
+token_pattern = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]", re.UNICODE)
+
+
+def count_tokens(text):
+    '''
+    Approximate the number of BPE tokens (e.g., OpenAI cl100k/o200k) of a text offline.
+    Words are counted as one token per 4 characters; digits as one token per 3 digits;
+    every punctuation mark as one token. Usually within 10% for English prose and Python code.
+    '''
+    if not text:
+        return 0
+    count = 0
+    for token in token_pattern.findall(text):
+        if token[0].isdigit():
+            count += math.ceil(len(token) / 3)
+        elif token[0].isalpha():
+            count += math.ceil(len(token) / 4)
+        else:
+            count += 1
+    return count
+
+
+def get_function_signatures(code, description=""):
+    '''
+    Summarize the code of a function: keep the "def" lines, docstrings and return lines, drop the bodies.
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        lines = [line for line in code.splitlines() if line.strip().startswith(("def ", "return "))]
+        return '\n'.join(lines)
+
+    summaries = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            summaries.append(ast.unparse(node))
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        args = ast.unparse(node.args)
+        lines = [f"def {node.name}({args}):"]
+        docstring = ast.get_docstring(node)
+        if docstring or description:
+            lines.append(f'    """{docstring or description}"""')
+        lines.append("    ...  # body omitted")
+        return_lines = [ast.unparse(child) for child in ast.walk(node) if isinstance(child, ast.Return)]
+        for return_line in dict.fromkeys(return_lines):  # unique, keep the order
+            lines.append(f"    {return_line}")
+        summaries.append('\n'.join(lines))
+    return '\n'.join(summaries)
+
+
+class PromptSection():
+    """
+    A piece of a prompt.
+
+    priority: sections with lower priority are reduced first when the prompt is over budget.
+    summary: a shorter replacement of the text (e.g., function signatures only); None means the section can only be dropped.
+    required: never reduce this section.
+    static: the text is the same for every prompt of a stage (roles, requirement lists, reply examples).
+            Static sections are placed first and never reduced, so the prompts share a prefix
+            that the provider's prompt caching (or a local KV cache) can reuse.
+    """
+    def __init__(self, name, text, priority=50, summary=None, required=False, static=False):
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.summary = summary
+        self.required = required or static
+        self.static = static
+
+    @property
+    def tokens(self):
+        return count_tokens(self.text)
+
+
+class PromptCompiler():
+    """
+    Assemble prompt sections within a token budget.
+
+    Static sections go first (in their given order), then the variable ones, so prompts
+    of the same stage share a prefix. When the sections exceed the budget, the lowest-priority
+    sections are first replaced by their summaries, then dropped, until the prompt fits (required
+    and static sections are always kept). compile() returns the prompt and a report of what was removed.
+    The report's prefix_id (template version + hash of the static prefix) identifies the shared prefix.
+    """
+    def __init__(self, token_budget=None, version=""):
+        self.token_budget = token_budget
+        self.version = version
+
+    def compile(self, sections):
+        sections = [section for section in sections if section.static] + \
+                   [section for section in sections if not section.static]
+        texts = [section.text for section in sections]
+        token_counts = [count_tokens(text) for text in texts]
+        total_tokens = sum(token_counts)
+        static_prefix = ''.join([section.text for section in sections if section.static])
+        report = {"token_budget": self.token_budget,
+                  "original_tokens": total_tokens,
+                  "final_tokens": total_tokens,
+                  "static_prefix_tokens": count_tokens(static_prefix),
+                  "prefix_id": f"{self.version}:{hashlib.sha1(static_prefix.encode('utf-8')).hexdigest()[:10]}",
+                  "reduced": [],
+                  }
+        if (self.token_budget is None) or (total_tokens <= self.token_budget):
+            return ''.join(texts), report
+
+        reducible = sorted([idx for idx, section in enumerate(sections) if not section.required],
+                           key=lambda idx: sections[idx].priority)  # stable: earlier sections first on ties
+
+        # pass 1: summarize; pass 2: drop.
+        for action in ["summarized", "dropped"]:
+            for idx in reducible:
+                if total_tokens <= self.token_budget:
+                    break
+                section = sections[idx]
+                if action == "summarized":
+                    if section.summary is None:
+                        continue
+                    new_text = section.summary
+                else:
+                    if texts[idx] == "":
+                        continue
+                    new_text = ""
+                new_tokens = count_tokens(new_text)
+                if new_tokens >= token_counts[idx]:
+                    continue
+                total_tokens -= token_counts[idx] - new_tokens
+                report["reduced"].append({"section": section.name,
+                                          "action": action,
+                                          "tokens_saved": token_counts[idx] - new_tokens,
+                                          })
+                texts[idx] = new_text
+                token_counts[idx] = new_tokens
+
+        report["final_tokens"] = total_tokens
+        return ''.join(texts), report
+
+    @staticmethod
+    def report_text(report):
+        if not report["reduced"]:
+            return f"Prompt tokens: {report['original_tokens']} (budget: {report['token_budget']}), nothing removed."
+        lines = [f"Prompt tokens: {report['original_tokens']} -> {report['final_tokens']} (budget: {report['token_budget']}):"]
+        for item in report["reduced"]:
+            lines.append(f"    {item['action']} '{item['section']}', saved {item['tokens_saved']} tokens")
+        return '\n'.join(lines)
@@ -0,0 +1,254 @@
+import os
+import re
+import functools
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+import canonical_crs
+import columnar_cache
+import dataset_catalog
+
+
+# layers with the names of the areas a task may be about: (path, column of the names).
+aoi_layers = [('Dataset/Dati_Pesaro/Quartieri2019.shp', 'denominazi'),
+              ]
+
+# the comparisons of a where filter pushed down into the Parquet/Feather scans.
+where_operators = {'=': '==', '==': '==', '!=': '!=', '<>': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+where_condition_pattern = re.compile(r"""^\s*(?:"([^"]+)"|(\w+))\s*
+                                         (?:(==|!=|<>|<=|>=|=|<|>)\s*('(?:[^']|'')*'|-?\d+(?:\.\d+)?)
+                                           |(not\s+in|in)\s*\(([^()]*)\))\s*$""", re.IGNORECASE | re.VERBOSE)
+literal_pattern = re.compile(r"'((?:[^']|'')*)'|(-?\d+(?:\.\d+)?)")
+
+
+def parse_literal(text):
+    match = literal_pattern.fullmatch(text.strip())
+    if match is None:
+        raise ValueError(f"Not a literal: {text}")
+    if match.group(1) is not None:
+        return match.group(1).replace("''", "'")
+    number = match.group(2)
+    return float(number) if '.' in number else int(number)
+
+
+def parse_where(where):
+    '''
+    Translate an SQL attribute filter, conditions like "col = 'a'", "col >= 10" or "col IN ('a', 'b')"
+    joined by AND, into pyarrow filters [(column, operator, value), ...]; None if it is not that simple
+    (OR, functions, LIKE, ...), then the filter is left to GDAL.
+    '''
+    if not where:
+        return []
+    filters = []
+    for condition in re.split(r"\s+and\s+", where.strip(), flags=re.IGNORECASE):
+        match = where_condition_pattern.match(condition)
+        if match is None:
+            return None
+        column = match.group(1) or match.group(2)
+        try:
+            if match.group(3):
+                filters.append((column, where_operators[match.group(3)], parse_literal(match.group(4))))
+            else:
+                values = [parse_literal(item) for item in re.findall(r"'(?:[^']|'')*'|-?\d+(?:\.\d+)?", match.group(6))]
+                operator = 'not in' if match.group(5).lower().startswith('not') else 'in'
+                filters.append((column, operator, values))
+        except ValueError:
+            return None
+    return filters
+
+
+def apply_filters(df, filters):
+    '''
+    Keep the rows of a DataFrame meeting all the filters (see parse_where()).
+    '''
+    keep = np.ones(len(df), dtype=bool)
+    for column, operator, value in filters:
+        series = df[column]
+        if operator in ('in', 'not in'):
+            matched = series.isin(value).to_numpy()
+            keep &= matched if operator == 'in' else ~matched
+        else:
+            keep &= {'==': series.eq, '!=': series.ne, '<': series.lt, '<=': series.le,
+                     '>': series.gt, '>=': series.ge}[operator](value).fillna(False).to_numpy(dtype=bool)
+    return df[keep]
+
+
+def find_aoi(text, layers=None):
+    '''
+    The area of interest named in a task, e.g., "buildings in Centro Storico":
+    {'path': ..., 'column': ..., 'values': [...]}; None if no area name of the layers is in the text.
+    '''
+    text = (text or "").lower()
+    for path, column in (aoi_layers if layers is None else layers):
+        try:
+            names = pyogrio.read_dataframe(path, columns=[column], read_geometry=False)[column].dropna().astype(str)
+        except Exception:
+            continue
+        values = []
+        for name in sorted(set(names), key=len, reverse=True):  # "Villa San Martino" before "San Martino"
+            position = text.find(name.lower())
+            if position >= 0 and name.strip():
+                values.append(name)
+                text = text[:position] + ' ' * len(name) + text[position + len(name):]
+        if values:
+            return {'path': path, 'column': column, 'values': sorted(values)}
+    return None
+
+
+def to_where(column, values):
+    quoted = ', '.join("'" + str(value).replace("'", "''") + "'" for value in values)
+    return f'"{column}" IN ({quoted})'
+
+
+@functools.lru_cache(maxsize=16)
+def _read_aoi(path, column, values):
+    return read_data(path, columns=[column], where=to_where(column, values))
+
+
+def get_aoi_geometry(aoi):
+    '''
+    The union of the areas of an AOI (see find_aoi()), as a GeoSeries of one geometry in the AOI layer's CRS.
+    '''
+    gdf = _read_aoi(aoi['path'], aoi['column'], tuple(aoi['values']))
+    if len(gdf) == 0:
+        raise ValueError(f"No area of {aoi['path']} has {aoi['column']} in {aoi['values']}")
+    return gpd.GeoSeries([shapely.union_all(gdf.geometry.values)], crs=gdf.crs)
+
+
+def to_mask_geometry(mask, crs):
+    '''
+    A mask (shapely geometry in the CRS of the data, or GeoSeries/GeoDataFrame in any CRS) as one geometry.
+    '''
+    if isinstance(mask, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        if (crs is not None) and (mask.crs is not None):
+            mask = canonical_crs.reproject(mask, crs)
+        return shapely.union_all(mask.geometry.values)
+    return mask
+
+
+def get_mirror(path, mirror_dir):
+    '''
+    The path of the GeoParquet/Feather mirror of a data file (built if missing), or None.
+    '''
+    mirror_dir = mirror_dir or columnar_cache.default_mirror_dir
+    if (not mirror_dir) or (not columnar_cache.can_mirror(path)):
+        return None
+    try:
+        return columnar_cache.build_mirror(path, mirror_dir)
+    except Exception:
+        return None
+
+
+def read_vector(path, columns=None, bbox=None, mask=None, where=None, mirror_dir=None):
+    if mask is not None:
+        mask = to_mask_geometry(mask, pyogrio.read_info(path)['crs'])
+        if bbox is not None:
+            mask = shapely.intersection(mask, shapely.box(*bbox))
+    filters = parse_where(where)
+    mirror_path = get_mirror(path, mirror_dir) if filters is not None else None
+    if mirror_path is None:  # GDAL applies the filters while reading the file
+        read_columns = columns
+        if (columns is not None) and where:  # GDAL sees only the columns read
+            read_columns = None if filters is None else list(dict.fromkeys(list(columns) + [column for column, _, _ in filters]))
+        gdf = pyogrio.read_dataframe(path, columns=read_columns, bbox=None if mask is not None else bbox,
+                                     mask=mask, where=where or None)
+        if read_columns != columns:
+            gdf = gdf[[column for column in gdf.columns if column in columns or column == 'geometry']]
+        return gdf
+    mirror_columns = columnar_cache.get_mirror_columns(mirror_path)
+    read_columns = None
+    if columns is not None:
+        read_columns = [column for column in mirror_columns if (column in columns or column == 'geometry') and column != 'bbox']
+    scan_bbox = mask.bounds if mask is not None else bbox
+    gdf = gpd.read_parquet(mirror_path, columns=read_columns, filters=filters or None,
+                           bbox=tuple(scan_bbox) if (scan_bbox is not None) and ('bbox' in mirror_columns) else None)
+    if gdf.crs is not None and gdf.crs.to_epsg() is not None:
+        gdf = gdf.set_crs(gdf.crs.to_epsg(), allow_override=True)
+    if (mask is not None) or (bbox is not None):  # the scan skips the row groups outside; now the features
+        area = mask if mask is not None else shapely.box(*bbox)
+        shapely.prepare(area)
+        gdf = gdf[shapely.intersects(np.asarray(gdf.geometry.values), area)]
+    return gdf.reset_index(drop=True)
+
+
+def read_table(path, columns=None, bbox=None, mask=None, where=None, xy_columns=None, xy_crs=None, mirror_dir=None):
+    entry = dataset_catalog.get_default_catalog().get_entry(path, exact=True) or {}
+    xy_columns = xy_columns or entry.get('coordinate_columns')
+    xy_crs = xy_crs or entry.get('crs')
+    filters = parse_where(where)
+    if filters is None:
+        raise ValueError(f"Cannot apply the where filter to a CSV file: {where}. "
+                         f"Use conditions like \"col = 'a'\", \"col >= 10\" or \"col IN ('a', 'b')\" joined by AND.")
+    spatial = (bbox is not None) or (mask is not None)
+    if spatial and not xy_columns:
+        raise ValueError(f"No coordinate columns (X/Y) known for {path}; give xy_columns=(x column, y column).")
+    read_columns = None
+    if columns is not None:
+        needed = list(columns) + [column for column, _, _ in filters] + (list(xy_columns) if spatial else [])
+        read_columns = list(dict.fromkeys(needed))
+    mirror_path = get_mirror(path, mirror_dir)
+    if mirror_path is not None:
+        import pyarrow.dataset
+        import pyarrow.parquet
+        dataset = pyarrow.dataset.dataset(mirror_path, format='feather')
+        expression = pyarrow.parquet.filters_to_expression(filters) if filters else None
+        if bbox is not None:  # pushed down with the attribute filters
+            x, y = pyarrow.dataset.field(xy_columns[0]), pyarrow.dataset.field(xy_columns[1])
+            box_expression = (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+            expression = box_expression if expression is None else expression & box_expression
+        df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+    else:
+        df = apply_filters(pd.read_csv(path, usecols=read_columns), filters)
+    if bbox is not None:
+        x, y = df[xy_columns[0]].to_numpy(dtype=float), df[xy_columns[1]].to_numpy(dtype=float)
+        df = df[(x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])]
+    if mask is not None:
+        mask = to_mask_geometry(mask, xy_crs)
+        shapely.prepare(mask)
+        df = df[shapely.contains_xy(mask, df[xy_columns[0]].to_numpy(dtype=float), df[xy_columns[1]].to_numpy(dtype=float))]
+    if columns is not None:
+        df = df[[column for column in df.columns if column in set(columns)]]
+    return df.reset_index(drop=True)
+
+
+def read_data(path, columns=None, bbox=None, mask=None, where=None, aoi=None, xy_columns=None, xy_crs=None, mirror_dir=None):
+    '''
+    Read a vector layer (GeoDataFrame) or a CSV file (DataFrame), only the rows and columns needed;
+    the filters are pushed down into the GDAL or GeoParquet/Feather scans (see columnar_cache.py).
+    columns: the attribute columns to load (the geometry of layers is always loaded); None for all.
+    bbox: (xmin, ymin, xmax, ymax) in the CRS of the data; the features intersecting it are loaded.
+    mask: a shapely geometry in the CRS of the data, or a GeoSeries/GeoDataFrame in any CRS.
+    where: an SQL attribute filter, e.g., "altezza > 10 AND annoctr >= 1950".
+    aoi: an area of interest, {'path': ..., 'column': ..., 'values': [...]} (see find_aoi()), instead of a mask.
+    xy_columns, xy_crs: the point coordinate columns of a CSV file and their CRS (from the dataset catalog if None).
+    '''
+    if aoi is not None:
+        if mask is not None:
+            raise ValueError("Give either a mask or an aoi.")
+        mask = get_aoi_geometry(aoi)
+    if os.path.splitext(path)[1].lower() in ['.csv', '.txt']:
+        return read_table(path, columns=columns, bbox=bbox, mask=mask, where=where,
+                          xy_columns=xy_columns, xy_crs=xy_crs, mirror_dir=mirror_dir)
+    return read_vector(path, columns=columns, bbox=bbox, mask=mask, where=where, mirror_dir=mirror_dir)
+
+
+def get_reading_hint(known_columns=(), aoi=None):
+    '''
+    The prompt text asking the programs to read the data with read_data(), with the known columns and AOI.
+    '''
+    known_columns = [column for column in known_columns or [] if column]
+    hint = ("Read the data files with 'import pushdown_reader; pushdown_reader.read_data(path, columns=[...], where=None, aoi=None)' "
+            "instead of gpd.read_file()/pd.read_csv(): it returns the same GeoDataFrame/DataFrame, but loads only "
+            "the given columns (the geometry of layers is always loaded; list every column the program uses, "
+            "including the join keys and CSV X/Y) and the rows meeting the SQL filter 'where', e.g., \"annoctr >= 1950\". ")
+    if known_columns:
+        hint += f"The columns of interest are: {', '.join(repr(column) for column in known_columns)}. "
+    if aoi is not None:
+        hint += (f"The task is about an area of interest; pass aoi={aoi!r} to load only the features (or CSV points) "
+                 f"within it, unless the program needs the data outside the area as well. ")
+    return hint
@@ -0,0 +1,375 @@
+import os
+import sys
+import heapq
+import hashlib
+import threading
+
+import numpy as np
+import shapely
+import geopandas as gpd
+
+
+# the sidecar of a layer: <layer file>.hrtree.npz, next to the data.
+sidecar_suffix = '.hrtree.npz'
+
+# vector layers with a spatial index; the other files of a shapefile change its signature as well.
+indexable_formats = ['.shp', '.geojson', '.gpkg']
+shapefile_companions = ['.shx', '.dbf']
+
+supported_predicates = ['intersects', 'within', 'contains', 'touches', 'crosses', 'overlaps', 'covers', 'covered_by']
+
+
+def hilbert_values(x, y):
+    '''
+    The positions on a Hilbert curve of 16-bit grid coordinates (numpy arrays), as in the flatbush library.
+    '''
+    x = x.astype(np.uint32)
+    y = y.astype(np.uint32)
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+    a, b, c, d = A, B, C, D
+
+    A = (a & (a >> 2)) ^ (b & (b >> 2))
+    B = (a & (b >> 2)) ^ (b & ((a ^ b) >> 2))
+    C = C ^ ((a & (c >> 2)) ^ (b & (d >> 2)))
+    D = D ^ ((b & (c >> 2)) ^ ((a ^ b) & (d >> 2)))
+    a, b, c, d = A, B, C, D
+
+    A = (a & (a >> 4)) ^ (b & (b >> 4))
+    B = (a & (b >> 4)) ^ (b & ((a ^ b) >> 4))
+    C = C ^ ((a & (c >> 4)) ^ (b & (d >> 4)))
+    D = D ^ ((b & (c >> 4)) ^ ((a ^ b) & (d >> 4)))
+    a, b, c, d = A, B, C, D
+
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    def interleave(value):
+        value = (value | (value << 8)) & 0x00FF00FF
+        value = (value | (value << 4)) & 0x0F0F0F0F
+        value = (value | (value << 2)) & 0x33333333
+        value = (value | (value << 1)) & 0x55555555
+        return value
+    return ((interleave(i1) << 1) | interleave(i0)).astype(np.uint32)
+
+
+class PackedRTree():
+    """
+    A static R-tree packed in Hilbert order of the box centers (like flatbush): every node is full,
+    and the whole tree is three arrays, so it is saved and loaded without rebuilding.
+
+    boxes: (node count, 4) bounding boxes of the items (in Hilbert order) then of the nodes, level by level.
+    indices: the item id of each leaf box, or the position of the first child of each node.
+    level_ends: the end position of each level in boxes; the last level is the root.
+    """
+    def __init__(self, boxes, indices, level_ends, node_size=16, item_cnt=None):
+        self.boxes = boxes
+        self.indices = indices
+        self.level_ends = level_ends
+        self.node_size = node_size
+        self.item_cnt = int(level_ends[0]) if item_cnt is None else item_cnt
+
+    @classmethod
+    def build(cls, item_boxes, node_size=16):
+        '''
+        item_boxes: (n, 4) array of xmin, ymin, xmax, ymax; empty items (NaN) never match a query.
+        '''
+        item_boxes = np.asarray(item_boxes, dtype='float64').reshape(-1, 4)
+        item_cnt = len(item_boxes)
+        empty = np.isnan(item_boxes).any(axis=1)
+        item_boxes = item_boxes.copy()
+        item_boxes[empty] = [np.inf, np.inf, -np.inf, -np.inf]
+
+        valid = item_boxes[~empty]
+        if len(valid):
+            xmin, ymin = valid[:, 0].min(), valid[:, 1].min()
+            width, height = max(valid[:, 2].max() - xmin, 1e-12), max(valid[:, 3].max() - ymin, 1e-12)
+            cx = np.where(empty, xmin, (item_boxes[:, 0] + item_boxes[:, 2]) / 2)
+            cy = np.where(empty, ymin, (item_boxes[:, 1] + item_boxes[:, 3]) / 2)
+            order = np.argsort(hilbert_values(np.floor(0xFFFF * (cx - xmin) / width),
+                                              np.floor(0xFFFF * (cy - ymin) / height)), kind='stable')
+        else:
+            order = np.arange(item_cnt)
+
+        levels_boxes = [item_boxes[order]]
+        levels_indices = [order.astype('int64')]
+        level_ends = [item_cnt]
+        start = 0
+        while len(levels_boxes[-1]) > 1 or len(levels_boxes) == 1:
+            child_boxes = levels_boxes[-1]
+            group_starts = np.arange(0, len(child_boxes), node_size)
+            if len(child_boxes) == 0:
+                break
+            node_boxes = np.column_stack([np.minimum.reduceat(child_boxes[:, 0], group_starts),
+                                          np.minimum.reduceat(child_boxes[:, 1], group_starts),
+                                          np.maximum.reduceat(child_boxes[:, 2], group_starts),
+                                          np.maximum.reduceat(child_boxes[:, 3], group_starts)])
+            levels_boxes.append(node_boxes)
+            levels_indices.append(start + group_starts)  # the absolute position of the first child
+            start += len(child_boxes)
+            level_ends.append(level_ends[-1] + len(node_boxes))
+        return cls(np.concatenate(levels_boxes), np.concatenate(levels_indices), np.array(level_ends, dtype='int64'),
+                   node_size=node_size, item_cnt=item_cnt)
+
+    def get_children(self, positions, level):
+        '''
+        The positions of the children (on level - 1) of the nodes at the given positions (on level).
+        '''
+        child_level_end = self.level_ends[level - 1]
+        starts = self.indices[positions]
+        ends = np.minimum(starts + self.node_size, child_level_end)
+        counts = ends - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return offsets + np.arange(counts.sum())
+
+    def query_bbox(self, bbox):
+        '''
+        Return the ids of the items whose boxes intersect the bbox (xmin, ymin, xmax, ymax), sorted.
+        '''
+        if self.item_cnt == 0:
+            return np.empty(0, dtype='int64')
+        xmin, ymin, xmax, ymax = bbox
+        level = len(self.level_ends) - 1
+        positions = np.arange(self.level_ends[level - 1] if level > 0 else 0, self.level_ends[level])
+        while True:
+            boxes = self.boxes[positions]
+            hit = (boxes[:, 0] <= xmax) & (boxes[:, 1] <= ymax) & (boxes[:, 2] >= xmin) & (boxes[:, 3] >= ymin)
+            positions = positions[hit]
+            if level == 0 or len(positions) == 0:
+                break
+            positions = self.get_children(positions, level)
+            level -= 1
+        return np.sort(self.indices[positions]) if level == 0 else np.empty(0, dtype='int64')
+
+    def iter_nearest(self, x_min, y_min, x_max, y_max):
+        '''
+        Yield (box distance, item id) in increasing distance of the item boxes to a query box.
+        '''
+        if self.item_cnt == 0:
+            return
+
+        def box_distance(boxes):
+            dx = np.maximum(0, np.maximum(boxes[:, 0] - x_max, x_min - boxes[:, 2]))
+            dy = np.maximum(0, np.maximum(boxes[:, 1] - y_max, y_min - boxes[:, 3]))
+            return np.hypot(dx, dy)
+
+        top_level = len(self.level_ends) - 1
+        top_positions = np.arange(self.level_ends[top_level - 1] if top_level > 0 else 0, self.level_ends[top_level])
+        queue = [(distance, int(position), top_level) for distance, position in zip(box_distance(self.boxes[top_positions]), top_positions)]
+        heapq.heapify(queue)
+        while queue:
+            distance, position, level = heapq.heappop(queue)
+            if not np.isfinite(distance):
+                return
+            if level == 0:
+                yield distance, int(self.indices[position])
+                continue
+            children = self.get_children(np.array([position]), level)
+            for child_distance, child in zip(box_distance(self.boxes[children]), children):
+                heapq.heappush(queue, (child_distance, int(child), level - 1))
+
+    def save(self, path, signature=""):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, boxes=self.boxes, indices=self.indices, level_ends=self.level_ends,
+                 node_size=self.node_size, item_cnt=self.item_cnt, signature=signature)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, signature=None):
+        '''
+        Return the saved tree, or None if it is missing or its signature differs.
+        '''
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if (signature is not None) and (str(data['signature']) != signature):
+                    return None
+                return cls(data['boxes'], data['indices'], data['level_ends'],
+                           node_size=int(data['node_size']), item_cnt=int(data['item_cnt']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def get_layer_signature(path):
+    '''
+    Modification time and size of the layer's files; the sidecar is rebuilt when it changes.
+    '''
+    files = [path]
+    if path.lower().endswith('.shp'):
+        files += [os.path.splitext(path)[0] + ext for ext in shapefile_companions]
+    items = []
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            items.append(f"{os.path.basename(file)}|{stat.st_mtime_ns}|{stat.st_size}")
+    return hashlib.sha1('|'.join(items).encode('utf-8')).hexdigest()
+
+
+def read_geometries(path):
+    return gpd.read_file(path, columns=[]).geometry
+
+
+class LayerIndex():
+    """
+    The spatial index of a layer file, for queries by generated programs. The results are the
+    positions (iloc) of the features in the layer as read by gpd.read_file(path).
+
+    The tree is loaded from the sidecar file next to the layer (built from the layer file and saved
+    if missing or outdated), so the queries do not build an index. The geometries, needed to test
+    the exact predicates, are read on the first such query unless given (see set_geometries()).
+    """
+    def __init__(self, path, geometries=None, node_size=16):
+        self.path = path
+        self.sidecar_path = path + sidecar_suffix
+        self._geometries = None
+        signature = get_layer_signature(path)
+        self.tree = PackedRTree.load(self.sidecar_path, signature=signature)
+        if self.tree is None:
+            self._geometries = np.asarray(read_geometries(path))  # never the caller's, maybe filtered, geometries
+            self.tree = PackedRTree.build(shapely.bounds(self._geometries), node_size=node_size)
+            try:
+                self.tree.save(self.sidecar_path, signature=signature)
+            except OSError as e:  # e.g., a read-only data directory; the index is kept in memory only
+                print(f"Cannot save the spatial index of {path}: {e}")
+        if (self._geometries is None) and (geometries is not None):
+            self.set_geometries(geometries)
+
+    def set_geometries(self, geometries):
+        '''
+        Use the layer's geometries already read by the caller, if they are all the features of the layer
+        in its order and CRS (their boxes are those of the tree); otherwise they are ignored and
+        the geometries are read from the file when needed. Return whether they are used.
+        '''
+        geometries = np.asarray(geometries)
+        if len(geometries) != self.tree.item_cnt:
+            return False
+        item_boxes = np.empty((self.tree.item_cnt, 4))
+        item_boxes[self.tree.indices[:self.tree.item_cnt]] = self.tree.boxes[:self.tree.item_cnt]
+        item_boxes[np.isinf(item_boxes)] = np.nan  # empty geometries
+        if not np.allclose(shapely.bounds(geometries), item_boxes, equal_nan=True):
+            return False
+        self._geometries = geometries
+        return True
+
+    @property
+    def geometries(self):
+        if self._geometries is None:
+            self._geometries = np.asarray(read_geometries(self.path))
+        return self._geometries
+
+    def query_bbox(self, bbox):
+        '''
+        Positions of the features whose bounding boxes intersect the bbox (xmin, ymin, xmax, ymax).
+        '''
+        return self.tree.query_bbox(bbox)
+
+    def query(self, geometry, predicate='intersects'):
+        '''
+        Positions of the features for which "feature <predicate> geometry" is true,
+        e.g., predicate='within' gives the features within the geometry.
+        '''
+        assert predicate in supported_predicates, f"Unknown predicate: {predicate}, should be one of {supported_predicates}"
+        candidates = self.tree.query_bbox(geometry.bounds)
+        if len(candidates) == 0:
+            return candidates
+        return candidates[getattr(shapely, predicate)(self.geometries[candidates], geometry)]
+
+    def within_distance(self, geometry, distance):
+        '''
+        Positions of the features within the distance of the geometry (in the layer's CRS units),
+        the same as intersecting geometry.buffer(distance), without computing the buffer.
+        '''
+        xmin, ymin, xmax, ymax = geometry.bounds
+        candidates = self.tree.query_bbox((xmin - distance, ymin - distance, xmax + distance, ymax + distance))
+        if len(candidates) == 0:
+            return candidates
+        return candidates[shapely.dwithin(self.geometries[candidates], geometry, distance)]
+
+    def nearest(self, geometry, k=1, max_distance=None):
+        '''
+        Positions of the k features nearest to the geometry, nearest first; and their distances.
+        '''
+        found, queue = [], []
+        for box_distance, item in self.tree.iter_nearest(*geometry.bounds):
+            while queue and queue[0][0] <= box_distance:  # no other feature can be nearer
+                found.append(heapq.heappop(queue))
+                if len(found) == k:
+                    break
+            if len(found) == k or ((max_distance is not None) and box_distance > max_distance):
+                break
+            heapq.heappush(queue, (float(shapely.distance(self.geometries[item], geometry)), item))
+        while queue and len(found) < k:
+            found.append(heapq.heappop(queue))
+        found = [(distance, item) for distance, item in found if (max_distance is None) or distance <= max_distance]
+        return np.array([item for _, item in found], dtype='int64'), np.array([distance for distance, _ in found])
+
+    def sjoin(self, left, predicate='intersects', layer=None):
+        '''
+        Pairs of (left position, layer position) for which "left geometry <predicate> feature" is true,
+        like the index pairs of gpd.sjoin(left, layer), without building an index of the layer.
+        left: GeoDataFrame or GeoSeries in the CRS of the layer.
+        '''
+        inverse = {'within': 'contains', 'contains': 'within', 'covers': 'covered_by', 'covered_by': 'covers'}
+        layer_predicate = inverse.get(predicate, predicate)
+        left_positions, layer_positions = [], []
+        for position, geometry in enumerate(left.geometry if hasattr(left, 'geometry') else left):
+            if geometry is None or geometry.is_empty:
+                continue
+            matches = self.query(geometry, predicate=layer_predicate)
+            left_positions.append(np.full(len(matches), position))
+            layer_positions.append(matches)
+        if not left_positions:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+        return np.concatenate(left_positions).astype('int64'), np.concatenate(layer_positions)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path, geometries=None):
+    '''
+    The LayerIndex of a layer file, kept for the next calls of the process while the file is unchanged.
+    geometries: the layer's geometries if already read (e.g., gdf.geometry), to avoid reading them again;
+    ignored unless they are all the features of the file, unchanged (see LayerIndex.set_geometries()).
+    '''
+    key = (os.path.abspath(path), get_layer_signature(path))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = LayerIndex(path)
+            _indexes[key] = index
+        if (index._geometries is None) and (geometries is not None):
+            index.set_geometries(geometries)
+    return index
+
+
+def build_indexes(root='Dataset/Dati_Pesaro'):
+    '''
+    Build (or refresh) the sidecars of every vector layer under root.
+    '''
+    for dir_path, dir_names, file_names in os.walk(root):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() not in indexable_formats:
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                index = LayerIndex(path)
+                print(f"{path}: {index.tree.item_cnt} features")
+            except Exception as e:
+                print(f"Cannot index {path}: {e}")
+
+
+if __name__ == '__main__':
+    build_indexes(*sys.argv[1:2])